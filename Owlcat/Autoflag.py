@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+
+"""This is a library of numpy kernels for the native autoflaggers of Owlcat.Flagger.
+The functions here work on in-memory arrays only. Flagger takes care of reading the
+data from the MS (grouped by baseline, and sorted in time), and of writing the
+resulting flags back into a flagset.
+""";
+
+import re
+import warnings
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+# casacore Stokes enum values of the correlation types we know about
+CORR_TYPES = dict(RR=5,RL=6,LR=7,LL=8,XX=9,XY=10,YX=11,YY=12);
+
+# functions that can be used in an autoflag expression
+EXPR_FUNCS = dict(ABS=numpy.abs,ARG=numpy.angle,RE=numpy.real,IM=numpy.imag,
+                  NORM=lambda x:x.real**2+x.imag**2);
+
+# sliding medians are computed in blocks of up to this many window elements, to keep the
+# temporary arrays made by nanmedian() bounded
+_MEDIAN_BLOCK_SIZE = 1<<22;
+
+def parse_expr (expr,corrtypes):
+  """Parses an autoflag expression of the form "FUNC CORRS", as used by the glish autoflagger.
+  FUNC is one of ABS, ARG, RE, IM or NORM. CORRS is a correlation name (e.g. "XX"), a sum or
+  difference of correlations (e.g. "XX+YY", "RR-LL"), or "I" for the sum of the parallel hands.
+  corrtypes is the list of CORR_TYPE values of the data.
+  Returns (func,terms) tuple, where func maps complex values to real, and terms is a list of
+  (sign,icorr) pairs.
+  """;
+  fields = expr.upper().split();
+  if len(fields) != 2 or fields[0] not in EXPR_FUNCS:
+    raise ValueError,"invalid autoflag expression '%s'"%expr;
+  funcname,corrs = fields;
+  corrnames = dict([ (num,name) for name,num in CORR_TYPES.iteritems() ]);
+  available = [ corrnames.get(ct) for ct in corrtypes ];
+  if corrs == "I":
+    terms = [ (1,available.index(name)) for name in ("XX","YY","RR","LL") if name in available ];
+    if not terms:
+      raise ValueError,"autoflag expression '%s': no parallel-hand correlations in data"%expr;
+  else:
+    if not re.match("^([+-]?[A-Z]+)+$",corrs):
+      raise ValueError,"invalid autoflag expression '%s'"%expr;
+    terms = [];
+    for sign,name in re.findall("([+-]?)([A-Z]+)",corrs):
+      if name not in available:
+        raise ValueError,"autoflag expression '%s': correlation %s not in data"%(expr,name);
+      terms.append((-1 if sign == "-" else 1,available.index(name)));
+  return EXPR_FUNCS[funcname],terms;
+
+def eval_expr (data,func,terms):
+  """Evaluates a parsed autoflag expression (see parse_expr()) on an (nrows,nchan,ncorr) data array.
+  Returns an (nrows,nchan) array of real values.""";
+  sign,icorr = terms[0];
+  value = data[:,:,icorr]*sign;
+  for sign,icorr in terms[1:]:
+    value += data[:,:,icorr]*sign;
+  return numpy.asarray(func(value),float);
+
+def sliding_median (x,hw,axis=0):
+  """Returns the median of the 2D array x over a sliding window of 2*hw+1 points along the given
+  axis. Windows are truncated at the edges, and NaNs (e.g. flagged points) are ignored. A window
+  with no valid points gives NaN.
+  """;
+  if axis:
+    return sliding_median(x.T,hw,0).T;
+  n,m = x.shape;
+  # pad with NaNs, and make a (n,2*hw+1,m) view of all the windows
+  padded = numpy.empty((n+2*hw,m),float);
+  padded.fill(numpy.nan);
+  padded[hw:hw+n] = x;
+  s0,s1 = padded.strides;
+  windows = as_strided(padded,shape=(n,2*hw+1,m),strides=(s0,s0,s1));
+  result = numpy.empty((n,m),float);
+  step = max(_MEDIAN_BLOCK_SIZE//((2*hw+1)*max(m,1)),1);
+  with warnings.catch_warnings():
+    # all-NaN windows are expected, and give NaN
+    warnings.simplefilter("ignore",RuntimeWarning);
+    for i0 in range(0,n,step):
+      result[i0:i0+step] = numpy.nanmedian(windows[i0:i0+step],axis=1);
+  return result;
+
+def median_flag (values,axis=0,thr=5,hw=10,rowthr=10,rowhw=6,norow=False):
+  """Sliding-median flagger for an (ntime,nchan) plane of real values, with NaNs marking points
+  that are already flagged. The median is taken along time (axis=0, as in settimemed) or frequency
+  (axis=1, as in setfreqmed), over a window of 2*hw+1 points. The deviation of each point from
+  the median is compared to the noise level of its timeslot, which is estimated as the median
+  deviation over all channels, and points deviating by more than thr times the noise are flagged.
+  Unless norow is set, entire timeslots are flagged if their noise level exceeds rowthr times
+  the median noise over a sliding window of 2*rowhw+1 timeslots.
+  Returns (flags,rowflags) tuple of boolean arrays, of shape (ntime,nchan) and (ntime,).
+  """;
+  dev = abs(values-sliding_median(values,hw,axis));
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore",RuntimeWarning);
+    noise = numpy.nanmedian(dev,axis=1);
+  with numpy.errstate(invalid='ignore'):
+    flags = dev > thr*noise[:,numpy.newaxis];
+    if norow:
+      rowflags = numpy.zeros(len(noise),bool);
+    else:
+      rowflags = noise > rowthr*sliding_median(noise[:,numpy.newaxis],rowhw)[:,0];
+  return flags,rowflags;
+
+def _sumthreshold_pass (values,flags,chi,m,axis):
+  """Helper function: one SumThreshold pass with windows of m samples along the given axis of a 2D
+  array. Flagged samples count as chi in the window sums. Returns boolean array of all samples
+  that fall into some window with a sum exceeding m*chi.""";
+  if axis:
+    return _sumthreshold_pass(values.T,flags.T,chi,m,0).T;
+  n,k = values.shape;
+  # window sums, via a cumulative sum along the axis
+  cs = numpy.zeros((n+1,k),float);
+  numpy.cumsum(numpy.where(flags,chi,values),axis=0,out=cs[1:]);
+  hits = (cs[m:]-cs[:-m]) > m*chi;
+  # sample i is in a window starting at j if i-m<j<=i, so count hits over that range, again via a cumulative sum
+  ch = numpy.zeros((n-m+2,k),int);
+  numpy.cumsum(hits,axis=0,out=ch[1:]);
+  i = numpy.arange(n);
+  return (ch[numpy.minimum(i,n-m)+1]-ch[numpy.maximum(i-m+1,0)]) > 0;
+
+def sumthreshold (values,flags,chi1,rho=1.5,max_window=64):
+  """SumThreshold algorithm (Offringa et al. 2010, MNRAS 405, 155) for a 2D (ntime,nchan) array of
+  values, e.g. residual amplitudes in units of the noise. For window sizes of m=1,2,4,...,max_window
+  samples, in turn along time and frequency, m consecutive samples are flagged if their sum exceeds
+  m*chi, where chi=chi1/rho**log2(m). Samples flagged in existing flags, or by a previous pass, count
+  as chi in the sums. Returns boolean array of flags, including the existing flags.
+  """;
+  flags = flags.copy();
+  m = 1;
+  while m <= max_window:
+    chi = chi1/rho**numpy.log2(m);
+    for axis in 0,1:
+      if values.shape[axis] >= m:
+        flags |= _sumthreshold_pass(values,flags,chi,m,axis);
+    m *= 2;
+  return flags;
+
+def sumthreshold_flag (amps,flags=None,thr=6,rho=1.5,max_window=64,niter=2):
+  """SumThreshold flagger for an (ntime,nchan) plane of amplitudes, with existing flags given by a
+  boolean array (or None). A background is estimated as the median over time of each channel, and
+  the residuals are normalized by their robust (MAD-based) standard deviation and passed to
+  sumthreshold(), with thr as the base threshold. The background and noise estimates leave out
+  the flags of the previous iteration, and are redone niter times.
+  Returns boolean array of new flags (not including the existing ones).
+  """;
+  flags0 = numpy.isnan(amps);
+  if flags is not None:
+    flags0 |= flags;
+  newflags = numpy.zeros(amps.shape,bool);
+  with warnings.catch_warnings():
+    # all-NaN channels are expected, and give NaN
+    warnings.simplefilter("ignore",RuntimeWarning);
+    for i in range(niter):
+      background = numpy.nanmedian(numpy.where(flags0|newflags,numpy.nan,amps),axis=0);
+      resid = amps - background[numpy.newaxis,:];
+      sigma = 1.4826*numpy.nanmedian(abs(resid[~(flags0|newflags)]));
+      if not numpy.isfinite(sigma) or not sigma:
+        break;
+      resid /= sigma;
+      invalid = numpy.isnan(resid);
+      resid[invalid] = 0;
+      newflags = sumthreshold(resid,flags0|invalid,thr,rho,max_window)&~(flags0|invalid);
+  return newflags;
+
+def dilate (mask,grow,axis=0,lower=None,upper=None):
+  """Dilates a boolean array by grow samples either way along the given axis, i.e. a sample becomes
+  set if any sample within grow of it is set. Window counts are taken via a cumulative sum along the
+  axis. lower and upper optionally give, per index along the axis, the range lower<=j<upper of indices
+  that it may be grown from, so that e.g. flags are not grown across the boundary of two baselines.
+  """;
+  if not grow:
+    return mask;
+  if axis:
+    return dilate(mask.swapaxes(0,axis),grow,0,lower,upper).swapaxes(0,axis);
+  n = mask.shape[0];
+  cs = numpy.zeros((n+1,)+mask.shape[1:],int);
+  numpy.cumsum(mask,axis=0,out=cs[1:]);
+  i = numpy.arange(n);
+  lo = numpy.maximum(i-grow,0 if lower is None else lower);
+  hi = numpy.minimum(i+grow+1,n if upper is None else upper);
+  return (cs[hi]-cs[lo]) > 0;
+
+def grow_flags (flags,grow_time=0,grow_freq=0,threshold_frac=None,lower=None,upper=None):
+  """Grows an (ntime,nchan,...) array of flags (which may hold the planes of several baselines one
+  after another, with lower and upper giving the per-timeslot baseline bounds, see dilate()). Flags
+  are first extended by grow_time timeslots and grow_freq channels either way. Then, if threshold_frac
+  is given, every timeslot with more than that fraction of its samples (over all the trailing axes, e.g.
+  channels and correlations together) flagged is flagged entirely.
+  Returns boolean array of flags, including the original ones.
+  """;
+  flags = dilate(dilate(flags,grow_time,0,lower,upper),grow_freq,1);
+  if threshold_frac is not None and flags.size:
+    fraction = flags.reshape((flags.shape[0],-1)).mean(1);
+    flags = flags.copy();
+    flags[fraction>threshold_frac] = True;
+  return flags;
+
+class UVBinHistogram (object):
+  """Per-channel 2D histogram of visibilities binned by UV distance and value, as used by the UV-bin
+  flagger. The ranges of both axes are given up front (the UV-bin flagger finds them in a first pass
+  over the data), so that each axis has exactly the requested number of bins. Points outside the
+  ranges go into the edge bins.
+  """;
+  def __init__ (self,nchan,nbins=50,uvrange=(0.,1.),valrange=(0.,1.)):
+    if not isinstance(nbins,(list,tuple)):
+      nbins = nbins,nbins;
+    self.nbins = [ max(int(n),1) for n in nbins ];
+    self.counts = numpy.zeros([nchan]+self.nbins,numpy.int64);
+    # (lo,width) of each axis
+    self.ranges = [ self._range(*uvrange),self._range(*valrange) ];
+
+  @staticmethod
+  def _range (vmin,vmax):
+    """Helper method. Converts a vmin~vmax range into (lo,width), widened a little so that vmax falls
+    into the last bin, and given a small non-zero width if vmin==vmax.""";
+    width = vmax - vmin;
+    return vmin,(width*(1+1e-6) if width > 0 else max(abs(vmin),1.)*1e-6);
+
+  def bin_widths (self):
+    """Returns the (uvdist,value) widths of the bins.""";
+    return tuple([ width/n for (lo,width),n in zip(self.ranges,self.nbins) ]);
+
+  def _bin (self,axis,x):
+    lo,width = self.ranges[axis];
+    n = self.nbins[axis];
+    return numpy.clip(((x-lo)*(n/width)).astype(int),0,n-1);
+
+  def bin_index (self,chans,uvdist,values):
+    """Returns the flat indices (into self.counts) of the bins of the given points.""";
+    return (chans*self.nbins[0]+self._bin(0,uvdist))*self.nbins[1]+self._bin(1,values);
+
+  def add (self,uvdist,values,valid):
+    """Adds a chunk of data to the histogram. uvdist is an (nrows,) array of UV distances, values an
+    (nrows,nchan) array of real values, and valid a boolean (nrows,nchan) array of points to include.""";
+    rows,chans = numpy.nonzero(valid&numpy.isfinite(values));
+    if not len(rows):
+      return;
+    counts = numpy.bincount(self.bin_index(chans,uvdist[rows],values[rows,chans]));
+    self.counts.ravel()[:len(counts)] += counts;
+
+def uvbin_lowpop (counts,thr=0.001,minpop=0):
+  """Given an (nchan,nuv,nval) array of bin counts (see UVBinHistogram), returns a boolean array of
+  the bins to be flagged: bins holding fewer than minpop points, and, per channel, the least populated
+  bins which between them hold no more than a fraction thr of all points.
+  """;
+  shape = counts.shape;
+  nchan = shape[0];
+  counts = counts.reshape((nchan,-1));
+  flagged = (counts>0)&(counts<minpop);
+  if thr:
+    order = numpy.argsort(counts,axis=1,kind='mergesort');
+    chans = numpy.arange(nchan)[:,numpy.newaxis];
+    cumcounts = numpy.cumsum(counts[chans,order],axis=1);
+    lowest = numpy.zeros(counts.shape,bool);
+    lowest[chans,order] = cumcounts <= thr*cumcounts[:,-1:];
+    flagged |= lowest&(counts>0);
+  return flagged.reshape(shape);
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+
+"""This implements flag occupancy cubes, as made by Owlcat.Flagger.occupancy(). For every DATA_DESC_ID,
+the cube holds the number of flagged visibilities (summed over correlations) for every baseline, block
+of chanbin channels and block of time, with one count per flagset. The number of visibilities per channel
+in every baseline and time block is kept alongside, so that flag fractions are counts/(nvis*channels per
+block). Counts are kept in the smallest unsigned integer type that can hold them (see count_dtype()),
+and the cube is converted to a larger type if a count would overflow. Cubes are accumulated chunk by
+chunk, and saved to a .npz file for plotting.
+""";
+
+import numpy
+
+# format version of the occupancy file. Version 1 files have no channel blocks
+VERSION = 2;
+
+# default size of time blocks, in seconds
+DEFAULT_TIMEBIN = 600.;
+
+# unsigned integer types for counts, smallest first
+COUNT_DTYPES = [ numpy.uint8,numpy.uint16,numpy.uint32,numpy.uint64 ];
+
+def count_dtype (maxcount):
+  """Returns the smallest unsigned integer type that can hold counts up to maxcount.""";
+  for dtype in COUNT_DTYPES:
+    if maxcount <= numpy.iinfo(dtype).max:
+      return dtype;
+  return COUNT_DTYPES[-1];
+
+class FlagOccupancy (object):
+  def __init__ (self,flagsets,flagmasks,ant1,ant2,time0,ntime,timebin=DEFAULT_TIMEBIN,chanbin=1,maxrows=1):
+    """Creates empty occupancy for the given lists of flagset names and flagmasks, the baselines given
+    by arrays of ant1 and ant2, ntime blocks of timebin seconds, starting at time0, and blocks of chanbin
+    channels. maxrows is the expected maximum number of rows of one baseline in a time block (i.e. the
+    number of timeslots per block), and is used to pick the type of the counts. Flagsets given as
+    flagmasks are named by their string representation.""";
+    self.flagsets = map(str,flagsets);
+    self.flagmasks = list(flagmasks);
+    self.ant1 = numpy.asarray(ant1,int);
+    self.ant2 = numpy.asarray(ant2,int);
+    self.time0,self.ntime,self.timebin = time0,ntime,timebin;
+    self.chanbin,self.maxrows = max(int(chanbin),1),max(int(maxrows),1);
+    # sorted baseline keys, for looking up baseline indices
+    self._blkeys = (self.ant1<<16)|self.ant2;
+    self._blorder = numpy.argsort(self._blkeys);
+    # per-DDID cubes of counts, of shape (nbaselines,nchanblocks,ntime,nflagsets), arrays of number of
+    # visibilities per channel, of shape (nbaselines,ntime), and numbers of channels
+    self.counts = {};
+    self.nvis = {};
+    self.nchan = {};
+
+  def ddids (self):
+    return sorted(self.counts.keys());
+
+  def baselines (self):
+    return zip(self.ant1.tolist(),self.ant2.tolist());
+
+  def nchanblocks (self,nchan):
+    """Returns the number of channel blocks for nchan channels.""";
+    return (nchan+self.chanbin-1)//self.chanbin;
+
+  def chanblock_widths (self,ddid):
+    """Returns array of the number of channels in every channel block of the given DDID.""";
+    nchan = self.nchan[ddid];
+    return numpy.minimum(self.chanbin,nchan-numpy.arange(self.nchanblocks(nchan))*self.chanbin);
+
+  def cube_dtype (self,ncorr):
+    """Returns the type of the counts of a cube with ncorr correlations.""";
+    return count_dtype(ncorr*self.chanbin*self.maxrows);
+
+  def cube_nbytes (self,nchan,ncorr):
+    """Returns the size in bytes of the cube (and visibility counts) of a DDID of nchan channels and ncorr
+    correlations, for estimating memory use beforehand.""";
+    ncell = len(self.ant1)*self.ntime;
+    return ncell*self.nchanblocks(nchan)*len(self.flagmasks)*numpy.dtype(self.cube_dtype(ncorr)).itemsize + ncell*8;
+
+  def _cells (self,ant1,ant2,time):
+    """Helper method. Returns (baseline,timeblock) arrays of indices for the given rows.""";
+    keys = (numpy.asarray(ant1,int)<<16)|ant2;
+    ibl = self._blorder[numpy.searchsorted(self._blkeys[self._blorder],keys)];
+    itime = numpy.clip(numpy.floor((numpy.asarray(time)-self.time0)/self.timebin).astype(int),0,self.ntime-1);
+    return ibl,itime;
+
+  def add (self,ddid,ant1,ant2,time,ncorr,counts):
+    """Adds a chunk of rows (all with the same DDID, and all of baselines known to the occupancy).
+    counts is an (nrows,nchan,nflagsets) array of per-row, per-channel counts of flagged visibilities
+    for every flagset, and ncorr is the number of correlations.""";
+    nrows,nchan,nfs = counts.shape;
+    nblk = self.nchanblocks(nchan);
+    if ddid not in self.counts:
+      self.counts[ddid] = numpy.zeros((len(self.ant1),nblk,self.ntime,nfs),self.cube_dtype(ncorr));
+      self.nvis[ddid] = numpy.zeros((len(self.ant1),self.ntime),numpy.int64);
+      self.nchan[ddid] = nchan;
+    if not nrows:
+      return;
+    ibl,itime = self._cells(ant1,ant2,time);
+    numpy.add.at(self.nvis[ddid],(ibl,itime),ncorr);
+    # rows are mapped to the cells present in this chunk, and the counts are summed up with a bincount
+    # over the index (cell,chanblock,flagset) encoded into a single integer
+    ucells,inverse = numpy.unique(ibl*self.ntime+itime,return_inverse=True);
+    chanblocks = numpy.arange(nchan)//self.chanbin;
+    index = (inverse[:,numpy.newaxis,numpy.newaxis]*nblk + chanblocks[numpy.newaxis,:,numpy.newaxis])*nfs \
+            + numpy.arange(nfs)[numpy.newaxis,numpy.newaxis,:];
+    sums = numpy.bincount(index.ravel(),weights=counts.ravel(),minlength=len(ucells)*nblk*nfs);
+    # (baseline,time) pairs are unique, so indexed assignment is safe here
+    cells = ucells//self.ntime,slice(None),ucells%self.ntime,slice(None);
+    cube = self.counts[ddid];
+    updated = cube[cells] + sums.reshape((len(ucells),nblk,nfs)).astype(numpy.uint64);
+    # if a count no longer fits (e.g. a baseline has more rows per time block than expected), convert the cube
+    maxcount = updated.max() if updated.size else 0;
+    if maxcount > numpy.iinfo(cube.dtype).max:
+      cube = self.counts[ddid] = cube.astype(count_dtype(maxcount));
+    cube[cells] = updated;
+
+  def fraction (self,ddid,flagset=None):
+    """Returns the cube of flag fractions of the given DDID, of shape (nbaselines,nchanblocks,ntime,nflagsets),
+    or (nbaselines,nchanblocks,ntime) if a flagset name is given. Cells with no data are NaN.""";
+    counts = self.counts[ddid];
+    if flagset is not None:
+      counts = counts[...,self.flagsets.index(flagset)];
+    nvis = self.nvis[ddid].astype(float);
+    nvis[nvis==0] = numpy.nan;
+    nvis = nvis[:,numpy.newaxis,:]*self.chanblock_widths(ddid)[numpy.newaxis,:,numpy.newaxis];
+    if flagset is None:
+      nvis = nvis[...,numpy.newaxis];
+    return counts/nvis;
+
+  def save (self,filename):
+    """Saves occupancy to file (given by name, or as a file object).""";
+    arrays = {};
+    for ddid in self.counts:
+      arrays['counts_%d'%ddid] = self.counts[ddid];
+      arrays['nvis_%d'%ddid] = self.nvis[ddid];
+      arrays['nchan_%d'%ddid] = self.nchan[ddid];
+    numpy.savez(filename,version=VERSION,chanbin=self.chanbin,maxrows=self.maxrows,flagsets=numpy.array(self.flagsets),
+                flagmasks=numpy.array(self.flagmasks,numpy.int64),ant1=self.ant1,ant2=self.ant2,
+                time0=self.time0,ntime=self.ntime,timebin=self.timebin,ddids=numpy.array(self.ddids(),int),**arrays);
+
+  @staticmethod
+  def load (filename):
+    """Loads occupancy from file. Returns None if the file is not in a known format. Version 1 files
+    are loaded with one channel per block.""";
+    data = numpy.load(filename);
+    if 'version' not in data.files or int(data['version']) not in (1,VERSION):
+      return None;
+    version = int(data['version']);
+    occ = FlagOccupancy(data['flagsets'].tolist(),data['flagmasks'].tolist(),data['ant1'],data['ant2'],
+                        float(data['time0']),int(data['ntime']),float(data['timebin']),
+                        *([] if version == 1 else [ int(data['chanbin']),int(data['maxrows']) ]));
+    for ddid in data['ddids'].tolist():
+      occ.counts[ddid] = data['counts_%d'%ddid];
+      occ.nvis[ddid] = data['nvis_%d'%ddid];
+      occ.nchan[ddid] = occ.counts[ddid].shape[1] if version == 1 else int(data['nchan_%d'%ddid]);
+    return occ;
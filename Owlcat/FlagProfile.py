@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+
+"""This implements per-stage timing of Owlcat.Flagger operations. A Profile accumulates, for every
+(stage,column) pair, the number of calls, the cumulative wall time, the number of rows processed,
+and the number of bytes read and written. Stages are timed with a context manager:
+
+  with profile.stage('getcol','FLAG',nrows) as st:
+    value = ms.getcol('FLAG',row0,nrows);
+    st.read(value.nbytes);
+
+Stages may be nested (e.g. a whole xflag() call is a stage too), and may run in the background I/O
+threads of the Flagger, so their times overlap and do not add up to the total. NULL_PROFILE has the
+same interface and does nothing, and is used when profiling is disabled.
+""";
+
+import time
+import threading
+import json
+
+class _Stage (object):
+  def __init__ (self,profile,key,nrows):
+    self.profile,self.key,self.nrows = profile,key,nrows;
+    self.nread = self.nwritten = 0;
+
+  def read (self,nbytes):
+    self.nread += nbytes;
+
+  def wrote (self,nbytes):
+    self.nwritten += nbytes;
+
+  def rows (self,nrows):
+    self.nrows += nrows;
+
+  def __enter__ (self):
+    self.t0 = time.time();
+    return self;
+
+  def __exit__ (self,*exc):
+    self.profile.record(self.key,time.time()-self.t0,self.nrows,self.nread,self.nwritten);
+    return False;
+
+class _NullStage (object):
+  def read (self,nbytes):
+    pass;
+  wrote = rows = read;
+
+  def __enter__ (self):
+    return self;
+
+  def __exit__ (self,*exc):
+    return False;
+
+class Profile (object):
+  # fields accumulated per (stage,column) key
+  FIELDS = 'calls','seconds','rows','bytes_read','bytes_written';
+
+  def __init__ (self):
+    self.start = time.time();
+    # (stage,column) -> list of accumulated values, in the order of FIELDS
+    self.stages = {};
+    # order in which keys were first seen, so that the table follows the order of processing
+    self._order = [];
+    self._lock = threading.Lock();
+
+  def stage (self,name,column=None,nrows=0):
+    """Returns context manager timing a stage, optionally for a given column and number of rows.""";
+    return _Stage(self,(name,column),nrows);
+
+  def record (self,key,seconds,nrows=0,nread=0,nwritten=0):
+    """Adds a timing to the given (stage,column) key.""";
+    self._lock.acquire();
+    try:
+      acc = self.stages.get(key);
+      if acc is None:
+        acc = self.stages[key] = [0,0.,0,0,0];
+        self._order.append(key);
+      acc[0] += 1;
+      acc[1] += seconds;
+      acc[2] += nrows;
+      acc[3] += nread;
+      acc[4] += nwritten;
+    finally:
+      self._lock.release();
+
+  def reset (self):
+    self._lock.acquire();
+    try:
+      self.start = time.time();
+      self.stages = {};
+      self._order = [];
+    finally:
+      self._lock.release();
+
+  def as_list (self):
+    """Returns list of dicts, one per (stage,column) key, with the accumulated values, and rows_per_sec.""";
+    result = [];
+    for key in self._order:
+      entry = dict(zip(self.FIELDS,self.stages[key]));
+      entry['stage'],entry['column'] = key;
+      entry['rows_per_sec'] = entry['rows']/entry['seconds'] if entry['seconds'] and entry['rows'] else None;
+      result.append(entry);
+    return result;
+
+  def summary (self):
+    """Returns summary table as a list of lines.""";
+    lines = [ "%-16s %-16s %7s %10s %12s %10s %10s"%("stage","column","calls","seconds","rows/s","MB read","MB written") ];
+    for entry in self.as_list():
+      lines.append("%-16s %-16s %7d %10.3f %12s %10.1f %10.1f"%(entry['stage'],entry['column'] or "",entry['calls'],
+          entry['seconds'],"%.0f"%entry['rows_per_sec'] if entry['rows_per_sec'] else "",
+          entry['bytes_read']/1e+6,entry['bytes_written']/1e+6));
+    lines.append("wall time since start: %.3f s"%(time.time()-self.start));
+    return lines;
+
+  def dump (self,filename,**info):
+    """Writes the profile to a JSON file. Any keyword arguments are included as extra information.""";
+    info = dict(info);
+    info.update(start=self.start,wall_time=time.time()-self.start,stages=self.as_list());
+    json.dump(info,file(filename,"w"),indent=1);
+
+class _NullProfile (object):
+  _stage = _NullStage();
+
+  def __nonzero__ (self):
+    return False;
+
+  def stage (self,name,column=None,nrows=0):
+    return self._stage;
+
+  def record (self,key,seconds,nrows=0,nread=0,nwritten=0):
+    pass;
+
+NULL_PROFILE = _NullProfile();
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+
+"""This implements an index of flag regions, used by Owlcat.Flagger.flag_regions() to apply a large
+number of regions in a single pass through the MS. A region is a time range, plus optional sets of
+DATA_DESC_IDs, baselines and antennas, and an optional list of channel slices. Regions are indexed by
+time interval: the start times are sorted, and a running maximum of the end times (in the same order)
+gives the first region that can still reach a given time, so the regions overlapping a chunk of rows
+are found with two searchsorted() calls. Set memberships are kept as sorted arrays of (region,key)
+pairs packed into integers, so that all (row,region) pairs of a chunk are matched at once.
+""";
+
+import numpy
+
+def _member (sorted_keys,keys):
+  """Helper function. Returns boolean array telling which of keys are in the sorted array sorted_keys.""";
+  if not len(sorted_keys):
+    return numpy.zeros(len(keys),bool);
+  i = numpy.minimum(numpy.searchsorted(sorted_keys,keys),len(sorted_keys)-1);
+  return sorted_keys[i] == keys;
+
+class RegionIndex (object):
+  def __init__ (self,regions,time0=0):
+    """Builds index from a list of regions, given as dicts with the following (optional) keys:
+    'time' is a (t0,t1) range of times, or 'reltime' a range of times relative to time0 (either end may
+    be None); 'ddid' is a DATA_DESC_ID or a list of them; 'baselines' is a list of (p,q) antenna pairs;
+    'antennas' is a list of antennas, any of which a baseline must involve; 'channels' is a list of
+    channel slices. Missing keys (or None) mean no restriction.
+    """;
+    nreg = len(regions);
+    t0 = numpy.empty(nreg,float);
+    t1 = numpy.empty(nreg,float);
+    for i,reg in enumerate(regions):
+      trange,offset = (reg['reltime'],time0) if reg.get('reltime') is not None else (reg.get('time'),0);
+      if trange is None:
+        t0[i],t1[i] = -numpy.inf,numpy.inf;
+      else:
+        t0[i] = -numpy.inf if trange[0] is None else trange[0]+offset;
+        t1[i] = numpy.inf if trange[1] is None else trange[1]+offset;
+    # regions are kept in order of start time
+    order = numpy.argsort(t0,kind='mergesort');
+    self.regions = [ regions[i] for i in order ];
+    self.t0 = t0[order];
+    self.t1 = t1[order];
+    self.maxt1 = numpy.maximum.accumulate(self.t1) if nreg else self.t1;
+    # per-region flags telling if the region is restricted by DDID, baseline or antenna, and the
+    # sorted (region<<32)|key arrays of the DDIDs, baselines (p<<16|q) and antennas of the restricted ones
+    self._any = {};
+    self._keys = {};
+    for name,keyfunc in (('ddid',int),('baselines',lambda (p,q):(int(p)<<16)|int(q)),('antennas',int)):
+      anykey = self._any[name] = numpy.ones(nreg,bool);
+      keys = [];
+      for i,reg in enumerate(self.regions):
+        values = reg.get(name);
+        if values is not None:
+          if name == 'ddid' and not isinstance(values,(list,tuple)):
+            values = [ values ];
+          anykey[i] = False;
+          keys += [ (i<<32)|keyfunc(value) for value in values ];
+      self._keys[name] = numpy.unique(numpy.array(keys,numpy.int64));
+    # per-nchan cache of (nreg,nchan) channel masks
+    self._chanmasks = {};
+
+  def __len__ (self):
+    return len(self.t0);
+
+  def overlapping (self,tmin,tmax):
+    """Returns array of indices of the regions overlapping the time range tmin~tmax.""";
+    # regions before 'start' end before tmin, regions from 'stop' on start after tmax
+    start = numpy.searchsorted(self.maxt1,tmin,'left');
+    stop = numpy.searchsorted(self.t0,tmax,'right');
+    cand = numpy.arange(start,max(start,stop));
+    return cand[self.t1[cand]>=tmin];
+
+  def chanmask (self,nchan):
+    """Returns (nregions,nchan) boolean array of the channels of each region.""";
+    mask = self._chanmasks.get(nchan);
+    if mask is None:
+      mask = self._chanmasks[nchan] = numpy.zeros((len(self.regions),nchan),bool);
+      for i,reg in enumerate(self.regions):
+        for chans in reg.get('channels') or [ slice(None) ]:
+          mask[i,chans] = True;
+    return mask;
+
+  def hits (self,ddid,time,ant1,ant2):
+    """Matches a chunk of rows (all with the same DDID) against the regions. Returns (rows,regions)
+    tuple of arrays, giving every pair of a row number (within the chunk) and a region that contains it.""";
+    cand = self.overlapping(time.min(),time.max()) if len(time) else numpy.zeros(0,int);
+    cand = cand[self._any['ddid'][cand]|_member(self._keys['ddid'],(cand.astype(numpy.int64)<<32)|ddid)];
+    if not len(cand):
+      return cand,cand;
+    # rows of each candidate region, as ranges in the time-sorted order of rows
+    order = numpy.argsort(time,kind='mergesort');
+    times = time[order];
+    lo = numpy.searchsorted(times,self.t0[cand],'left');
+    nrows = numpy.maximum(numpy.searchsorted(times,self.t1[cand],'right')-lo,0);
+    # expand the ranges into (row,region) pairs
+    regions = numpy.repeat(cand,nrows).astype(numpy.int64);
+    offsets = numpy.arange(nrows.sum()) - numpy.repeat(numpy.cumsum(nrows)-nrows,nrows);
+    rows = order[numpy.repeat(lo,nrows)+offsets];
+    a1 = numpy.asarray(ant1,numpy.int64)[rows];
+    a2 = numpy.asarray(ant2,numpy.int64)[rows];
+    match = self._any['baselines'][regions]|_member(self._keys['baselines'],(regions<<32)|(a1<<16)|a2);
+    match &= self._any['antennas'][regions]|_member(self._keys['antennas'],(regions<<32)|a1)| \
+                                           _member(self._keys['antennas'],(regions<<32)|a2);
+    return rows[match],regions[match];
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+
+"""This implements a shadow store for the BITFLAG and BITFLAG_ROW columns of an MS, used by
+Owlcat.Flagger to run a session of flagging operations at memory speed. The columns are copied
+once into numpy memory-mapped files in a local directory, one pair of files per DATA_DESC_ID,
+with rows in the order of the row index (see Owlcat.MSIndex), so that the rows of each DDID are
+contiguous. Reads and writes of these columns then go to the shadow, which keeps track of the rows
+that have been written. sync() writes the changed rows back to the MS.
+""";
+
+import os
+import os.path
+import shutil
+import tempfile
+
+import numpy
+
+# columns kept in the shadow
+COLUMNS = ('BITFLAG','BITFLAG_ROW');
+
+class FlagShadow (object):
+  def __init__ (self,ms,index,ddids,directory=None,chunksize=200000):
+    """Creates shadow of the bitflag columns of ms (which must be the full MS), for the given list
+    of DDIDs, using the given MSIndex.RowIndex. If directory is None, a temporary directory is
+    created, and removed again by close().""";
+    self._tmpdir = directory is None;
+    self.directory = tempfile.mkdtemp(prefix="flagshadow-") if directory is None else directory;
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory);
+    # per-row DDID and position within the per-DDID arrays. Rows of other DDIDs have ddid -1
+    nrows = ms.nrows();
+    self.row_ddid = numpy.empty(nrows,int);
+    self.row_ddid.fill(-1);
+    self.row_pos = numpy.zeros(nrows,int);
+    # per-DDID row numbers, memmaps, and masks of rows that have been written to
+    self.rows = {};
+    self.arrays = {};
+    self.dirty = {};
+    for ddid in ddids:
+      rows = self.rows[ddid] = index.ddid_rows([ddid]);
+      self.row_ddid[rows] = ddid;
+      self.row_pos[rows] = numpy.arange(len(rows));
+      subms = ms.selectrows(rows);
+      arrays = self.arrays[ddid] = {};
+      for col in COLUMNS:
+        # take shape and type from the first row
+        first = subms.getcol(col,0,1);
+        filename = os.path.join(self.directory,"%s_%d.dat"%(col,ddid));
+        arr = arrays[col] = numpy.memmap(filename,dtype=first.dtype,mode='w+',shape=(len(rows),)+first.shape[1:]);
+        for row0 in range(0,len(rows),chunksize):
+          n = min(chunksize,len(rows)-row0);
+          arr[row0:row0+n] = subms.getcol(col,row0,n);
+      self.dirty[ddid] = numpy.zeros(len(rows),bool);
+
+  def _locate (self,rownums):
+    """Helper method. Maps an array of row numbers (which must all belong to one DDID) to a
+    (ddid,index) tuple, where index indexes the per-DDID arrays, and is a slice if possible.""";
+    ddids = numpy.unique(self.row_ddid[rownums]);
+    if len(ddids) != 1 or ddids[0] < 0:
+      raise KeyError,"rows do not belong to a single shadowed DATA_DESC_ID";
+    pos = self.row_pos[rownums];
+    if len(pos) and pos[-1]-pos[0] == len(pos)-1 and (numpy.diff(pos)==1).all():
+      pos = slice(pos[0],pos[-1]+1);
+    return ddids[0],pos;
+
+  def getcol (self,colname,rownums):
+    """Returns values of the column for the given row numbers of the MS.""";
+    ddid,pos = self._locate(rownums);
+    return numpy.array(self.arrays[ddid][colname][pos]);
+
+  def putcol (self,colname,value,rownums):
+    """Writes values of the column for the given row numbers of the MS.""";
+    ddid,pos = self._locate(rownums);
+    self.arrays[ddid][colname][pos] = value;
+    self.dirty[ddid][pos] = True;
+
+  def ndirty (self):
+    """Returns number of rows that have been written to since the last sync().""";
+    return sum([ dirty.sum() for dirty in self.dirty.itervalues() ]);
+
+  def sync (self,ms):
+    """Writes the rows that have changed back to ms (which must be the full MS, opened for writing).
+    Returns number of rows written.""";
+    nrows = 0;
+    for ddid,dirty in self.dirty.iteritems():
+      pos = numpy.flatnonzero(dirty);
+      if not len(pos):
+        continue;
+      subms = ms.selectrows(self.rows[ddid]);
+      # write spans of consecutive dirty rows
+      breaks = numpy.flatnonzero(numpy.diff(pos)>1);
+      for i0,i1 in zip([ pos[0] ]+list(pos[breaks+1]),list(pos[breaks]+1)+[ pos[-1]+1 ]):
+        for col in COLUMNS:
+          subms.putcol(col,numpy.asarray(self.arrays[ddid][col][i0:i1]),i0,i1-i0);
+      dirty[:] = False;
+      nrows += len(pos);
+    return nrows;
+
+  def close (self):
+    """Releases the memmaps, and removes the shadow files.""";
+    self.arrays = {};
+    if self._tmpdir:
+      shutil.rmtree(self.directory,ignore_errors=True);
+    else:
+      for ddid in self.rows:
+        for col in COLUMNS:
+          filename = os.path.join(self.directory,"%s_%d.dat"%(col,ddid));
+          if os.path.exists(filename):
+            os.remove(filename);
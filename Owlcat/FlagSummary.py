@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+
+"""This implements a compact summary of the flags in an MS, used by Owlcat.Flagger to answer flag
+statistics queries without scanning the FLAG/BITFLAG columns. The summary holds the number of rows
+and visibilities, and per-bit counts of flagged rows and visibilities, for every cell of DATA_DESC_ID,
+baseline and time chunk. It is stored in a file in the MS index cache directory (see Owlcat.MSIndex),
+rather than inside the MS, together with the modification time of the MS at the time it was written:
+if the MS has been modified since (by anything other than Flagger.xflag(), which keeps the summary up
+to date), the summary is stale.
+""";
+
+import numpy
+
+# base name of the summary file, in the MS index cache directory
+FILENAME = "FLAG_SUMMARY.npz";
+
+# format version of the summary file
+VERSION = 1;
+
+# number of per-bit counts kept per cell: 32 bitflags, plus the legacy FLAG/FLAG_ROW columns
+NBITS = 33;
+LEGACY_BIT = 32;
+
+# default size of time chunks, in seconds
+DEFAULT_TIMEBIN = 600.;
+
+class FlagSummary (object):
+  def __init__ (self,timebin=DEFAULT_TIMEBIN):
+    self.timebin = timebin;
+    # MS modification time that the summary corresponds to
+    self.mtime = None;
+    # per-cell keys
+    self.ddid  = numpy.zeros(0,int);
+    self.ant1  = numpy.zeros(0,int);
+    self.ant2  = numpy.zeros(0,int);
+    self.tchunk = numpy.zeros(0,numpy.int64);
+    # per-cell number of rows and visibilities
+    self.nrows = numpy.zeros(0,numpy.int64);
+    self.nvis  = numpy.zeros(0,numpy.int64);
+    # per-cell, per-bit counts of flagged visibilities, and of rows with the row flag raised
+    self.visbits = numpy.zeros((0,NBITS),numpy.int64);
+    self.rowbits = numpy.zeros((0,NBITS),numpy.int64);
+    # (ddid,ant1,ant2,tchunk) -> cell index
+    self._index = {};
+
+  def ncells (self):
+    return len(self.nrows);
+
+  def _cells (self,ddid,ant1,ant2,time,create):
+    """Helper method. Maps the rows of a chunk (all with the same DDID) to cells. Returns (icell,inverse)
+    tuple, where icell is an array of cell indices, and inverse maps each row to an element of icell.
+    If create is False, raises KeyError for rows not in any cell, else adds new cells as needed.""";
+    tchunk = numpy.floor(numpy.asarray(time)/self.timebin).astype(numpy.int64);
+    t0 = int(tchunk.min()) if len(tchunk) else 0;
+    # within a chunk, baseline and time chunk can be packed into a single key
+    keys = (numpy.asarray(ant1,numpy.int64)<<48)|(numpy.asarray(ant2,numpy.int64)<<32)|(tchunk-t0);
+    ukeys,inverse = numpy.unique(keys,return_inverse=True);
+    icell = numpy.zeros(len(ukeys),int);
+    new = [];
+    for i,key in enumerate(ukeys):
+      cell = ddid,int(key>>48),int((key>>32)&0xFFFF),int(key&0xFFFFFFFF)+t0;
+      index = self._index.get(cell);
+      if index is None:
+        if not create:
+          raise KeyError,"no flag summary cell for %s"%(cell,);
+        index = self._index[cell] = self.ncells() + len(new);
+        new.append(cell);
+      icell[i] = index;
+    if new:
+      dd,a1,a2,tc = zip(*new);
+      self.ddid   = numpy.concatenate((self.ddid,dd));
+      self.ant1   = numpy.concatenate((self.ant1,a1));
+      self.ant2   = numpy.concatenate((self.ant2,a2));
+      self.tchunk = numpy.concatenate((self.tchunk,numpy.array(tc,numpy.int64)));
+      self.nrows  = numpy.concatenate((self.nrows,numpy.zeros(len(new),numpy.int64)));
+      self.nvis   = numpy.concatenate((self.nvis,numpy.zeros(len(new),numpy.int64)));
+      self.visbits = numpy.concatenate((self.visbits,numpy.zeros((len(new),NBITS),numpy.int64)));
+      self.rowbits = numpy.concatenate((self.rowbits,numpy.zeros((len(new),NBITS),numpy.int64)));
+    return icell,inverse;
+
+  def add (self,ddid,ant1,ant2,time,nvis_per_row,bits,viscounts,rowflags):
+    """Adds a chunk of rows (all with the same DDID) to the summary. bits is a list of bit numbers
+    (0~31 for bitflags, LEGACY_BIT for legacy flags), viscounts is an (nrows,len(bits)) array of
+    per-row counts of visibilities with each bit raised, rowflags is an (nrows,len(bits)) array that
+    is True where the row flag has that bit raised.""";
+    icell,inverse = self._cells(ddid,ant1,ant2,time,True);
+    cells = icell[inverse];
+    numpy.add.at(self.nrows,cells,1);
+    numpy.add.at(self.nvis,cells,nvis_per_row);
+    self._add_bits(cells,bits,viscounts,rowflags);
+
+  def update (self,ddid,ant1,ant2,time,bits,dviscounts,drowflags):
+    """Updates the summary with changes to the flags of a chunk of rows (all with the same DDID).
+    dviscounts and drowflags are (nrows,len(bits)) arrays of the per-row changes in the counts (as
+    for add()). Raises KeyError if the rows are not in the summary.""";
+    icell,inverse = self._cells(ddid,ant1,ant2,time,False);
+    self._add_bits(icell[inverse],bits,dviscounts,drowflags);
+
+  def _add_bits (self,cells,bits,viscounts,rowflags):
+    for i,bit in enumerate(bits):
+      numpy.add.at(self.visbits[:,bit],cells,viscounts[:,i]);
+      numpy.add.at(self.rowbits[:,bit],cells,rowflags[:,i]);
+
+  def totals (self,cellmask=None):
+    """Returns (nrows,nvis,rowbits,visbits) tuple of totals over the cells selected by the boolean
+    cellmask (default is all cells). rowbits and visbits are arrays of NBITS per-bit counts.""";
+    if cellmask is None:
+      cellmask = slice(None);
+    return self.nrows[cellmask].sum(),self.nvis[cellmask].sum(), \
+           self.rowbits[cellmask].sum(0),self.visbits[cellmask].sum(0);
+
+  def save (self,filename):
+    """Saves summary to file (given by name, or as a file object).""";
+    numpy.savez(filename,version=VERSION,timebin=self.timebin,mtime=self.mtime,
+                ddid=self.ddid,ant1=self.ant1,ant2=self.ant2,tchunk=self.tchunk,
+                nrows=self.nrows,nvis=self.nvis,visbits=self.visbits,rowbits=self.rowbits);
+
+  @staticmethod
+  def load (filename):
+    """Loads summary from file. Returns None if the file is not in a known format.""";
+    data = numpy.load(filename);
+    if 'version' not in data.files or int(data['version']) != VERSION:
+      return None;
+    summary = FlagSummary(float(data['timebin']));
+    summary.mtime = float(data['mtime']);
+    for attr in 'ddid','ant1','ant2','tchunk','nrows','nvis','visbits','rowbits':
+      setattr(summary,attr,data[attr]);
+    summary._index = dict([ (cell,i) for i,cell in
+        enumerate(zip(summary.ddid.tolist(),summary.ant1.tolist(),summary.ant2.tolist(),summary.tchunk.tolist())) ]);
+    return summary;
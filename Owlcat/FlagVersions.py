@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+
+"""This implements named versions of the flags of an MS, used by Owlcat.Flagger. The flag columns
+are split into fixed blocks of rows within each DATA_DESC_ID (in row index order, see Owlcat.MSIndex).
+Each version stores, for the blocks that differ from the previous version only, the XOR of the old
+and new flags, zlib-compressed (boolean columns are bit-packed first). A "base" copy of the flags
+is kept as well, along with the version it corresponds to and the modification time of the MS at
+the time, so that snapshots and restores only need to read the MS if it has been modified since.
+Since file modification times have a limited resolution, an unchanged modification time is only
+trusted if it was recorded well after the MS was last written (see base_is_current()).
+Everything is stored in a directory inside the MS.
+""";
+
+import os
+import os.path
+import time
+import zlib
+import cPickle
+
+import numpy
+
+# name of the versions directory, inside the MS directory
+DIRNAME = "FLAG_VERSIONS";
+
+# format version of the index file
+VERSION = 1;
+
+# resolution of file modification times, in seconds (some filesystems only have 2-second resolution).
+# A write to the MS made within the same tick as the last recorded one leaves its modification time unchanged
+MTIME_RESOLUTION = 2.;
+
+# default number of rows per block
+DEFAULT_BLOCKSIZE = 10000;
+
+def pack (value):
+  """Converts a column chunk into a flat uint8 array. Boolean columns are bit-packed.""";
+  if value.dtype == bool:
+    return numpy.packbits(value.ravel());
+  return numpy.ascontiguousarray(value).ravel().view(numpy.uint8);
+
+def unpack (data,shape,dtype):
+  """Converts a flat uint8 array made by pack() back into a column chunk of the given shape and type.""";
+  dtype = numpy.dtype(dtype);
+  if dtype == bool:
+    return numpy.unpackbits(data)[:int(numpy.prod(shape))].astype(bool).reshape(shape);
+  return data.view(dtype).reshape(shape);
+
+def count_changes (data,dtype):
+  """Given a flat uint8 array made by pack() from the XOR of two column chunks, returns the number
+  of values that differ.""";
+  if numpy.dtype(dtype) == bool:
+    return int(numpy.unpackbits(data).sum());
+  return int((data.view(dtype)!=0).sum());
+
+def xor_deltas (*deltas):
+  """XORs together deltas, given as dicts of block -> dict of column -> packed uint8 arrays.
+  Blocks and columns with no remaining differences are left out of the result.""";
+  result = {};
+  for delta in deltas:
+    for block,cols in delta.iteritems():
+      rcols = result.setdefault(block,{});
+      for col,data in cols.iteritems():
+        rcols[col] = rcols[col]^data if col in rcols else data;
+  for block in result.keys():
+    cols = result[block];
+    for col in cols.keys():
+      if not cols[col].any():
+        del cols[col];
+    if not cols:
+      del result[block];
+  return result;
+
+def _compress (delta):
+  return dict([ (block,dict([ (col,zlib.compress(data.tostring(),1)) for col,data in cols.iteritems() ]))
+                for block,cols in delta.iteritems() ]);
+
+def _decompress (delta):
+  return dict([ (block,dict([ (col,numpy.frombuffer(zlib.decompress(z),numpy.uint8)) for col,z in cols.iteritems() ]))
+                for block,cols in delta.iteritems() ]);
+
+class FlagVersions (object):
+  def __init__ (self,msname):
+    """Opens the flag versions stored in the given MS. If there are none, the store is empty
+    until init() is called.""";
+    self.directory = os.path.join(msname,DIRNAME);
+    self._indexfile = os.path.join(self.directory,"index.pickle");
+    if os.path.exists(self._indexfile):
+      index = cPickle.load(file(self._indexfile,"rb"));
+      if index.get('version') != VERSION:
+        raise ValueError,"flag versions in %s are in an unknown format"%self.directory;
+      self.__dict__.update(index['attrs']);
+    else:
+      self.nrows = self.columns = None;
+      self.versions = [];
+      self.base_version = self.base_mtime = None;
+    # stores made before base_mtime_taken was added do not have it, and are never taken as current
+    self.__dict__.setdefault('base_mtime_taken',None);
+
+  def init (self,nrows,columns,blocksize=DEFAULT_BLOCKSIZE):
+    """Checks that the store matches an MS of nrows rows, with the given dict of column -> dtype,
+    initializing it if it is empty. Raises ValueError on mismatch.""";
+    if self.nrows is None:
+      self.nrows,self.columns,self.blocksize = nrows,dict(columns),blocksize;
+    elif self.nrows != nrows or sorted(self.columns.keys()) != sorted(columns.keys()):
+      raise ValueError,"flag versions in %s do not match the MS (it has been modified or had columns added)"%self.directory;
+
+  def names (self):
+    return [ v['name'] for v in self.versions ];
+
+  def find (self,name):
+    """Returns number of named version. Raises KeyError if not found.""";
+    names = self.names();
+    if name not in names:
+      raise KeyError,"no flag version named '%s'"%name;
+    return names.index(name);
+
+  def _save_index (self):
+    if not os.path.isdir(self.directory):
+      os.mkdir(self.directory);
+    attrs = dict([ (attr,getattr(self,attr)) for attr in
+                   ('nrows','columns','blocksize','versions','base_version','base_mtime','base_mtime_taken') ]);
+    tmpname = self._indexfile+".tmp";
+    cPickle.dump(dict(version=VERSION,attrs=attrs),file(tmpname,"wb"),2);
+    os.rename(tmpname,self._indexfile);
+
+  def _basefile (self,block):
+    return os.path.join(self.directory,"base","%d_%d.pickle"%block);
+
+  def get_base (self,block):
+    """Returns dict of column -> packed uint8 array of the base flags of a block, or None if the
+    block has no base yet (i.e. before the first snapshot).""";
+    filename = self._basefile(block);
+    if not os.path.exists(filename):
+      return None;
+    return _decompress({ block:cPickle.load(file(filename,"rb")) })[block];
+
+  def put_base (self,block,cols):
+    """Stores the base flags of a block, given as a dict of column -> packed uint8 array.""";
+    dirname = os.path.dirname(self._basefile(block));
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname);
+    cPickle.dump(_compress({ block:cols })[block],file(self._basefile(block),"wb"),2);
+
+  def delta (self,iversion):
+    """Returns the delta of version #iversion against the previous version.""";
+    return _decompress(cPickle.load(file(os.path.join(self.directory,self.versions[iversion]['file']),"rb")));
+
+  def delta_between (self,iv0,iv1):
+    """Returns the delta between two versions, i.e. the XOR of all the deltas in between.
+    Either version may be None, which stands for the empty flags before the first version.""";
+    iv0 = -1 if iv0 is None else iv0;
+    iv1 = -1 if iv1 is None else iv1;
+    iv0,iv1 = min(iv0,iv1),max(iv0,iv1);
+    return xor_deltas(*[ self.delta(i) for i in range(iv0+1,iv1+1) ]);
+
+  def latest (self):
+    """Returns number of latest version, or None if there are no versions.""";
+    return len(self.versions)-1 if self.versions else None;
+
+  def add_version (self,name,comment,delta,mtime,mtime_taken=None):
+    """Adds a new version at the end of the list, given its delta against the latest version.
+    The base is assumed to have been brought up to date with the new version, which is what the
+    MS contains as of modification time mtime (see set_base_state()).""";
+    if not os.path.isdir(self.directory):
+      os.mkdir(self.directory);
+    filename = "v%d.pickle"%len(self.versions);
+    cPickle.dump(_compress(delta),file(os.path.join(self.directory,filename),"wb"),2);
+    self.versions.append(dict(name=name,comment=comment,time=time.time(),file=filename,nblocks=len(delta)));
+    self.set_base_state(len(self.versions)-1,mtime,mtime_taken);
+
+  def set_base_state (self,iversion,mtime,mtime_taken=None):
+    """Records which version the base flags correspond to, and the MS modification time
+    at which the MS matched the base. mtime_taken is the wall time at which mtime was looked up,
+    the default being now.""";
+    self.base_version,self.base_mtime = iversion,mtime;
+    self.base_mtime_taken = time.time() if mtime_taken is None else mtime_taken;
+    self._save_index();
+
+  def base_is_current (self,mtime):
+    """Returns True if the MS, whose modification time is now mtime, is certain not to have been
+    modified since the base state was recorded. This needs an unchanged modification time, recorded
+    at least MTIME_RESOLUTION after the MS was last written, since a later write within the same tick
+    would leave the modification time unchanged.""";
+    return self.base_mtime is not None and self.base_mtime_taken is not None and \
+           mtime == self.base_mtime and self.base_mtime_taken - self.base_mtime >= MTIME_RESOLUTION;
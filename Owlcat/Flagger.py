@@ -4,6 +4,10 @@ import Timba.dmi
 import re
 import tempfile
 import os
+import sys
+import threading
+import time
+import Queue
 
 import Meow
 import Meow.MSUtils
@@ -16,6 +20,21 @@ except:
 
 from Meow.MSUtils import TABLE
 
+# TaQL commands are used to fill whole columns inside casacore, if available
+try:
+  from pyrap.tables import taql as TAQL
+except:
+  TAQL = None;
+
+from Owlcat import Autoflag
+from Owlcat import FlagSummary
+from Owlcat import FlagOccupancy
+from Owlcat import FlagRegions
+from Owlcat import FlagProfile
+from Owlcat import FlagShadow
+from Owlcat import FlagVersions
+from Owlcat import MSIndex
+
 _gli = Meow.MSUtils.find_exec('glish');
 if _gli:
   _GLISH = 'glish';
@@ -110,8 +129,399 @@ def _format_clip (arg,argname):
     return "[%s]"%','.join(recfields);
   raise TypeError,"invalid value for '%s' keyword (%s)"%(argname,arg);
 
+def _make_slice_list (selection,parm):
+  """Helper function to parse the channels/corrs/timeslots arguments of xflag() and friends.
+  Returns a list of slice objects.""";
+  if not selection:
+    return [ numpy.s_[:] ];
+  if isinstance(selection,(int,slice)):
+    return _make_slice_list([selection],parm);
+  if not isinstance(selection,(list,tuple)):
+    raise TypeError,"invalid %s selection: %s"%(parm,selection);
+  sellist = [];
+  for sel in selection:
+    if isinstance(sel,int):
+      sellist.append(slice(sel,sel+1));
+    elif isinstance(sel,slice):
+      sellist.append(sel);
+    else:
+      raise TypeError,"invalid %s selection: %s"%(parm,selection);
+  return sellist;
+
+# marker objects used by _ChunkPipeline to signal end-of-chunks and errors through its queues
+_END_OF_CHUNKS = object();
+_READ_ERROR = object();
+
+class _ChunkPipeline (object):
+  """Helper class for chunked passes through the MS. A reader thread prefetches the columns of
+  upcoming chunks, while a writer thread flushes the putcols of previous chunks, so that table I/O
+  overlaps with the numpy work done on the current chunk. Both queues are bounded by 'depth' chunks.
+  With depth=0, everything is done synchronously in the calling thread.
+
+  'chunks' is a list of (ddid,irow_prev,ms,row0,nrows) tuples, as returned by Flagger._get_chunks().
+  The tuples may carry additional items, which are passed through as is.
+  'columns' is a list of column names to read for each chunk, or a callable(ms,row0,nrows) returning
+  a dict of columns. Iterating over the pipeline yields (chunk,cols) pairs, where cols is a dict of
+  column arrays. Use put() to queue up writes, and call flush() at the end of the loop, and close()
+  in a finally clause.
+  """;
+  def __init__ (self,flagger,chunks,columns,depth=1):
+    self.flagger = flagger;
+    self.chunks = chunks;
+    self.columns = columns;
+    self.depth = depth;
+    # table objects are not thread-safe, so all table I/O is serialized through this lock
+    self._iolock = threading.Lock();
+    self._stop = False;
+    self._write_error = None;
+    self._reader = self._writer = None;
+    if depth > 0:
+      self._readq = Queue.Queue(depth);
+      self._writeq = Queue.Queue(depth);
+      self._reader = threading.Thread(target=self._read_loop,name="Flagger reader");
+      self._writer = threading.Thread(target=self._write_loop,name="Flagger writer");
+      for thread in self._reader,self._writer:
+        thread.daemon = True;
+        thread.start();
+
+  def _read (self,chunk):
+    ms,row0,nrows = chunk[2:5];
+    if callable(self.columns):
+      return self.columns(ms,row0,nrows);
+    return self.flagger._getcols(ms,row0,nrows,self.columns);
+
+  def _read_loop (self):
+    try:
+      for chunk in self.chunks:
+        if self._stop:
+          break;
+        self._iolock.acquire();
+        try:
+          cols = self._read(chunk);
+        finally:
+          self._iolock.release();
+        self._readq.put((chunk,cols));
+      self._readq.put(_END_OF_CHUNKS);
+    except:
+      self._readq.put((_READ_ERROR,sys.exc_info()));
+
+  def _write_loop (self):
+    while True:
+      item = self._writeq.get();
+      if item is None:
+        return;
+      # after an error, keep draining the queue so that put() does not block
+      if self._write_error is None:
+        self._iolock.acquire();
+        try:
+          try:
+            self.flagger._putcols(*item);
+          except:
+            self._write_error = sys.exc_info();
+        finally:
+          self._iolock.release();
+
+  def _check_write_error (self):
+    if self._write_error is not None:
+      exc_type,exc_value,exc_tb = self._write_error;
+      self._write_error = None;
+      raise exc_type,exc_value,exc_tb;
+
+  def __iter__ (self):
+    if not self.depth:
+      for chunk in self.chunks:
+        yield chunk,self._read(chunk);
+      return;
+    while True:
+      item = self._readq.get();
+      if item is _END_OF_CHUNKS:
+        return;
+      if item[0] is _READ_ERROR:
+        exc_type,exc_value,exc_tb = item[1];
+        raise exc_type,exc_value,exc_tb;
+      yield item;
+
+  def getcols (self,ms,row0,nrows,columns):
+    """Reads the named columns at the specified rows, outside the chunks being read ahead. The read
+    is serialized with those of the reader thread and the writes of the writer thread.""";
+    self._iolock.acquire();
+    try:
+      return self.flagger._getcols(ms,row0,nrows,columns);
+    finally:
+      self._iolock.release();
+
+  def put (self,ms,row0,nrows,putcols):
+    """Queues up a list of (column,value) pairs to be written to the specified rows.""";
+    if not putcols:
+      return;
+    if not self.depth:
+      self.flagger._putcols(ms,row0,nrows,putcols);
+      return;
+    self._check_write_error();
+    self._writeq.put((ms,row0,nrows,putcols));
+
+  def flush (self):
+    """Waits for all queued writes to complete, and re-raises any error that occurred while writing.""";
+    if self._writer is not None:
+      self._writeq.put(None);
+      self._writer.join();
+      self._writer = None;
+    self._check_write_error();
+
+  def close (self):
+    """Stops the reader thread and waits for queued writes to complete. Unlike flush(), write errors are not raised,
+    so this is safe to call from a finally clause.""";
+    if self._reader is not None:
+      self._stop = True;
+      # drain the read queue, so that the reader is not left blocking on a put()
+      while self._reader.is_alive():
+        try:
+          self._readq.get(timeout=.1);
+        except Queue.Empty:
+          pass;
+      self._reader = None;
+    if self._writer is not None:
+      self._writeq.put(None);
+      self._writer.join();
+      self._writer = None;
+
+class _BufferRing (object):
+  """Helper class: a ring of output buffers that are reused across chunks. Call next() before every chunk,
+  then get() buffers for the chunk. A buffer is only reused after size-1 more chunks, so size must exceed
+  the number of writes that a _ChunkPipeline can have pending (its depth, plus one being written).
+  """;
+  def __init__ (self,size):
+    self._slots = [ {} for i in range(size) ];
+    self._islot = 0;
+
+  def next (self):
+    self._islot = (self._islot+1)%len(self._slots);
+
+  def get (self,name,shape,dtype):
+    """Returns named buffer of the given shape and type, reallocating it if it is too small.""";
+    slot = self._slots[self._islot];
+    buf = slot.get(name);
+    if buf is None or buf.dtype != dtype or buf.shape[1:] != shape[1:] or buf.shape[0] < shape[0]:
+      buf = slot[name] = numpy.empty(shape,dtype);
+    return buf[:shape[0]];
+
+def _baseline_lookup (baselines):
+  """Helper function. Converts a list of (p,q) baselines into a boolean antenna-pair lookup
+  matrix, for use with _baseline_rowmask(). The matrix has an extra all-False row and column,
+  which antenna indices beyond those in the baseline list are mapped to.""";
+  nant = max([ max(p,q) for p,q in baselines ])+1;
+  lookup = numpy.zeros((nant+1,nant+1),bool);
+  lookup[[ p for p,q in baselines ],[ q for p,q in baselines ]] = True;
+  return lookup;
+
+def _baseline_rowmask (lookup,a1,a2):
+  """Helper function. Returns mask of rows whose ANTENNA1/ANTENNA2 pair is selected in the
+  lookup matrix made by _baseline_lookup(). Cost is O(nrows), regardless of the number of baselines.""";
+  nant = lookup.shape[0]-1;
+  return lookup[numpy.minimum(a1,nant),numpy.minimum(a2,nant)];
+
+def _reduce_rowflags (flags):
+  """Helper function. Reduces an (nrows,nchan,ncorr) array of flags to per-row flags, with each
+  bit (or boolean) raised only if it is raised for all visibilities of the row. Done in a single
+  pass over the array.""";
+  # in principle this is a bitwise_and.reduce over the last two axes, but bitwise_and.reduce is broken
+  # (see https://github.com/numpy/numpy/issues/5250), so we use ~OR(~flags) instead
+  # (the explicit row size keeps this working for chunks with no selected rows)
+  flags = flags.reshape((flags.shape[0],int(numpy.prod(flags.shape[1:]))));
+  return ~numpy.bitwise_or.reduce(~flags,1);
+
+def _signed_square (x):
+  """Helper function: squares a threshold, keeping its sign, so that |V|>x and |V|<x can be
+  evaluated as |V|^2>x*|x| and |V|^2<x*|x| even for negative x.""";
+  return x*abs(x);
+
+def _clip_data (datacol,selmask,datamask=None,nan=False,above=None,below=None,fm_above=None,fm_below=None):
+  """Helper function implementing data clipping for xflag() and _flag(). selmask is a boolean
+  array of the same shape as datacol, which is ANDed in place with the clipping criteria:
+  * nan: data is NaN or infinite
+  * above, below: |data|>above, |data|<below
+  * fm_above, fm_below: mean |data| over frequency (axis 1) is >fm_above, <fm_below. Visibilities
+    where datamask is True are left out of the mean. If no visibilities remain, the criterion fails.
+  The amplitude criteria are evaluated as |data|^2 against squared thresholds. To avoid temporaries,
+  datacol is overwritten in the process. Returns selmask.
+  """;
+  if nan:
+    selmask &= ~numpy.isfinite(datacol);
+  fm = datacol.ndim > 1 and (fm_above is not None or fm_below is not None);
+  if above is None and below is None and not fm:
+    return selmask;
+  # compute |data|^2 in place
+  if numpy.iscomplexobj(datacol):
+    amp = datacol.real;
+    im = datacol.imag;
+    amp *= amp;
+    im *= im;
+    amp += im;
+  else:
+    amp = datacol;
+    amp *= amp;
+  # scratch array for comparison results
+  sel = numpy.empty(amp.shape,bool);
+  if above is not None:
+    selmask &= numpy.greater(amp,_signed_square(above),sel);
+  if below is not None:
+    selmask &= numpy.less(amp,_signed_square(below),sel);
+  if fm:
+    # masked mean of |data| over frequency, as sums and counts of unmasked visibilities
+    amp = numpy.sqrt(amp,amp);
+    if datamask is not None:
+      amp[datamask] = 0;
+      counts = (~datamask).sum(1);
+    else:
+      counts = numpy.empty(amp.shape[:1]+amp.shape[2:],int);
+      counts.fill(amp.shape[1]);
+    mean = amp.sum(1)/numpy.maximum(counts,1);
+    valid = counts>0;
+    if fm_above is not None:
+      selmask &= numpy.expand_dims(valid&(mean>fm_above),1);
+    if fm_below is not None:
+      selmask &= numpy.expand_dims(valid&(mean<fm_below),1);
+  return selmask;
+
+def _changed_row_spans (value,oldvalue):
+  """Helper function. Compares the new and old values of a column chunk, and returns a list of
+  (i0,i1) spans of consecutive rows where they differ.""";
+  diff = value != oldvalue;
+  if diff.ndim > 1:
+    diff = diff.reshape((diff.shape[0],-1)).any(1);
+  rows = numpy.flatnonzero(diff);
+  if not len(rows):
+    return [];
+  # a span ends wherever the next changed row is not adjacent
+  breaks = numpy.flatnonzero(numpy.diff(rows)>1);
+  starts = [ rows[0] ] + list(rows[breaks+1]);
+  ends = list(rows[breaks]+1) + [ rows[-1]+1 ];
+  return zip(starts,ends);
+
+def _sorted_rowmask (selected,rownums):
+  """Helper function. Returns mask of the row numbers in rownums that are present in the sorted
+  array of row numbers 'selected'.""";
+  if not len(selected):
+    return numpy.zeros(len(rownums),bool);
+  index = numpy.minimum(numpy.searchsorted(selected,rownums),len(selected)-1);
+  return selected[index] == rownums;
+
+class _XflagOp (object):
+  """Helper class for Flagger._run_xflag_ops(). Holds the parsed arguments of an xflag() operation
+  (see xflag() for their meaning; all flagmasks must already be converted to ints), the rows it
+  applies to, and the stats it accumulates. ddids is the list of DDIDs the operation applies to,
+  and rows is a sorted array of the selected row numbers in the full MS, or None if the MS being
+  processed is already reduced to the selected rows.
+  """;
+  def __init__ (self,flag=0,unflag=0,fill_legacy=None,baselines=None,channels=None,corrs=None,
+                flagmask=None,flagmask_all=None,flagmask_none=None,
+                data_nan=False,data_above=None,data_below=None,data_fm_above=None,data_fm_below=None,
+                data_column='CORRECTED_DATA',data_flagmask=-1,flag_allcorr=True):
+    self.flag,self.unflag,self.fill_legacy = flag,unflag,fill_legacy;
+    self.baselines = baselines and [ (int(p),int(q)) for p,q in baselines ];
+    self.baseline_lookup = self.baselines and _baseline_lookup(self.baselines);
+    self.channels  = _make_slice_list(channels,'channels');
+    self.corrs     = _make_slice_list(corrs,'corrs');
+    self.flagmask,self.flagmask_all,self.flagmask_none = flagmask,flagmask_all,flagmask_none;
+    self.data_nan,self.data_above,self.data_below = data_nan,data_above,data_below;
+    self.data_fm_above,self.data_fm_below = data_fm_above,data_fm_below;
+    self.data_column,self.data_flagmask = data_column,data_flagmask;
+    self.flag_allcorr = flag_allcorr;
+    self.flagsubsets = flagmask is not None or flagmask_all is not None or flagmask_none is not None;
+    self.dataclip = data_above is not None or data_below is not None or data_nan or \
+                    data_fm_above is not None or data_fm_below is not None;
+    # if only whole rows are selected, we can work on the row flags, and only need to touch the
+    # FLAG/BITFLAG cubes when writing them out
+    self.rowonly = not self.flagsubsets and not self.dataclip and \
+                   self.channels == [ numpy.s_[:] ] and self.corrs == [ numpy.s_[:] ];
+    self.doflag = bool(flag or unflag or fill_legacy is not None);
+    self.ddids = self.rows = None;
+    # clipping overwrites the data column (see _clip_data()), so if other operations need it, it is copied first
+    self.copy_data = False;
+    # stats: rows and visibilities in the row subset, visibilities selected in subsets A, B and C
+    self.sel_nrow = self.sel_nvis = self.nvis_A = self.nvis_B = self.nvis_C = 0;
+
+  def readcols (self,has_bitflags):
+    """Returns the set of columns that the operation needs to read.""";
+    write_bitflags = has_bitflags and (self.flag|self.unflag)&Flagger.BITMASK_ALL;
+    write_legacy = self.fill_legacy is not None or (self.flag|self.unflag)&Flagger.LEGACY;
+    cols = set();
+    if self.rowonly:
+      if write_legacy:
+        cols.add('FLAG');
+      if write_bitflags or (has_bitflags and self.fill_legacy is not None):
+        cols.add('BITFLAG');
+    else:
+      cols.add('FLAG');
+      if has_bitflags and (self.doflag or self.flagsubsets or (self.dataclip and self.data_flagmask is not None)):
+        cols.add('BITFLAG');
+    if self.baselines:
+      cols.update(['ANTENNA1','ANTENNA2']);
+    if self.doflag:
+      cols.add('FLAG_ROW');
+      if has_bitflags:
+        cols.add('BITFLAG_ROW');
+    if self.dataclip:
+      cols.add(self.data_column);
+    return cols;
+
+# keys of flag program entries that may be given as strings of slice specifications
+_PROGRAM_SLICE_KEYS = ('channels','corrs');
+
+def load_flag_program (filename):
+  """Loads a flag program (see Flagger.xflag_program()) from a file. A .yaml or .yml file (which
+  needs the yaml module) must contain a list of mappings of xflag() arguments. Any other file is
+  executed as Python, and must define a variable named 'program' with a list of dicts of xflag()
+  arguments. In both cases, 'channels' and 'corrs' may also be given as strings of comma-separated
+  slice specifications such as "0~10,20:30" (see Owlcat.Parsing.parse_slice()).
+  Returns list of dicts.""";
+  if os.path.splitext(filename)[1].lower() in (".yaml",".yml"):
+    try:
+      import yaml
+    except ImportError:
+      raise RuntimeError,"the yaml module is needed to read flag program %s"%filename;
+    program = yaml.safe_load(file(filename));
+  else:
+    namespace = dict(numpy=numpy);
+    execfile(filename,namespace);
+    if 'program' not in namespace:
+      raise ValueError,"flag program %s does not define a 'program' variable"%filename;
+    program = namespace['program'];
+  if not isinstance(program,(list,tuple)) or [ op for op in program if not isinstance(op,dict) ]:
+    raise TypeError,"flag program %s is not a list of dicts"%filename;
+  program = [ dict(op) for op in program ];
+  from Owlcat import Parsing
+  for op in program:
+    for key in _PROGRAM_SLICE_KEYS:
+      if isinstance(op.get(key),str):
+        op[key] = map(Parsing.parse_slice,op[key].split(","));
+  return program;
+
+def _xflag_job (args):
+  """Helper function for parallel xflag(). Runs one job (a DDID, or a row range within a DDID)
+  in a worker process, using its own Flagger object and table handle.""";
+  msname,verbose,chunksize,memory_budget,readahead,ddid,rows,kw = args;
+  flagger = Flagger(msname,verbose=verbose,chunksize=chunksize,memory_budget=memory_budget,readahead=readahead,
+                    lockoptions='usernoread');
+  try:
+    return flagger._xflag(ddid=[ddid],rows=rows,update_summary=False,**kw);
+  finally:
+    flagger.close();
+
+def _uvbin_job (args):
+  """Helper function for parallel uvbin_flag(). Runs both passes for one DDID in a worker process,
+  using its own Flagger object and table handle.""";
+  msname,verbose,chunksize,memory_budget,readahead,ddid,kw = args;
+  flagger = Flagger(msname,verbose=verbose,chunksize=chunksize,memory_budget=memory_budget,readahead=readahead,
+                    lockoptions='usernoread');
+  try:
+    return flagger._uvbin_flag(ddid=[ddid],**kw);
+  finally:
+    flagger.close();
+
 class Flagger (Timba.dmi.verbosity):
-  def __init__ (self,msname,verbose=0,timestamps=False,chunksize=200000):
+  def __init__ (self,msname,verbose=0,timestamps=False,chunksize=200000,memory_budget=None,workers=1,readahead=1,
+                lockoptions='default',shadow=False,profile=False):
     Timba.dmi.verbosity.__init__(self,name="Flagger");
     self.set_verbose(verbose);
     if timestamps:
@@ -122,9 +532,33 @@ class Flagger (Timba.dmi.verbosity):
     self.ms = None;
     self.readwrite = False;
     self.chunksize = chunksize;
+    # if set, chunk sizes are computed per DDID to fit this many MB, and chunksize is ignored
+    self.memory_budget = memory_budget;
+    # number of worker processes used by xflag()
+    self.workers = workers;
+    # number of chunks read ahead (and written behind) by background I/O threads. 0 disables the threads
+    self.readahead = readahead;
+    # table locking options. Parallel xflag() workers use 'usernoread', and lock the MS explicitly when writing
+    self.lockoptions = lockoptions;
+    # timeslot and row indices, built on first use by _timeslot_index() and _row_index()
+    self._tsindex = self._rowindex = None;
+    # shadow store of the bitflag columns (see shadow_flags()), and cache of subset row numbers used with it
+    self._shadow = None;
+    self._shadow_rownums = {};
+    # per-stage timings (see Owlcat.FlagProfile), if profile=True. Use profile.summary() to print them
+    self.profile = FlagProfile.Profile() if profile else FlagProfile.NULL_PROFILE;
     self._reopen();
+    # shadow=True, or a directory name, sets up the shadow store right away
+    if shadow:
+      self.shadow_flags(shadow if isinstance(shadow,str) else None);
 
   def close (self):
+    # write back and release the shadow store, if any
+    if self._shadow is not None:
+      self.sync();
+      self._shadow.close();
+      self._shadow = None;
+      self._shadow_rownums = {};
     if self.ms:
       self.dprint(2,"closing MS",self.msname);
       self.ms.close();
@@ -132,7 +566,7 @@ class Flagger (Timba.dmi.verbosity):
 
   def _reopen (self,readwrite=False):
     if self.ms is None:
-      self.ms = ms = TABLE(self.msname,readonly=not readwrite);
+      self.ms = ms = TABLE(self.msname,readonly=not readwrite,lockoptions=self.lockoptions);
       self.readwrite = readwrite;
       self.dprintf(1,"opened MS %s, %d rows\n",ms.name(),ms.nrows());
       self.has_bitflags = 'BITFLAG' in ms.colnames();
@@ -140,10 +574,48 @@ class Flagger (Timba.dmi.verbosity):
       self.dprintf(1,"flagsets are %s\n",self.flagsets.names());
       self.purrpipe = Purr.Pipe.Pipe(self.msname) if has_purr else None;
     elif self.readwrite != readwrite:
-      self.ms = TABLE(self.msname,readonly=not readwrite);
+      self.ms = TABLE(self.msname,readonly=not readwrite,lockoptions=self.lockoptions);
       self.readwrite = readwrite;
     return self.ms;
 
+  def shadow_flags (self,directory=None):
+    """Mirrors the BITFLAG and BITFLAG_ROW columns into a shadow store of memory-mapped files (see
+    Owlcat.FlagShadow), in the given local directory (default is a temporary directory). This costs one
+    read of the columns. From then on, all operations read and write bitflags via the shadow, at memory
+    speed, and sync() writes the changes back to the MS. close() syncs and removes the shadow.
+    Parallel workers are not used while the shadow is in place. Returns the FlagShadow object.""";
+    if self._shadow is None:
+      ms = self._reopen(self.readwrite);
+      if not self.has_bitflags:
+        raise TypeError,"MS does not contain a BITFLAG column, cannot shadow bitflags";
+      self.dprintf(1,"creating shadow store of bitflag columns\n");
+      self._shadow = FlagShadow.FlagShadow(ms,self._row_index(),self._parse_ddids(ms),directory,self.chunksize);
+      self.dprintf(1,"shadow store is in %s\n",self._shadow.directory);
+    return self._shadow;
+
+  def sync (self):
+    """Writes the bitflags changed in the shadow store (see shadow_flags()) back to the MS.
+    Returns the number of rows written.""";
+    if self._shadow is None or not self._shadow.ndirty():
+      return 0;
+    ms = self._reopen(True);
+    nrows = self._shadow.sync(ms);
+    self.dprintf(1,"wrote %d changed rows of bitflags from the shadow store to the MS\n",nrows);
+    return nrows;
+
+  def _shadow_rows (self,ms,row0,nrows):
+    """Helper method. Returns the row numbers in the full MS of rows row0:row0+nrows of ms, which
+    is the full MS or a subset of it.""";
+    if ms is self.ms:
+      return numpy.arange(row0,row0+nrows);
+    # the cache holds on to the subset, so that its id cannot be reused while it is in the cache
+    cached = self._shadow_rownums.get(id(ms));
+    if cached is None or cached[0] is not ms:
+      if len(self._shadow_rownums) > 16:
+        self._shadow_rownums = {};
+      cached = self._shadow_rownums[id(ms)] = ms,ms.rownumbers(self.ms);
+    return cached[1][row0:row0+nrows];
+
   def add_bitflags (self,wait=True,purr=True):
     if not self.has_bitflags:
       global _addbitflagcol;
@@ -220,10 +692,41 @@ class Flagger (Timba.dmi.verbosity):
     self.dprint(1,"stats: ",msg);
     return stats;
 
+  def _putcols (self,ms,row0,nrows,putcols):
+    """Helper method. Writes a list of (column,value) pairs to the specified rows. If the MS
+    was opened with user locking (as is the case with parallel xflag() workers), the writes are
+    done under a write lock, which is released afterwards so that other processes can proceed.
+    Entries may also be (column,value,offset) triplets, which write value to the rows starting
+    at row0+offset.""";
+    if not putcols:
+      return;
+    if self.lockoptions in ('user','usernoread'):
+      ms.lock(True);
+    try:
+      for item in putcols:
+        if len(item) == 3:
+          colname,value,offset = item;
+          start,count = row0+offset,value.shape[0];
+        else:
+          colname,value = item;
+          start,count = row0,nrows;
+        with self.profile.stage('putcol',colname,count) as st:
+          # bitflags go to the shadow store, if there is one
+          if self._shadow is not None and colname in FlagShadow.COLUMNS:
+            self._shadow.putcol(colname,value,self._shadow_rows(ms,start,count));
+          else:
+            ms.putcol(colname,value,start,count);
+          st.wrote(value.nbytes);
+    finally:
+      if self.lockoptions in ('user','usernoread'):
+        ms.unlock();
+
   def _get_bitflag_col (self,ms,row0,nrows,shape=None):
     """helper method. Gets the bitflag column at the specified location. On error (presumably,
     column is missing), returns zero array of specified shape. If shape is not specified,
     queries the DATA column to obtain it.""";
+    if self._shadow is not None:
+      return self._shadow.getcol('BITFLAG',self._shadow_rows(ms,row0,nrows));
     try:
       return ms.getcol('BITFLAG',row0,nrows);
     except:
@@ -231,6 +734,95 @@ class Flagger (Timba.dmi.verbosity):
         shape = ms.getcol('DATA',row0,nrows).shape;
       return numpy.zeros(shape,dtype=numpy.int32);
 
+  def _put_changed (self,pipeline,ms,row0,nrows,putcols):
+    """Helper method. putcols is a list of (column,value,oldvalue) triplets for the chunk at row0.
+    Queues up writes (via the pipeline) of only those spans of rows where value differs from oldvalue.
+    Returns the number of column rows written.""";
+    written = [];
+    nrows_written = 0;
+    for colname,value,oldvalue in putcols:
+      for i0,i1 in _changed_row_spans(value,oldvalue):
+        written.append((colname,value[i0:i1],i0));
+        nrows_written += i1-i0;
+    if written:
+      self.dprintf(4,"writing %d changed row spans\n",len(written));
+      pipeline.put(ms,row0,nrows,written);
+    else:
+      self.dprint(4,"no flags changed, skipping write");
+    return nrows_written;
+
+  def _getcols (self,ms,row0,nrows,colnames):
+    """Helper method. Reads the named columns at the specified location, and returns a dict of
+    column arrays. BITFLAG is read via _get_bitflag_col(), so a missing BITFLAG column reads as zeros.
+    Bitflags are read from the shadow store, if there is one.""";
+    cols = {};
+    for colname in colnames:
+      with self.profile.stage('getcol',colname,nrows) as st:
+        if colname == 'BITFLAG':
+          cols[colname] = self._get_bitflag_col(ms,row0,nrows,cols['FLAG'].shape if 'FLAG' in cols else None);
+        elif colname == 'BITFLAG_ROW' and self._shadow is not None:
+          cols[colname] = self._shadow.getcol(colname,self._shadow_rows(ms,row0,nrows));
+        else:
+          cols[colname] = ms.getcol(colname,row0,nrows);
+        st.read(cols[colname].nbytes);
+    return cols;
+
+  def _get_datashape (self,ms):
+    """Helper method. Returns the (nchan,ncorr) shape of the FLAG column in a per-DDID subset
+    of the MS. Uses column metadata, so no data is read.""";
+    # casacore shape strings are in Fortran order, e.g. "[ncorr, nchan]"
+    shape = ms.getcolshapestring('FLAG',0,1)[0];
+    return tuple(reversed(map(int,shape.strip('[]').split(','))));
+
+  # sizes of casacore column value types, in bytes
+  _VALUETYPE_SIZES = dict(boolean=1,uchar=1,short=2,ushort=2,int=4,uint=4,float=4,double=8,
+                          complex=8,dcomplex=16);
+  # working arrays per visibility of the current chunk (int64 visflags, boolean masks and temporaries), in bytes
+  _WORKSPACE_BYTES_PER_VIS = 24;
+
+  def _get_chunksize (self,ms,ddid,columns):
+    """Helper method. Returns the number of rows per chunk for a per-DDID subset of the MS. If a
+    memory budget is set, this is derived from the per-row footprint of the given columns (plus
+    working arrays), otherwise self.chunksize is returned.
+    """;
+    if not self.memory_budget:
+      return self.chunksize;
+    nchan,ncorr = self._get_datashape(ms);
+    colnames = set(ms.colnames());
+    colbytes = 0;
+    for colname in columns:
+      if colname in colnames:
+        desc = ms.getcoldesc(colname);
+        size = self._VALUETYPE_SIZES.get(desc.get('valueType'),8);
+        colbytes += size*nchan*ncorr if desc.get('ndim',0) else size;
+    # column arrays are held by the read queue, the current chunk and the write queue,
+    # while working arrays are only needed for the current chunk
+    rowbytes = colbytes*(2*self.readahead+2) + self._WORKSPACE_BYTES_PER_VIS*nchan*ncorr;
+    chunksize = max(int(self.memory_budget*1024*1024)//rowbytes,1);
+    self.dprintf(1,"ddid %d: %d chans x %d corrs, %d bytes per row, using chunks of %d rows for %gMB memory budget\n",
+                 ddid,nchan,ncorr,rowbytes,chunksize,self.memory_budget);
+    return chunksize;
+
+  def _get_chunks (self,sub_mss,rows=None,columns=()):
+    """Helper method. Splits the per-DDID subsets returned by _get_submss() into chunks. Returns
+    list of (ddid,irow_prev,subms,row0,nrows) tuples. If rows is not None, it gives a (row0,row1)
+    range to be processed within each subset. columns is the list of columns the operation
+    touches, used to size the chunks if a memory budget is set (see _get_chunksize()).
+    """;
+    chunks = [];
+    for ddid,irow_prev,subms in sub_mss:
+      row_start,row_end = rows or (0,subms.nrows());
+      if row_end <= row_start:
+        continue;
+      chunksize = self._get_chunksize(subms,ddid,columns);
+      for row0 in range(row_start,row_end,chunksize):
+        chunks.append((ddid,irow_prev,subms,row0,min(chunksize,row_end-row0)));
+    return chunks;
+
+  def _pipeline (self,chunks,columns):
+    """Helper method. Creates a _ChunkPipeline for reading the specified columns of the given chunks.""";
+    return _ChunkPipeline(self,chunks,columns,depth=self.readahead);
+
   def _get_submss (self,ms,ddids=None):
     """Helper method. Splits MS into subsets by DATA_DESC_ID.
     Returns list of (ddid,nrows,subms) tuples, where subms is a subset of the MS with the given DDID,
@@ -243,12 +835,118 @@ class Flagger (Timba.dmi.verbosity):
     nrows = 0;
     if ddids is None:
       ddids = range(TABLE(ms.getkeyword('DATA_DESCRIPTION'),ack=False).nrows());
-    for ddid in ddids:
-      subms = ms.query("DATA_DESC_ID==%d"%ddid);
+    # the row index can only be used with the full MS, for a subset we partition its own DATA_DESC_ID column
+    for ddid,subms in MSIndex.split_by_ddid(ms,ddids,self._row_index() if ms is self.ms else None):
       sub_mss.append((ddid,nrows,subms));
       nrows += subms.nrows();
     return sub_mss;
 
+  def _timeslot_index (self):
+    """Helper method. Returns the timeslot index of the MS (see Owlcat.MSIndex), loading or building it
+    on first use.""";
+    if self._tsindex is None:
+      with self.profile.stage('index','TIME'):
+        self._tsindex = MSIndex.timeslot_index(self._reopen(self.readwrite),self.msname);
+    return self._tsindex;
+
+  def _reltime_origin (self):
+    """Helper method. Returns the time that relative times (the reltime selections of xflag() and
+    friends, and of flag regions) are counted from, i.e. the first timeslot of the MS.""";
+    return self._timeslot_index().times[0];
+
+  def _row_index (self):
+    """Helper method. Returns the row index of the MS (see Owlcat.MSIndex), loading or building it
+    on first use.""";
+    if self._rowindex is None:
+      with self.profile.stage('index','rows'):
+        self._rowindex = MSIndex.row_index(self._reopen(self.readwrite),self.msname);
+    return self._rowindex;
+
+  def _parse_ddids (self,ms,ddid=None):
+    """Helper method. Converts a ddid argument (None for all, int, or list) into a list of DDIDs.""";
+    if ddid is None:
+      return range(TABLE(ms.getkeyword('DATA_DESCRIPTION'),ack=False,readonly=True).nrows());
+    elif isinstance(ddid,int):
+      return [ ddid ];
+    elif isinstance(ddid,(tuple,list)):
+      return list(ddid);
+    else:
+      raise TypeError,"invalid ddid argument of type %s"%type(ddid);
+
+  def _select_subset (self,ms,ddid=None,fieldid=None,antennas=None,time=None,reltime=None,taql=None,baselines=None,purr=False):
+    """Helper method. Applies the row selection options common to _flag(), xflag() and
+    flagset_stats() to the MS (which must be the full MS, not a subset). Returns (ms,ddids) tuple,
+    where ms is the selected subset of the MS, and ddids is a list of DATA_DESC_IDs to process.
+    The per-chunk flaggers select baselines themselves, but the native autoflaggers pass a list of
+    (p,q) baselines here, to be taken from the row index.
+    """;
+    # get DDIDs
+    ddids = self._parse_ddids(ms,ddid);
+    # form up list of TaQL expressions for subset selectors
+    queries = [];
+    if taql:
+      queries.append(taql);
+    # field, antenna and time selections are turned into sorted arrays of row numbers, taken from the
+    # row and timeslot indices, and intersected. None means all rows
+    rows = None;
+    def select_rows (rows,selected):
+      return selected if rows is None else numpy.intersect1d(rows,selected,assume_unique=True);
+    if fieldid is not None:
+      if isinstance(fieldid,int):
+        fieldid = [ fieldid ];
+      elif not isinstance(fieldid,(tuple,list)):
+        raise TypeError,"invalid fieldid argument of type %s"%type(fieldid);
+      purr and self.purrpipe.comment("; fields %s"%",".join(map(str,fieldid)),endline=False);
+      rows = select_rows(rows,self._row_index().field_rows(fieldid));
+    if antennas is not None:
+      purr and self.purrpipe.comment("; antennas %s"%",".join(map(str,antennas)),endline=False);
+      rows = select_rows(rows,self._row_index().antenna_rows(list(antennas)));
+    if baselines is not None:
+      purr and self.purrpipe.comment("; %d baselines"%len(baselines),endline=False);
+      rows = select_rows(rows,self._row_index().baseline_rows([ (int(p),int(q)) for p,q in baselines ]));
+    # time and reltime are combined into a single absolute time range
+    if time is not None or reltime is not None:
+      lower,upper = [],[];
+      if time is not None:
+        t0,t1 = time;
+        t0 is not None and lower.append(t0);
+        t1 is not None and upper.append(t1);
+      if reltime is not None:
+        t0,t1 = reltime;
+        time0 = self._reltime_origin();
+        t0 is not None and lower.append(time0+t0);
+        t1 is not None and upper.append(time0+t1);
+      t0 = max(lower) if lower else None;
+      t1 = min(upper) if upper else None;
+      # if the MS is ordered in time, the time range is a contiguous range of rows, which saves us a query
+      tsindex = self._timeslot_index();
+      if tsindex.ordered:
+        row0,row1 = tsindex.row_range(*tsindex.slots(t0,t1));
+        purr and self.purrpipe.comment("; time range selects rows %d~%d"%(row0,row1-1),endline=False);
+        self.dprintf(2,"time range selects rows %d:%d\n",row0,row1);
+        rows = select_rows(rows,numpy.arange(row0,row1));
+      else:
+        if t0 is not None:
+          queries.append("TIME>=%f"%t0);
+        if t1 is not None:
+          queries.append("TIME<=%f"%t1);
+    if rows is not None:
+      with self.profile.stage('select',None,len(rows)):
+        ms = ms.selectrows(rows);
+      self.dprintf(2,"row selection reduces MS to %d rows\n",ms.nrows());
+    # form up TaQL string, and extract subset of table
+    if queries:
+      query = "( " + " ) && ( ".join(queries)+" )";
+      purr and self.purrpipe.comment("; effective MS selection is \"%s\""%query,endline=False);
+      self.dprintf(2,"selection string is %s\n",query);
+      with self.profile.stage('taql') as st:
+        ms = ms.query(query);
+        st.rows(ms.nrows());
+      self.dprintf(2,"query reduces MS to %d rows\n",ms.nrows());
+    else:
+      self.dprintf(2,"no selection applied\n");
+    return ms,ddids;
+
   def _flag (self,
           flag=1,                         # set this flagmask (or flagset name) or
           unflag=0,                       # clear this flagmask (or flagset name)
@@ -306,58 +1004,16 @@ class Flagger (Timba.dmi.verbosity):
     else:
       self.dprintf(2,"no bitflags in MS, using legacy FLAG/FLAG_ROW columns\n",unflag);
 
-    # get DDIDs
-    if ddid is None:
-      ddids = range(TABLE(ms.getkeyword('DATA_DESCRIPTION'),ack=False,readonly=True).nrows());
-    elif isinstance(ddid,int):
-      ddids = [ ddid ];
-    elif isinstance(ddid,(tuple,list)):
-      ddids = ddid;
-    else:
-      raise TypeError,"invalid ddid argument of type %s"%type(ddid);
-
-    # form up list of TaQL expressions for subset selectors
-    queries = [];
-    if taql:
-      queries.append(taql);
-    if fieldid is not None:
-      if isinstance(fieldid,int):
-        fieldid = [ fieldid ];
-      elif not isinstance(fieldid,(tuple,list)):
-        raise TypeError,"invalid fieldid argument of type %s"%type(fieldid);
-      queries.append(" || ".join(["FIELD_ID==%d"%f for f in fieldid]));
-    if antennas is not None:
-      antlist = str(list(antennas));
-      queries.append("ANTENNA1 in %s || ANTENNA2 in %s"%(antlist,antlist));
-    if time is not None:
-      t0,t1 = time;
-      if t0 is not None:
-        queries.append("TIME>=%g"%t0);
-      if t1 is not None:
-        queries.append("TIME<=%g"%t1);
-    if reltime is not None:
-      t0,t1 = reltime;
-      time0 = self.ms.getcol('TIME',0,1)[0];
-      if t0 is not None:
-        queries.append("TIME>=%f"%(time0+t0));
-      if t1 is not None:
-        queries.append("TIME<=%f"%(time0+t1));
-
-    # form up TaQL string, and extract subset of table
-    if queries:
-      query = "( " + " ) && ( ".join(queries)+" )";
-      purr and self.purrpipe.comment("; effective MS selection is \"%s\""%query,endline=False);
-      self.dprintf(2,"selection string is %s\n",query);
-      ms = ms.query(query);
-      self.dprintf(2,"query reduces MS to %d rows\n",ms.nrows());
-    else:
-      self.dprintf(2,"no selection applied\n");
+    # select subset of MS, and get DDIDs
+    ms,ddids = self._select_subset(ms,ddid=ddid,fieldid=fieldid,antennas=antennas,
+                                   time=time,reltime=reltime,taql=taql,purr=purr);
     # check list of baselines
     if baselines:
       baselines = [ (int(p),int(q)) for p,q in baselines ];
       purr and self.purrpipe.comment("; baseline subset is %s"%
         " ".join(["%d-%d"%(p,q) for p,q in baselines]),
         endline=False);
+      baseline_lookup = _baseline_lookup(baselines);
 
     # This will be true if only whole rows are being selected for. If channel/correlation/clipping
     # criteria are supplied, this will be set to False below
@@ -391,25 +1047,42 @@ class Flagger (Timba.dmi.verbosity):
     # make list of sub-MSs by DDID
     sub_mss = self._get_submss(ms,ddids);
     nrow_tot = ms.nrows();
+    # work out which columns each chunk needs, so that they can be read ahead
+    readcols = [];
+    if baselines:
+      readcols += [ 'ANTENNA1','ANTENNA2' ];
+    if get_stats:
+      if include_legacy_stats:
+        readcols += [ 'FLAG_ROW','FLAG' ];
+      if flag:
+        readcols += [ 'BITFLAG_ROW','BITFLAG' ];
+    elif transfer:
+      readcols += [ 'BITFLAG_ROW','FLAG_ROW','FLAG','BITFLAG' ];
+    elif flagrows:
+      if self.has_bitflags:
+        readcols += [ 'BITFLAG_ROW','BITFLAG' ];
+        if fill_legacy is not None:
+          readcols += [ 'FLAG_ROW','FLAG' ];
+      else:
+        readcols += [ 'FLAG_ROW','FLAG' ];
+    else:
+      readcols += [ 'FLAG','FLAG_ROW' ];
+      if clip:
+        readcols.append(clip_column);
+      if self.has_bitflags:
+        readcols += [ 'BITFLAG','BITFLAG_ROW' ];
     # go through rows of the MS in chunks
-    for ddid,irow_prev,ms in sub_mss:
-      self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
-      if progress_callback:
-        progress_callback(irow_prev,nrow_tot);
-      for row0 in range(0,ms.nrows(),self.chunksize):
+    pipeline = self._pipeline(self._get_chunks(sub_mss,columns=readcols),readcols);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows),cols in pipeline:
+        if row0 == 0:
+          self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
         if progress_callback:
           progress_callback(irow_prev+row0,nrow_tot);
-        nrows = min(self.chunksize,ms.nrows()-row0);
         self.dprintf(2,"flagging rows %d:%d\n",row0,row0+nrows-1);
         # get mask of matching baselines
         if baselines:
-          # init mask of all-false
-          rowmask = numpy.zeros(nrows,dtype=numpy.bool);
-          a1 = ms.getcol('ANTENNA1',row0,nrows);
-          a2 = ms.getcol('ANTENNA2',row0,nrows);
-          # update mask
-          for p,q in baselines:
-            rowmask |= (a1==p) & (a2==q);
+          rowmask = _baseline_rowmask(baseline_lookup,cols['ANTENNA1'],cols['ANTENNA2']);
           self.dprintf(2,"baseline selection leaves %d rows\n",len(rowmask.nonzero()[0]));
         # else select all rows
         else:
@@ -421,14 +1094,14 @@ class Flagger (Timba.dmi.verbosity):
         if get_stats:
           # collect row stats
           if include_legacy_stats:
-            lfr  = ms.getcol('FLAG_ROW',row0,nrows)[rowmask];
-            lf   = ms.getcol('FLAG',row0,nrows);
+            lfr  = cols['FLAG_ROW'][rowmask];
+            lf   = cols['FLAG'];
           else:
             lfr = lf = 0;
           if flag:
-            bfr = ms.getcol('BITFLAG_ROW',row0,nrows)[rowmask];
+            bfr = cols['BITFLAG_ROW'][rowmask];
             lfr = lfr + ((bfr&flag)!=0);
-            bf = self._get_bitflag_col(ms,row0,nrows);
+            bf = cols['BITFLAG'];
           # size seems to be a method or an attribute depending on numpy version :(
           stat_rows     += (callable(lfr.size) and lfr.size()) or lfr.size;
           stat_rows_nfl += lfr.sum();
@@ -444,18 +1117,18 @@ class Flagger (Timba.dmi.verbosity):
             stat_pixels_nfl += lfm.sum();
         # second, handle transfer-flags mode
         elif transfer:
-          bf = ms.getcol('BITFLAG_ROW',row0,nrows);
+          bf = cols['BITFLAG_ROW'];
           bfm = bf[rowmask];
           if unflag:
             bfm &= ~unflag;
-          lf = ms.getcol('FLAG_ROW',row0,nrows)[rowmask];
+          lf = cols['FLAG_ROW'][rowmask];
           bf[rowmask] = numpy.where(lf,bfm|flag,bfm);
             # size seems to be a method or an attribute depending on numpy version :(
           stat_rows     += (callable(lf.size) and lf.size()) or lf.size;
           stat_rows_nfl += lf.sum();
-          ms.putcol('BITFLAG_ROW',bf,row0,nrows);
-          lf = ms.getcol('FLAG',row0,nrows);
-          bf = self._get_bitflag_col(ms,row0,nrows,lf.shape);
+          putcols = [ ('BITFLAG_ROW',bf) ];
+          lf = cols['FLAG'];
+          bf = cols['BITFLAG'];
           for subset in subsets:
             bfm = bf[subset];
             if unflag:
@@ -465,38 +1138,37 @@ class Flagger (Timba.dmi.verbosity):
             # size seems to be a method or an attribute depending on numpy version :(
             stat_pixels     += (callable(lfm.size) and lfm.size()) or lfm.size;
             stat_pixels_nfl += lfm.sum();
-          ms.putcol('BITFLAG',bf,row0,nrows);
+          putcols.append(('BITFLAG',bf));
+          pipeline.put(ms,row0,nrows,putcols);
         # else, are we flagging whole rows?
         elif flagrows:
           if self.has_bitflags:
-            bfr = ms.getcol('BITFLAG_ROW',row0,nrows);
-            bf = self._get_bitflag_col(ms,row0,nrows);
+            bfr = cols['BITFLAG_ROW'];
+            bf = cols['BITFLAG'];
             if unflag:
               bfr[rowmask] &= ~unflag;
               bf[rowmask,:,:] &= ~unflag;
             if flag:
               bfr[rowmask] |= flag;
               bf[rowmask,:,:] |= flag;
-            ms.putcol('BITFLAG_ROW',bfr,row0,nrows);
-            ms.putcol('BITFLAG',bf,row0,nrows);
+            putcols = [ ('BITFLAG_ROW',bfr),('BITFLAG',bf) ];
             if fill_legacy is not None:
-              lfr = ms.getcol('FLAG_ROW',row0,nrows);
-              lf = ms.getcol('FLAG',row0,nrows);
+              lfr = cols['FLAG_ROW'];
+              lf = cols['FLAG'];
               lfr[rowmask] = ( (bfr[rowmask]&fill_legacy) !=0 );
               lf[rowmask,:,:] = ( (bf[rowmask]&fill_legacy) !=0 );
-              ms.putcol('FLAG_ROW',lfr,row0,nrows);
-              ms.putcol('FLAG',lf,row0,nrows);
+              putcols += [ ('FLAG_ROW',lfr),('FLAG',lf) ];
+            pipeline.put(ms,row0,nrows,putcols);
           else:
-            lfr = ms.getcol('FLAG_ROW',row0,nrows);
-            lf = ms.getcol('FLAG',row0,nrows);
+            lfr = cols['FLAG_ROW'];
+            lf = cols['FLAG'];
             lfr[rowmask] = (flag!=0);
             lf[rowmask,:,:] = (flag!=0);
-            ms.putcol('FLAG_ROW',lfr,row0,nrows);
-            ms.putcol('FLAG',lf,row0,nrows);
+            pipeline.put(ms,row0,nrows,[ ('FLAG_ROW',lfr),('FLAG',lf) ]);
         # else flagging individual correlations or channels
         else:
           # get flags (for clipping purposes)
-          lf = ms.getcol('FLAG',row0,nrows);
+          lf = cols['FLAG'];
           # 'mask' is what needs to be flagged/unflagged. Start with empty mask.
           mask = numpy.zeros(lf.shape,bool);
           # then fill in subsets
@@ -504,19 +1176,12 @@ class Flagger (Timba.dmi.verbosity):
             mask[subset] = True;
           # get clipping mask, if amplitude clipping is in effect
           if clip:
-            datacol = ms.getcol(clip_column,row0,nrows);
+            datacol = cols[clip_column];
             clip_mask = numpy.ones(datacol.shape,bool);
-            if clip_above is not None:
-              clip_mask &= abs(datacol)>clip_above;
-            if clip_below is not None:
-              clip_mask &= abs(datacol)<clip_below;
-            if len(datacol.shape) > 1:
-              # mask data column with subset, and with legacy flags
-              datacol = numpy.ma.masked_array(abs(datacol),(~mask)|lf,fill_value=0).mean(1);
-              if clip_fm_above is not None:
-                clip_mask &= (datacol>clip_fm_above)[:,numpy.newaxis,...];
-              if clip_fm_below is not None:
-                clip_mask &= (datacol<clip_fm_below)[:,numpy.newaxis,...];
+            # frequency means leave out data outside the subset, and data with legacy flags
+            datamask = ((~mask)|lf) if datacol.ndim > 1 else None;
+            _clip_data(datacol,clip_mask,datamask,above=clip_above,below=clip_below,
+                       fm_above=clip_fm_above,fm_below=clip_fm_below);
             # broadcast shape, if datacol has fewer axes than flags
             if len(clip_mask.shape) == 1:
               clip_mask = clip_mask[:,numpy.newaxis,numpy.newaxis];
@@ -528,34 +1193,31 @@ class Flagger (Timba.dmi.verbosity):
           rmask = mask.any(2).any(1);
           # apply flags
           if self.has_bitflags:
-            bf = self._get_bitflag_col(ms,row0,nrows);
-            bfr = ms.getcol('BITFLAG_ROW',row0,nrows);
+            bf = cols['BITFLAG'];
+            bfr = cols['BITFLAG_ROW'];
             if unflag:
               bf[mask] &= ~unflag;
             if flag:
               bf[mask] |= flag;
-            # update row flag: mask out all affected bits
-            bf1 = bf[rmask,:,:]&(flag|unflag);
-            # clear all affected bits in rowflag
+            # update row flag: clear all affected bits in rowflag, then set those that are set in all flags
             bfr[rmask] &= ~(flag|unflag);
-            # set bits in rowflag that are set in all flags
-            for nbit in range(self.NBITS):
-              bfr[rmask] |= (1<<nbit)*numpy.logical_and.reduce(numpy.logical_and.reduce(bf1&(1<<nbit),2),1);
-            ms.putcol('BITFLAG',bf,row0,nrows);
-            ms.putcol('BITFLAG_ROW',bfr,row0,nrows);
+            bfr[rmask] |= _reduce_rowflags(bf[rmask,:,:])&(flag|unflag);
+            putcols = [ ('BITFLAG',bf),('BITFLAG_ROW',bfr) ];
             # fill legacy flags
             if fill_legacy is not None:
-              lfr = ms.getcol('FLAG_ROW',row0,nrows);
+              lfr = cols['FLAG_ROW'];
               lf[mask] = ( (bf[mask]&fill_legacy) !=0 );
               lfr[rmask] = ( (bfr[rmask]&fill_legacy) != 0);
-              ms.putcol('FLAG',lf,row0,nrows);
-              ms.putcol('FLAG_ROW',lfr,row0,nrows);
+              putcols += [ ('FLAG',lf),('FLAG_ROW',lfr) ];
+            pipeline.put(ms,row0,nrows,putcols);
           else:
-            lfr = ms.getcol('FLAG_ROW',row0,nrows);
+            lfr = cols['FLAG_ROW'];
             lf[mask] = (flag!=0);
-            lfr[rmask] = lf[mask].all(2).all(1);
-            ms.putcol('FLAG',lf,row0,nrows);
-            ms.putcol('FLAG_ROW',lfr,row0,nrows);
+            lfr[rmask] = _reduce_rowflags(lf[rmask,:,:]);
+            pipeline.put(ms,row0,nrows,[ ('FLAG',lf),('FLAG_ROW',lfr) ]);
+      pipeline.flush();
+    finally:
+      pipeline.close();
     if progress_callback:
       progress_callback(99,100);
     stat0 = (stat_rows and stat_rows_nfl/float(stat_rows)) or 0;
@@ -647,281 +1309,1079 @@ class Flagger (Timba.dmi.verbosity):
 
               # other options
           flag_allcorr=True,              # flag all correlations if at least one is flagged
+          grow_time=0,                    # once flagged, grow the 'flag' flags by N timeslots either way
+          grow_freq=0,                    # ...and by N channels either way
+          threshold_frac=None,            # ...and flag whole timeslots that are more than this fraction flagged
           progress_callback=None,         # callback, called with (n,nmax) to report progress
           purr=False                      # if True, writes comments to purrpipe
           ):
-    """Alternative flag interface, works on the in/out principle.""";
+    """Alternative flag interface, works on the in/out principle.
+    If grow_time, grow_freq or threshold_frac is given, the flags in 'flag' are then grown within
+    the row subset (including the baselines selection), in a second pass by baseline and time (see grow_flags()).""";
     if not self.purrpipe:
       purr = False;
-    ms = self._reopen(flag or unflag or fill_legacy is not None);
-    # lookup flagset names
+    self._reopen(flag or unflag or fill_legacy is not None);
+    kw = self._xflag_args(flag=flag,unflag=unflag,create=create,fill_legacy=fill_legacy,
+              ddid=ddid,fieldid=fieldid,antennas=antennas,baselines=baselines,
+              time=time,reltime=reltime,taql=taql,channels=channels,corrs=corrs,
+              flagmask=flagmask,flagmask_all=flagmask_all,flagmask_none=flagmask_none,
+              data_nan=data_nan,data_above=data_above,data_below=data_below,
+              data_fm_above=data_fm_above,data_fm_below=data_fm_below,data_column=data_column,
+              data_flagmask=data_flagmask,flag_allcorr=flag_allcorr);
+    # with parallel workers, only the total time is profiled, since the stages run in other processes
+    grow = grow_time or grow_freq or threshold_frac is not None;
+    if grow and not kw['flag']&self.BITMASK_ALL:
+      raise ValueError,"growing flags requires a flagset to flag";
+    with self.profile.stage('xflag'):
+      if self.workers > 1 and self._shadow is None:
+        stats = self._xflag_parallel(progress_callback=progress_callback,purr=purr,**kw);
+      else:
+        stats = self._xflag(progress_callback=progress_callback,purr=purr,**kw);
+    if grow:
+      selection = dict([ (key,kw[key]) for key in self._XFLAG_SELECTION ]);
+      self.grow_flags(kw['flag']&self.BITMASK_ALL,grow_time=grow_time,grow_freq=grow_freq,
+                      threshold_frac=threshold_frac,flag=kw['flag'],fill_legacy=kw['fill_legacy'],baselines=kw['baselines'],
+                      progress_callback=progress_callback,purr=purr,**selection);
+    return stats;
+
+  # xflag() arguments that select rows of the MS
+  _XFLAG_SELECTION = ('ddid','fieldid','antennas','time','reltime','taql');
+
+  def _xflag_args (self,create=False,**kw):
+    """Helper method for xflag() and xflag_program(). Converts the flagset names in a dict of xflag()
+    arguments into flagmasks, and checks that the MS can take the flags. Returns the converted dict.""";
     for var in 'flag','unflag','flagmask','flagmask_all','flagmask_none','data_flagmask','fill_legacy':
-      flagval = locals()[var];
-      locals()[var] = fm = self.lookup_flagmask(flagval,create=(var=='flag'));
-      if flagval is not None:
-        self.dprintf(2,"%s=%s corresponds to bitmask %s\n",var,flagval,self.flagmaskstr(fm));
+      if var in kw:
+        flagval = kw[var];
+        kw[var] = fm = self.lookup_flagmask(flagval,create=(var=='flag' and create));
+        if flagval is not None:
+          self.dprintf(2,"%s=%s corresponds to bitmask %s\n",var,flagval,self.flagmaskstr(fm));
     # for these two masks, it's more convenient that they're set to 0 if missing
-    flag = flag or 0;
-    unflag = unflag or 0;
-    if not self.has_bitflags and (flag|unflag)&self.BITMASK_ALL:
+    kw['flag'] = kw.get('flag') or 0;
+    kw['unflag'] = kw.get('unflag') or 0;
+    if not self.has_bitflags and (kw['flag']|kw['unflag'])&self.BITMASK_ALL:
       raise RuntimeError,"no BITFLAG column in this MS, can't change bitflags";
-    # stats
-    # total number of rows
+    return kw;
+
+  def _xflag_parallel (self,ddid=None,progress_callback=None,purr=False,**kw):
+    """Helper method for xflag(). Splits the selection into jobs by DDID, and runs these jobs
+    in a pool of worker processes. If there are fewer DDIDs than workers, each DDID is further
+    split into row ranges. Returns the combined stats of all jobs.
+    """;
+    ms = self._reopen();
     totrows = ms.nrows();
-    # rows and visibilities in the row subset
-    sel_nrow = sel_nvis = 0;
-    # visibilities selected in subsets A, B and C
-    nvis_A = nvis_B = nvis_C = 0;
-    # get DDIDs and FIELD_IDs
-    if ddid is None:
-      ddids = range(TABLE(ms.getkeyword('DATA_DESCRIPTION'),ack=False,readonly=True).nrows());
-    elif isinstance(ddid,int):
-      ddids = [ ddid ];
-    elif isinstance(ddid,(tuple,list)):
-      ddids = ddid;
-    else:
-      raise TypeError,"invalid ddid argument of type %s"%type(ddid);
-    # form up list of TaQL expressions for subset selectors
-    queries = [];
-    if taql:
-      queries.append(taql);
-    if fieldid is not None:
-      if isinstance(fieldid,int):
-        fieldid = [ fieldid ];
-      elif not isinstance(fieldid,(tuple,list)):
-        raise TypeError,"invalid fieldid argument of type %s"%type(fieldid);
-      queries.append(" || ".join(["FIELD_ID==%d"%f for f in fieldid]));
-    if antennas is not None:
-      antlist = str(list(antennas));
-      queries.append("ANTENNA1 in %s || ANTENNA2 in %s"%(antlist,antlist));
-    if time is not None:
-      t0,t1 = time;
-      if t0 is not None:
-        queries.append("TIME>=%g"%t0);
-      if t1 is not None:
-        queries.append("TIME<=%g"%t1);
-    if reltime is not None:
-      t0,t1 = reltime;
-      time0 = self.ms.getcol('TIME',0,1)[0];
-      if t0 is not None:
-        queries.append("TIME>=%f"%(time0+t0));
-      if t1 is not None:
-        queries.append("TIME<=%f"%(time0+t1));
-    # form up TaQL string, and extract subset of table
-    if queries:
-      query = "( " + " ) && ( ".join(queries)+" )";
-      purr and self.purrpipe.comment("; effective MS selection is \"%s\""%query,endline=False);
-      self.dprintf(2,"selection string is %s\n",query);
-      ms = ms.query(query);
-      self.dprintf(2,"query reduces MS to %d rows\n",ms.nrows());
+    ddids = self._parse_ddids(ms,ddid);
+    if len(ddids) >= self.workers:
+      jobs = [ (dd,None) for dd in ddids ];
     else:
-      self.dprintf(2,"no selection applied\n");
-    # check list of baselines
-    if baselines:
-      baselines = [ (int(p),int(q)) for p,q in baselines ];
-      purr and self.purrpipe.comment("; baseline subset is %s"%
-        " ".join(["%d-%d"%(p,q) for p,q in baselines]),
-        endline=False);
-    # helper func to parse the channels/corrs/timeslots arguments
-    def make_slice_list (selection,parm):
-      if not selection:
-        return [ numpy.s_[:] ];
-      if isinstance(selection,(int,slice)):
-        return make_slice_list([selection],parm);
-      if not isinstance(selection,(list,tuple)):
-        raise TypeError,"invalid %s selection: %s"%(parm,selection);
-      sellist = [];
-      for sel in selection:
-        if isinstance(sel,int):
-          sellist.append(slice(sel,sel+1));
-        elif isinstance(sel,slice):
-          sellist.append(sel);
-        else:
-          raise TypeError,"invalid %s selection: %s"%(parm,selection);
-      return sellist;
-    # parse the arguments
-    channels  = make_slice_list(channels,'channels');
-    corrs     = make_slice_list(corrs,'corrs');
-    purr and self.purrpipe.comment("; channels are %s"%channels,endline=False);
-    purr and self.purrpipe.comment("; correlations are %s"%corrs,endline=False);
+      # we need the size of each per-DDID subset to split it into row ranges
+      selection = dict([ (key,kw[key]) for key in ('fieldid','antennas','time','reltime','taql') ]);
+      ms,ddids = self._select_subset(ms,ddid=ddids,**selection);
+      sub_mss = self._get_submss(ms,ddids);
+      nrow = sum([ subms.nrows() for dd,irow,subms in sub_mss ]);
+      step = max((nrow-1)//self.workers+1,1);
+      jobs = [];
+      for dd,irow,subms in sub_mss:
+        jobs += [ (dd,(row0,min(row0+step,subms.nrows()))) for row0 in range(0,subms.nrows(),step) ];
+      # release the query results, so that they don't hold locks on the MS
+      ms = sub_mss = subms = None;
+    self.dprintf(1,"running %d xflag jobs in %d worker processes\n",len(jobs),self.workers);
+    purr and self.purrpipe.comment("; running %d parallel jobs."%len(jobs));
+    # detach from the MS while workers are running, they will open their own table handles
+    self.close();
+    import multiprocessing
+    pool = multiprocessing.Pool(min(self.workers,len(jobs)));
+    try:
+      results = [];
+      args = [ (self.msname,self.get_verbose(),self.chunksize,self.memory_budget,self.readahead,dd,rows,kw)
+               for dd,rows in jobs ];
+      for res in pool.imap_unordered(_xflag_job,args):
+        results.append(res);
+        if progress_callback:
+          progress_callback(len(results),len(jobs));
+    finally:
+      pool.close();
+      pool.join();
+    if not results:
+      return totrows,0,0,0,0,0;
+    # first stats item is the total number of rows in the MS, the rest are summed up
+    return tuple([results[0][0]]+[ sum(x) for x in zip(*results)[1:] ]);
+
+  def _xflag (self,flag=0,unflag=0,fill_legacy=None,
+          ddid=None,fieldid=None,antennas=None,baselines=None,time=None,reltime=None,taql=None,
+          channels=None,corrs=None,
+          flagmask=None,flagmask_all=None,flagmask_none=None,
+          data_nan=False,data_above=None,data_below=None,data_fm_above=None,data_fm_below=None,
+          data_column='CORRECTED_DATA',data_flagmask=-1,
+          flag_allcorr=True,
+          rows=None,                      # if not None, a (row0,row1) range within each per-DDID subset
+          update_summary=True,            # if True, an up-to-date flag summary is kept up to date
+          progress_callback=None,purr=False):
+    """Internal _xflag method does the actual work of xflag(). All flagmasks must already be
+    converted to ints.""";
+    ms = self._reopen(flag or unflag or fill_legacy is not None);
+    # total number of rows
+    totrows = ms.nrows();
+    # select subset of MS, and get DDIDs
+    ms,ddids = self._select_subset(ms,ddid=ddid,fieldid=fieldid,antennas=antennas,
+                                   time=time,reltime=reltime,taql=taql,purr=purr);
+    op = _XflagOp(flag=flag,unflag=unflag,fill_legacy=fill_legacy,baselines=baselines,
+                  channels=channels,corrs=corrs,
+                  flagmask=flagmask,flagmask_all=flagmask_all,flagmask_none=flagmask_none,
+                  data_nan=data_nan,data_above=data_above,data_below=data_below,
+                  data_fm_above=data_fm_above,data_fm_below=data_fm_below,
+                  data_column=data_column,data_flagmask=data_flagmask,flag_allcorr=flag_allcorr);
+    # the MS is already reduced to the selected rows
+    op.ddids = ddids;
+    self._comment_xflag_op(op,purr);
     # put comment into purrpipe
     purr and self.purrpipe.comment(".");
-    #
-    flagsubsets = flagmask is not None or flagmask_all is not None or flagmask_none is not None;
-    dataclip = data_above is not None or data_below is not None or data_nan or \
-               data_fm_above is not None or data_fm_below is not None;
-    # make list of sub-MSs by DDID
-    sub_mss = self._get_submss(ms,ddids);
+    self._run_xflag_ops([op],self._get_submss(ms,ddids),rows=rows,update_summary=update_summary,
+                        progress_callback=progress_callback);
+    # print collected stats
+    return self._xflag_stats(op,totrows);
+
+  def xflag_program (self,program,progress_callback=None,purr=False):
+    """Runs a flag program: a list of dicts of xflag() arguments (or the name of a file containing one,
+    see load_flag_program()), in a single pass through the MS. Every chunk of the MS is read once, the
+    operations are applied to its flags in order (so each operation sees the flags raised and cleared by
+    the ones before it), and the flags are written out once.
+    Returns list of per-operation stats, each one a tuple as returned by xflag().
+    """;
+    if isinstance(program,str):
+      program = load_flag_program(program);
+    if not self.purrpipe:
+      purr = False;
+    program = [ dict(op) for op in program ];
+    doflag = [ op for op in program if op.get('flag') or op.get('unflag') or op.get('fill_legacy') is not None ];
+    ms = self._reopen(bool(doflag));
+    totrows = ms.nrows();
+    purr and self.purrpipe.comment("Running flag program of %d operations"%len(program),endline=False);
+    ops = [];
+    for i,kw in enumerate(program):
+      kw = self._xflag_args(**kw);
+      selection = dict([ (key,kw.pop(key)) for key in self._XFLAG_SELECTION if key in kw ]);
+      op = _XflagOp(**kw);
+      purr and self.purrpipe.comment("; operation %d"%(i+1),endline=False);
+      # the selection of each operation is kept as a set of row numbers in the full MS
+      subms,op.ddids = self._select_subset(ms,purr=purr,**selection);
+      if subms is not ms:
+        op.rows = subms.rownumbers(ms);
+      self._comment_xflag_op(op,purr);
+      ops.append(op);
+    purr and self.purrpipe.comment(".");
+    # clipping overwrites the data column, so all but the last operation clipping a column need a copy of it
+    for i,op in enumerate(ops):
+      op.copy_data = op.dataclip and bool([ op1 for op1 in ops[i+1:] if op1.dataclip and op1.data_column == op.data_column ]);
+    # make one pass through the union of the selections
+    ddids = sorted(set(sum([ op.ddids for op in ops ],[])));
+    if ops and not [ op for op in ops if op.rows is None ]:
+      ms = ms.selectrows(reduce(numpy.union1d,[ op.rows for op in ops ]));
+    with self.profile.stage('xflag_program'):
+      self._run_xflag_ops(ops,self._get_submss(ms,ddids),progress_callback=progress_callback);
+    stats = [];
+    for i,op in enumerate(ops):
+      self.dprintf(1,"flag program operation %d:\n",i+1);
+      stats.append(self._xflag_stats(op,totrows));
+    return stats;
+
+  def flag_regions (self,regions,flag,create=False,fill_legacy=None,progress_callback=None,purr=False):
+    """Flags a list of regions in a single pass through the MS. Each region is a dict with any of the
+    keys 'time' or 'reltime' (a (t0,t1) range), 'ddid', 'baselines', 'antennas' and 'channels', which
+    are interpreted as by xflag() (see Owlcat.FlagRegions.RegionIndex); all correlations are flagged.
+    The regions are indexed by time interval, and only chunks of rows overlapping some region have their
+    flags read, after which all the regions overlapping the chunk are applied at once.
+    flag gives the flagmask or flagset name to raise (created as needed if create is True); if it includes
+    the legacy bit, the legacy flags are raised as well. fill_legacy is as for xflag().
+    Returns (nvis,nflagged) tuple: number of visibilities within the regions, and number newly flagged.
+    """;
+    if not self.purrpipe:
+      purr = False;
+    ms = self._reopen(True);
+    if not self.has_bitflags:
+      raise TypeError,"MS does not contain a BITFLAG column, cannot use flagsets";
+    flag = self.lookup_flagmask(flag,create=create);
+    fill_legacy = self.lookup_flagmask(fill_legacy);
+    if not flag or not flag&self.BITMASK_ALL:
+      raise ValueError,"no flagset specified to raise region flags in";
+    if flag&self.LEGACY:
+      fill_legacy = (fill_legacy or 0)|flag;
+    flag &= self.BITMASK_ALL;
+    regions = [ dict(reg,channels=_make_slice_list(reg.get('channels'),'channels')) for reg in regions ];
+    with self.profile.stage('index','regions'):
+      time0 = self._reltime_origin() if [ reg for reg in regions if reg.get('reltime') is not None ] else 0;
+      index = FlagRegions.RegionIndex(regions,time0);
+    self.dprintf(1,"flagging %d regions with flagmask %s\n",len(index),self.flagmaskstr(flag));
+    purr and self.purrpipe.title("Flagging").comment("Flagging %d regions with flagmask %s."%(len(index),self.flagmaskstr(flag)));
+    flagcols = [ 'FLAG','FLAG_ROW','BITFLAG','BITFLAG_ROW' ];
+    rowcols = [ 'TIME','ANTENNA1','ANTENNA2' ];
+    def readcols (ms,row0,nrows):
+      cols = self._getcols(ms,row0,nrows,rowcols);
+      # the flags are only read if some region overlaps the chunk in time
+      if len(index.overlapping(cols['TIME'].min(),cols['TIME'].max())):
+        cols.update(self._getcols(ms,row0,nrows,flagcols));
+      return cols;
     nrow_tot = ms.nrows();
+    nvis = nflagged = 0;
+    pipeline = self._pipeline(self._get_chunks(self._get_submss(ms),columns=rowcols+flagcols),readcols);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows),cols in pipeline:
+        if progress_callback:
+          progress_callback(irow_prev+row0,nrow_tot);
+        if 'BITFLAG' not in cols:
+          continue;
+        with self.profile.stage('regions',None,nrows):
+          rows,regs = index.hits(ddid,cols['TIME'],cols['ANTENNA1'],cols['ANTENNA2']);
+          if not len(rows):
+            continue;
+          nchan = cols['BITFLAG'].shape[1];
+          mask = numpy.zeros((nrows,nchan),bool);
+          numpy.logical_or.at(mask,rows,index.chanmask(nchan)[regs]);
+          mask = mask[:,:,numpy.newaxis];
+        self.dprintf(2,"ddid %d, rows %d:%d: %d row/region matches\n",ddid,row0,row0+nrows-1,len(rows));
+        nvis += mask.sum()*cols['BITFLAG'].shape[2];
+        nflagged += self._put_autoflags(pipeline,ms,row0,nrows,cols,mask,flag,fill_legacy);
+      pipeline.flush();
+    finally:
+      pipeline.close();
+    if progress_callback:
+      progress_callback(99,100);
+    self.dprintf(1,"regions: %d of %d visibilities newly flagged\n",nflagged,nvis);
+    return nvis,nflagged;
+
+  def _comment_xflag_op (self,op,purr):
+    """Helper method. Writes the arguments of an xflag() operation to the purrpipe.""";
+    if purr:
+      if op.baselines:
+        self.purrpipe.comment("; baseline subset is %s"%
+          " ".join(["%d-%d"%(p,q) for p,q in op.baselines]),
+          endline=False);
+      self.purrpipe.comment("; channels are %s"%op.channels,endline=False);
+      self.purrpipe.comment("; correlations are %s"%op.corrs,endline=False);
+
+  def _xflag_stats (self,op,totrows):
+    """Helper method. Prints the stats of an xflag() operation, and returns them as a tuple.""";
+    self.dprint(1,"xflag stats:");
+    self.dprintf(1,"total MS size:           %8d rows\n",totrows);
+    self.dprintf(1,"data selection leaves    %8d rows, %8d visibilities\n",op.sel_nrow,op.sel_nvis);
+    self.dprintf(1,"chan/corr slicing leaves %8s       %8d visibilities\n",'',op.nvis_A);
+    self.dprintf(1,"flag selection leaves    %8s       %8d visibilities\n",'',op.nvis_B);
+    self.dprintf(1,"data clipping leaves     %8s       %8d visibilities\n",'',op.nvis_C);
+    return totrows,op.sel_nrow,op.sel_nvis,op.nvis_A,op.nvis_B,op.nvis_C;
+
+  def _run_xflag_ops (self,ops,sub_mss,rows=None,update_summary=True,progress_callback=None):
+    """Helper method for _xflag() and xflag_program(). Makes a single pass through the per-DDID subsets
+    returned by _get_submss(), applying a list of _XflagOp operations in order to the flags of each chunk,
+    then writing the flags of the chunk out once. The stats are accumulated in the operations.
+    rows and update_summary are as for _xflag().""";
+    nrow_tot = sum([ subms.nrows() for dd,irow,subms in sub_mss ]);
+    # work out which columns each chunk needs, so that they can be read ahead
+    doflag = bool([ op for op in ops if op.doflag ]);
+    flag_any = reduce(lambda a,b:a|b,[ op.flag|op.unflag for op in ops ],0);
+    write_bitflags = self.has_bitflags and flag_any&self.BITMASK_ALL;
+    write_legacy = flag_any&self.LEGACY or bool([ op for op in ops if op.fill_legacy is not None ]);
+    needcols = set();
+    for op in ops:
+      needcols.update(op.readcols(self.has_bitflags));
+      if op.rowonly:
+        self.dprint(2,"whole rows selected, using row-only flagging");
+    # if all operations only raise flags in whole rows, the flags never need to be converted into bitmasks:
+    # the row flags are raised directly, and the FLAG/BITFLAG cubes are read and modified (in their own
+    # dtypes) for the selected rows only, see _raise_row_flags()
+    rowraise = doflag and not [ op for op in ops if not op.rowonly or op.unflag or op.fill_legacy is not None ];
+    if rowraise:
+      self.dprint(2,"only raising flags in whole rows");
+      cubecols = [ col for col in ('FLAG','BITFLAG') if col in needcols ];
+      needcols -= set(cubecols);
+    # FLAG is read first, since its shape is used if the BITFLAG column is missing
+    readcols = [ col for col in ('FLAG','BITFLAG','ANTENNA1','ANTENNA2','FLAG_ROW','BITFLAG_ROW') if col in needcols ];
+    readcols += sorted(needcols - set(readcols));
+    # if the MS has an up-to-date flag summary, it is updated with the changes to the flags we write
+    # (not while bitflags go to the shadow store, since the summary describes the flags in the MS)
+    summary = self._load_flag_summary() if doflag and update_summary and self._shadow is None else None;
+    if summary is not None:
+      summary_bits = [ bit for bit in range(32) if write_bitflags and flag_any&(1<<bit) ];
+      if write_legacy:
+        summary_bits.append(FlagSummary.LEGACY_BIT);
+      readcols += [ col for col in ('ANTENNA1','ANTENNA2','TIME') if col not in readcols ];
+    # per-DDID (nchan,ncorr) shapes, filled in from column metadata as needed
+    datashapes = {};
+    # per-DDID row numbers (in the full MS) of the subsets, for operations that select their own rows
+    rownumbers = {};
+    # number of column rows that were compared and that were actually written, for write elision stats
+    nrows_checked = nrows_written = 0;
+    row_start = rows[0] if rows else 0;
     # go through rows of the MS in chunks
-    for ddid,irow_prev,ms in sub_mss:
-      self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
-      if progress_callback:
-        progress_callback(irow_prev,nrow_tot);
-      for row0 in range(0,ms.nrows(),self.chunksize):
+    pipeline = self._pipeline(self._get_chunks(sub_mss,rows,readcols),readcols);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows),cols in pipeline:
+        if row0 == row_start:
+          self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
         if progress_callback:
           progress_callback(irow_prev+row0,nrow_tot);
-        nrows = min(self.chunksize,ms.nrows()-row0);
         self.dprintf(2,"processing rows %d:%d (%d rows total)\n",row0,row0+nrows-1,nrows);
-        # apply baseline selection to the mask
-        if baselines:
-          # rowmask will be True for all selected rows
-          rowmask = numpy.zeros(nrows,bool);
-          a1 = ms.getcol('ANTENNA1',row0,nrows);
-          a2 = ms.getcol('ANTENNA2',row0,nrows);
-          # update mask
-          for p,q in baselines:
-            rowmask |= (a1==p) & (a2==q);
-          self.dprintf(2,"baseline selection leaves %d rows\n",nr);
-        # else select all rows
-        else:
-          # rowmask will be True for all selected rows
-          rowmask = numpy.ones(nrows,bool);
-        # read legacy flags to get a datashape
-        lf = ms.getcol('FLAG',row0,nrows);
-        datashape = lf.shape;
-        nv_per_row = datashape[1]*datashape[2];
+        # get the datashape from column metadata, so that we don't need to read any cubes for it
+        if ddid not in datashapes:
+          datashapes[ddid] = self._get_datashape(ms);
+        datashape = (nrows,)+datashapes[ddid];
+        lf = cols.get('FLAG');
         # rowflags and visflags will be constructed on-demand below. Make helper functions for this
         self._rowflags = self._visflags = None;
         def rowflags ():
           if self._rowflags is None:
-            # read legacy flags and convert them to bitmask, then add bitflags
-            lfr = ms.getcol('FLAG_ROW',row0,nrows);
-            self._rowflags = lfr*self.LEGACY;
-            if self.has_bitflags:
-              self._rowflags |= ms.getcol('BITFLAG_ROW',row0,nrows);
+            # convert legacy flags to bitmask, then add bitflags
+            with self.profile.stage('flagmasks','FLAG_ROW',nrows):
+              self._rowflags = cols['FLAG_ROW']*self.LEGACY;
+              if self.has_bitflags:
+                self._rowflags |= cols['BITFLAG_ROW'];
           return self._rowflags;
         def visflags ():
           if self._visflags is None:
-            self._visflags = lf*self.LEGACY;
-            if self.has_bitflags:
-              bf = ms.getcol('BITFLAG',row0,nrows);
-              self._bitflag_dtype = bf.dtype;
-              self._visflags |= bf;
+            with self.profile.stage('flagmasks','FLAG',nrows):
+              if lf is not None:
+                self._visflags = lf*self.LEGACY;
+              else:
+                self._visflags = numpy.zeros(datashape,numpy.int64);
+              if 'BITFLAG' in cols:
+                bf = cols['BITFLAG'];
+                self._bitflag_dtype = bf.dtype;
+                self._visflags |= bf;
           return self._visflags;
-        # apply stats
+        if summary is not None and not rowraise:
+          vf,rf = visflags(),rowflags();
+          with self.profile.stage('summary',None,nrows):
+            oldcounts = self._summary_counts(summary_bits,vf,rf);
+        # per-row bitmasks of the flags to be raised in whole rows
+        if rowraise:
+          rowbits = numpy.zeros(nrows,numpy.int64);
+        # apply the operations in turn
+        for op in ops:
+          if ddid not in op.ddids:
+            continue;
+          # apply row selection to the mask
+          if op.rows is not None:
+            if ddid not in rownumbers:
+              rownumbers[ddid] = ms.rownumbers(self.ms);
+            # rowmask will be True for all selected rows
+            rowmask = _sorted_rowmask(op.rows,rownumbers[ddid][row0:row0+nrows]);
+          else:
+            rowmask = numpy.ones(nrows,bool);
+          # apply baseline selection to the mask
+          if op.baselines:
+            rowmask &= _baseline_rowmask(op.baseline_lookup,cols['ANTENNA1'],cols['ANTENNA2']);
+            self.dprintf(2,"baseline selection leaves %d rows\n",rowmask.sum());
+          if rowraise:
+            self._rowonly_stats(op,rowmask,datashape);
+            rowbits[rowmask] |= op.flag;
+          else:
+            self._apply_xflag_op(op,cols,rowmask,datashape,visflags,rowflags);
+        # now, write out the flags
+        if rowraise:
+          nchecked,nwritten,counts = self._raise_row_flags(pipeline,ms,row0,nrows,cols,cubecols,rowbits,
+              datashape,summary_bits if summary is not None else None);
+          nrows_checked += nchecked;
+          nrows_written += nwritten;
+          if summary is not None:
+            try:
+              summary.update(ddid,cols['ANTENNA1'],cols['ANTENNA2'],cols['TIME'],summary_bits,*counts);
+            except KeyError:
+              self.dprint(1,"rows not found in flag summary, it will be out of date");
+              summary = None;
+        elif doflag:
+          rf = rowflags();
+          vf = visflags();
+          if summary is not None:
+            with self.profile.stage('summary',None,nrows):
+              viscounts,rowcounts = self._summary_counts(summary_bits,vf,rf);
+              try:
+                summary.update(ddid,cols['ANTENNA1'],cols['ANTENNA2'],cols['TIME'],summary_bits,
+                               viscounts-oldcounts[0],rowcounts-oldcounts[1]);
+              except KeyError:
+                self.dprint(1,"rows not found in flag summary, it will be out of date");
+                summary = None;
+          # list of (column,value,oldvalue) triplets to be written out
+          putcols = [];
+          with self.profile.stage('writeprep',None,nrows):
+            # mask bitflag, convert back to bitflag type and write out
+            if write_bitflags:
+              self.dprint(4,"computing bitflags");
+              bf = numpy.asarray(vf&self.BITMASK_ALL,self._bitflag_dtype)
+              bfr = numpy.asarray(rf&self.BITMASK_ALL,self._bitflag_dtype)
+              self.dprintf(4,"filling bitflags for rows %d:%d\n"%(row0,row0+nrows));
+              putcols += [ ('BITFLAG',bf,cols['BITFLAG']),('BITFLAG_ROW',bfr,cols['BITFLAG_ROW']) ];
+            # write legacy flags
+            if write_legacy:
+              self.dprintf(4,"filling legacy flags for rows %d:%d\n"%(row0,row0+nrows));
+              putcols += [ ('FLAG',(vf&self.LEGACY)!=0,cols['FLAG']),('FLAG_ROW',(rf&self.LEGACY)!=0,cols['FLAG_ROW']) ];
+            # only write out the spans of rows that have actually changed
+            nrows_written += self._put_changed(pipeline,ms,row0,nrows,putcols);
+          nrows_checked += nrows*len(putcols);
+        self.dprint(4,"done with this chunk");
+      pipeline.flush();
+    finally:
+      pipeline.close();
+    if progress_callback:
+      progress_callback(99,100);
+    self._rowflags = self._visflags = None;
+    # flush our changes to disk, so that the summary can be stamped with the new MS modification time
+    if summary is not None:
+      self.ms.flush();
+      summary.mtime = self._ms_mtime();
+      self._save_flag_summary(summary);
+    if nrows_checked:
+      self.dprintf(1,"changed flags required writing %d of %d column rows\n",nrows_written,nrows_checked);
+
+  def _rowonly_stats (self,op,rowmask,datashape):
+    """Helper method for _run_xflag_ops(). Accumulates the stats of a row-only operation: all
+    visibilities of the selected rows are in subsets A, B and C.""";
+    nr = rowmask.sum();
+    nv = nr*datashape[1]*datashape[2];
+    op.sel_nrow += nr;
+    op.sel_nvis += nv;
+    op.nvis_A += nv;
+    op.nvis_B += nv;
+    op.nvis_C += nv;
+    self.dprintf(2,"Row subset (data selection) leaves %d rows and %d visibilities\n",nr,nv);
+
+  def _raise_row_flags (self,pipeline,ms,row0,nrows,cols,cubecols,rowbits,datashape,summary_bits=None):
+    """Helper method for _run_xflag_ops(). Raises flags in whole rows of a chunk. rowbits gives the
+    per-row bitmasks to raise (with legacy flags as the LEGACY bit), cols holds the row flag columns
+    as read in, and cubecols lists the FLAG/BITFLAG columns to be updated. A flag raised in every
+    visibility of a row is raised in its row flag as well, so the row flags are updated directly, and
+    the cubes are only read and modified for the spans of rows with flags to raise, in their own dtypes.
+    Only the rows that change are written. If summary_bits is not None, also works out the changes in
+    the per-row counts of these flag summary bits.
+    Returns (nrows_checked,nrows_written,counts) tuple, where counts is a (viscounts,rowcounts) tuple
+    of (nrows,len(summary_bits)) arrays of changes in the counts, or None.""";
+    bits = rowbits&self.BITMASK_ALL;
+    legacy = (rowbits&self.LEGACY)!=0;
+    nv_per_row = datashape[1]*datashape[2];
+    if summary_bits is not None:
+      viscounts = numpy.zeros((nrows,len(summary_bits)),numpy.int64);
+      rowcounts = numpy.zeros((nrows,len(summary_bits)),numpy.int64);
+    putcols = [];
+    with self.profile.stage('rowflags',None,nrows):
+      if 'BITFLAG' in cubecols:
+        bfr = cols['BITFLAG_ROW'];
+        putcols.append(('BITFLAG_ROW',(bfr|bits).astype(bfr.dtype),bfr));
+      if 'FLAG' in cubecols:
+        lfr = cols['FLAG_ROW'];
+        putcols.append(('FLAG_ROW',lfr|legacy,lfr));
+      if summary_bits is not None:
+        for i,bit in enumerate(summary_bits):
+          if bit == FlagSummary.LEGACY_BIT:
+            rowcounts[:,i] = legacy&~cols['FLAG_ROW'];
+          else:
+            rowcounts[:,i] = ((bits>>bit)&1 != 0)&((cols['BITFLAG_ROW']>>bit)&1 == 0);
+    nrows_checked = nrows*len(putcols);
+    nrows_written = self._put_changed(pipeline,ms,row0,nrows,putcols);
+    written = [];
+    for i0,i1 in _changed_row_spans(rowbits!=0,False):
+      span = pipeline.getcols(ms,row0+i0,i1-i0,cubecols);
+      putcols = [];
+      with self.profile.stage('flag',None,i1-i0):
+        if 'BITFLAG' in span:
+          bf = span['BITFLAG'];
+          putcols.append(('BITFLAG',(bf|bits[i0:i1,numpy.newaxis,numpy.newaxis]).astype(bf.dtype),bf));
+        if 'FLAG' in span:
+          lf = span['FLAG'];
+          putcols.append(('FLAG',lf|legacy[i0:i1,numpy.newaxis,numpy.newaxis],lf));
+        if summary_bits is not None:
+          # raised bits go from their old count to all visibilities of the row
+          for i,bit in enumerate(summary_bits):
+            if bit == FlagSummary.LEGACY_BIT:
+              raised,old = legacy[i0:i1],span['FLAG'];
+            else:
+              raised,old = (bits[i0:i1]>>bit)&1 != 0,(span['BITFLAG']>>bit)&1 != 0;
+            oldcount = old.reshape((i1-i0,-1)).sum(1);
+            viscounts[i0:i1,i] = numpy.where(raised,nv_per_row-oldcount,0);
+      nrows_checked += (i1-i0)*len(putcols);
+      for colname,value,oldvalue in putcols:
+        for j0,j1 in _changed_row_spans(value,oldvalue):
+          written.append((colname,value[j0:j1],i0+j0));
+          nrows_written += j1-j0;
+    pipeline.put(ms,row0,nrows,written);
+    return nrows_checked,nrows_written,(viscounts,rowcounts) if summary_bits is not None else None;
+
+  def _apply_xflag_op (self,op,cols,rowmask,datashape,visflags,rowflags):
+    """Helper method for _run_xflag_ops(). Applies an operation to the flags of a chunk. rowmask is True
+    for the rows of the chunk selected by the operation. visflags and rowflags are callables returning
+    the flags of the chunk as bitmasks (with legacy flags as the LEGACY bit), which are modified in place.""";
+    nv_per_row = datashape[1]*datashape[2];
+    if op.rowonly:
+      self._rowonly_stats(op,rowmask,datashape);
+      # flags are applied to whole rows
+      vismask = rowmask;
+    else:
+      # apply stats
+      nr = rowmask.sum();
+      op.sel_nrow += nr;
+      nv = nr*nv_per_row;
+      op.sel_nvis += nv;
+      self.dprintf(2,"Row subset (data selection) leaves %d rows and %d visibilities\n",nr,nv);
+      # get subset C
+      # vismask will be True for all selected visibilities
+      with self.profile.stage('mask',None,datashape[0]):
+        vismask = numpy.zeros(datashape,bool);
+        for channel_slice in op.channels:
+          for corr_slice in op.corrs:
+            vismask[rowmask,channel_slice,corr_slice] = True;
+        nv = vismask.sum();
+      op.nvis_A += nv;
+      self.dprintf(2,"subset A (freq/corr slicing) leaves %d visibilities\n",nv);
+      # read flags if selecting subset D on them (and also if clipping data)
+      if op.flagsubsets:
+        vf = visflags();
+        # apply them to the rowmask
+        with self.profile.stage('mask',None,datashape[0]):
+          if op.flagmask is not None:
+            vismask &= ( (vf&op.flagmask) != 0 );
+          if op.flagmask_all is not None:
+            vismask &= ( (vf&op.flagmask_all) == op.flagmask_all );
+          if op.flagmask_none is not None:
+            vismask &= ( (vf&op.flagmask_none) == 0 );
+      nv = vismask.sum();
+      op.nvis_B += nv;
+      self.dprintf(2,"subset B (flag-based selection) leaves %d visibilities\n",nv);
+      # now apply clipping
+      if op.dataclip:
+        # frequency means leave out data outside the subset, and data matching data_flagmask
+        vf = visflags() if op.data_flagmask is not None else None;
+        with self.profile.stage('clip',op.data_column,datashape[0]):
+          datamask = ~vismask;
+          if op.data_flagmask is not None:
+            datamask |= ( (vf&op.data_flagmask)!=0 );
+          self.dprintf(4,"datamask contains %d masked visibilities\n",datamask.sum());
+          datacol = cols[op.data_column];
+          if op.copy_data:
+            datacol = datacol.copy();
+          _clip_data(datacol,vismask,datamask,nan=op.data_nan,above=op.data_above,below=op.data_below,
+                     fm_above=op.data_fm_above,fm_below=op.data_fm_below);
+      # finally, subset E is ready
+      nv = vismask.sum();
+      self.dprintf(2,"subset C (data clipping) leaves %d visibilities\n",nv);
+      # extending flagging to all correlations
+      if op.flag_allcorr:
+       vismask |= numpy.logical_or.reduce(vismask,2)[:,:,numpy.newaxis];
+       nv = vismask.sum();
+       self.dprintf(2,"which extends to %d visibilities with flag_allcorr in effect\n",nv);
+      op.nvis_C += nv;
+
+    # now, do the actual flagging
+    if op.doflag:
+      rf = rowflags();
+      vf = visflags();
+      self.dprint(4,"doing flag/unflag");
+      with self.profile.stage('flag',None,datashape[0]):
+        # flag/unflag visibilities
+        if op.flag:
+          vf[vismask] |= op.flag;
+        if op.unflag:
+          vf[vismask] &= ~op.unflag;
+        # fill legacy flags
+        self.dprint(4,"filling legacy");
+        if op.fill_legacy is not None:
+          vf[rowmask] &= ~self.LEGACY;
+          vf[rowmask] |= numpy.where(vf[rowmask,...]&op.fill_legacy,self.LEGACY,0);
+      # adjust the rowflags
+      self.dprint(4,"adjusting rowflags");
+      with self.profile.stage('rowflags',None,datashape[0]):
+        rf[rowmask] = _reduce_rowflags(vf[rowmask,:,:]);
+
+  def flagset_stats (self,
+          flagsets=None,                  # list of flagset names or flagmasks. Default is all flagsets
+          legacy=True,                    # if True, legacy FLAG/FLAG_ROW stats are included as flagset "+L"
+              # The following options select a subset, same as for xflag()
+          ddid=None,fieldid=None,
+          antennas=None,
+          baselines=None,
+          time=None,
+          reltime=None,
+          taql=None,
+          channels=None,
+          corrs=None,
+          flagmask_all=None,
+          flagmask_none=None,
+          summary=False,                  # if True, uses the flag summary where possible (see flag_summary())
+          progress_callback=None,         # callback, called with (n,nmax) to report progress
+          purr=False                      # if True, writes comments to purrpipe
+          ):
+    """Collects statistics for many flagsets at once, in a single pass through the MS.
+    Returns tuple of totrows,sel_nrow,sel_nvis,nvis_A,stats. The first four items are the same as
+    returned by xflag(). stats is a list of (flagset,flagmask,nrows,nvis) tuples, one per flagset,
+    giving the number of rows and visibilities within the selection that have any of the flags in
+    flagmask raised.
+    If summary is True, and the selection is by DDID, antennas and baselines only, the stats
+    are taken from the flag summary instead, which is built first if needed.
+    """;
+    if not self.purrpipe:
+      purr = False;
+    ms = self._reopen();
+    # make list of flagsets
+    if flagsets is None:
+      flagsets = list(self.flagsets.names() or []);
+    else:
+      flagsets = list(flagsets);
+    if legacy:
+      flagsets.append("+L");
+    flagmasks = [ self.lookup_flagmask(fset) for fset in flagsets ];
+    flagmask_all = self.lookup_flagmask(flagmask_all);
+    flagmask_none = self.lookup_flagmask(flagmask_none);
+    if not self.has_bitflags and [ fm for fm in flagmasks if fm&self.BITMASK_ALL ]:
+      raise RuntimeError,"no BITFLAG column in this MS, can't get bitflag stats";
+    # use the summary if every flagmask is a single bit, and the selection is compatible
+    if summary and self._shadow is None and None not in map(self._summary_bit,flagmasks) and \
+        fieldid is None and time is None and reltime is None and taql is None and \
+        channels is None and corrs is None and flagmask_all is None and flagmask_none is None:
+      return self._flagset_stats_from_summary(flagsets,flagmasks,ddid=ddid,antennas=antennas,
+                                              baselines=baselines,progress_callback=progress_callback);
+    with self.profile.stage('flagset_stats'):
+      return self._flagset_stats(flagsets,flagmasks,ms,ddid=ddid,fieldid=fieldid,antennas=antennas,baselines=baselines,
+          time=time,reltime=reltime,taql=taql,channels=channels,corrs=corrs,
+          flagmask_all=flagmask_all,flagmask_none=flagmask_none,progress_callback=progress_callback,purr=purr);
+
+  def _flagset_stats (self,flagsets,flagmasks,ms,ddid=None,fieldid=None,antennas=None,baselines=None,
+          time=None,reltime=None,taql=None,channels=None,corrs=None,flagmask_all=None,flagmask_none=None,
+          progress_callback=None,purr=False):
+    """Helper method for flagset_stats(). Collects the stats by reading the flags of the MS.""";
+    # per-flagset counts of rows and visibilities
+    stat_nrow = numpy.zeros(len(flagmasks),int);
+    stat_nvis = numpy.zeros(len(flagmasks),int);
+    totrows = ms.nrows();
+    sel_nrow = sel_nvis = nvis_A = 0;
+    # select subset
+    ms,ddids = self._select_subset(ms,ddid=ddid,fieldid=fieldid,antennas=antennas,
+                                   time=time,reltime=reltime,taql=taql,purr=purr);
+    if baselines:
+      baseline_lookup = _baseline_lookup([ (int(p),int(q)) for p,q in baselines ]);
+    channels  = _make_slice_list(channels,'channels');
+    corrs     = _make_slice_list(corrs,'corrs');
+    purr and self.purrpipe.comment("; collecting stats for flagsets %s."%", ".join(map(str,flagsets)));
+    sub_mss = self._get_submss(ms,ddids);
+    nrow_tot = ms.nrows();
+    readcols = [ 'FLAG','FLAG_ROW' ];
+    if self.has_bitflags:
+      readcols += [ 'BITFLAG','BITFLAG_ROW' ];
+    if baselines:
+      readcols += [ 'ANTENNA1','ANTENNA2' ];
+    # go through rows of the MS in chunks. Each chunk is read once, and counted against every flagmask
+    pipeline = self._pipeline(self._get_chunks(sub_mss,columns=readcols),readcols);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows),cols in pipeline:
+        if row0 == 0:
+          self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
+        if progress_callback:
+          progress_callback(irow_prev+row0,nrow_tot);
+        self.dprintf(2,"processing rows %d:%d (%d rows total)\n",row0,row0+nrows-1,nrows);
+        if baselines:
+          rowmask = _baseline_rowmask(baseline_lookup,cols['ANTENNA1'],cols['ANTENNA2']);
+        else:
+          rowmask = numpy.ones(nrows,bool);
+        # convert all flags of this chunk to bitmasks
+        lf = cols['FLAG'];
+        datashape = lf.shape;
+        with self.profile.stage('flagmasks','FLAG',nrows):
+          visflags = lf*self.LEGACY;
+          rowflags = cols['FLAG_ROW']*self.LEGACY;
+          if self.has_bitflags:
+            visflags |= cols['BITFLAG'];
+            rowflags |= cols['BITFLAG_ROW'];
         nr = rowmask.sum();
         sel_nrow += nr;
-        nv = nr*nv_per_row;
-        sel_nvis += nv;
-        self.dprintf(2,"Row subset (data selection) leaves %d rows and %d visibilities\n",nr,nv);
-        # get subset C
-        # vismask will be True for all selected visibilities
+        sel_nvis += nr*datashape[1]*datashape[2];
+        # form up subset A
         vismask = numpy.zeros(datashape,bool);
         for channel_slice in channels:
           for corr_slice in corrs:
             vismask[rowmask,channel_slice,corr_slice] = True;
-        nv = vismask.sum();
         nvis_A += vismask.sum();
-        self.dprintf(2,"subset A (freq/corr slicing) leaves %d visibilities\n",nv);
-        # read flags if selecting subset D on them (and also if clipping data)
-        if flagsubsets:
-          vf = visflags();
-          # apply them to the rowmask
-          if flagmask is not None:
-            vismask &= ( (vf&flagmask) != 0 );
-          if flagmask_all is not None:
-            vismask &= ( (vf&flagmask_all) == flagmask_all );
-          if flagmask_none is not None:
-            vismask &= ( (vf&flagmask_none) == 0 );
-        nv = vismask.sum();
-        nvis_B += nv;
-        self.dprintf(2,"subset B (flag-based selection) leaves %d visibilities\n",nv);
-        # now apply clipping
-        if dataclip:
-          datacol = ms.getcol(data_column,row0,nrows);
-          # make it a masked array: mask out stuff not in vismask
-          datamask = ~vismask;
-          # and mask stuff in data_flagmask
-          if data_flagmask is not None:
-            datamask |= ( (visflags()&data_flagmask)!=0 );
-          datacol = numpy.ma.masked_array(datacol,datamask);
-          self.dprintf(4,"datamask contains %d masked visibilities\n",datamask.sum());
-          self.dprintf(3,"At start of clipping we have %d visibilities\n",vismask.sum());
-          self.dprintf(3,"of which %d are finite\n",numpy.isfinite(datacol).sum());
-          # clip on NANs
-          if data_nan:
-            vismask &= ~numpy.isfinite(datacol);
-            self.dprintf(3,"NAN filtering leaves %d visibilities\n",vismask.sum());
-          # clip on amplitudes
-          abscol = abs(datacol);
-          if data_above is not None:
-            vismask &= abscol>data_above;
-            self.dprintf(3,"data_above filtering leaves %d visibilities\n",vismask.sum());
-          if data_below is not None:
-            vismask &= abscol<data_below;
-            self.dprintf(3,"data_below filtering leaves %d visibilities\n",vismask.sum());
-          # clip on freq-mean amplitudes
-          if data_fm_above is not None or data_fm_below is not None:
-            datacol = abscol.mean(1);
-#            print datacol.max(),data_fm_above;
-            if data_fm_above is not None:
-              vismask &= (datacol>data_fm_above)[:,numpy.newaxis,...];
-            if data_fm_below is not None:
-              vismask &= (datacol<data_fm_below)[:,numpy.newaxis,...];
-            self.dprintf(3,"data_fm_above/below filtering leaves %d visibilities\n",vismask.sum());
-        # finally, subset E is ready
-        nv = vismask.sum();
-        self.dprintf(2,"subset C (data clipping) leaves %d visibilities\n",nv);
-        # extending flagging to all correlations
-        if flag_allcorr:
-         vismask |= numpy.logical_or.reduce(vismask,2)[:,:,numpy.newaxis];
-         nv = vismask.sum();
-         self.dprintf(2,"which extends to %d visibilities with flag_allcorr in effect\n",nv);
-        nvis_C += nv;
- 
-        # now, do the actual flagging
-        if flag or unflag or fill_legacy is not None:
-          rf = rowflags();
-          vf = visflags();
-          self.dprint(4,"doing flag/unflag");
-          # flag/unflag visibilities
-          if flag:
-            vf[vismask] |= flag;
-          if unflag:
-            vf[vismask] &= ~unflag;
-          # fill legacy flags
-          self.dprint(4,"filling legacy");
-          if fill_legacy is not None:
-            vf[rowmask] &= ~self.LEGACY;
-            vf[rowmask] |= numpy.where(vf[rowmask,...]&fill_legacy,self.LEGACY,0);
-          # adjust the rowflags
-          self.dprint(4,"adjusting rowflags");
-            ## in principle we need to bitwise_and.reduce both axes of vf[rowmask,:,:], and set the rowflags from that
-            ## but bitwise_and.reduce is broken, see https://github.com/numpy/numpy/issues/5250
-            ## so here's a lengthy workaround:
-            #   rf[rowmask] = 0;
-            #   for nbit in range(self.NBITS):
-            #     rf[rowmask] |= (1<<nbit)*numpy.logical_and.reduce(numpy.logical_and.reduce(vf[rowmask,:,:]&(1<<nbit),2),1);
-            ## and here's a shorter one:
-          rf[rowmask] = ~numpy.bitwise_or.reduce(numpy.bitwise_or.reduce(~vf[rowmask,:,:],2),1);
-          # mask bitflag, convert back to bitflag type and write out
-          if self.has_bitflags and (flag|unflag)&self.BITMASK_ALL:
-            self.dprint(4,"computing bitflags");
-            bf = numpy.asarray(vf&self.BITMASK_ALL,self._bitflag_dtype)
-            bfr = numpy.asarray(rf&self.BITMASK_ALL,self._bitflag_dtype)
-            self.dprintf(4,"filling bitflags for rows %d:%d\n"%(row0,row0+nrows));
-            ms.putcol('BITFLAG',bf,row0,nrows);
-            ms.putcol('BITFLAG_ROW',bfr,row0,nrows);
-          # write legacy flags
-          if fill_legacy is not None or (flag|unflag)&self.LEGACY:
-            self.dprintf(4,"filling legacy flags for rows %d:%d\n"%(row0,row0+nrows));
-            ms.putcol('FLAG',(vf&self.LEGACY)!=0,row0,nrows);
-            ms.putcol('FLAG_ROW',(rf&self.LEGACY)!=0,row0,nrows);
-        self.dprint(4,"done with this chunk");
+        # apply flag-based selection
+        if flagmask_all is not None:
+          vismask &= ( (visflags&flagmask_all) == flagmask_all );
+        if flagmask_none is not None:
+          vismask &= ( (visflags&flagmask_none) == 0 );
+        # reduce flags to the selected subset, and count them for every flagmask
+        with self.profile.stage('count',None,nrows):
+          visflags = visflags[vismask];
+          rowflags = rowflags[rowmask];
+          for i,fm in enumerate(flagmasks):
+            stat_nrow[i] += ((rowflags&fm)!=0).sum();
+            stat_nvis[i] += ((visflags&fm)!=0).sum();
+    finally:
+      pipeline.close();
     if progress_callback:
       progress_callback(99,100);
-    self._rowflags = self._visflags = None;
-    # print collected stats
-    self.dprint(1,"xflag stats:");
-    self.dprintf(1,"total MS size:           %8d rows\n",totrows);
-    self.dprintf(1,"data selection leaves    %8d rows, %8d visibilities\n",sel_nrow,sel_nvis);
-    self.dprintf(1,"chan/corr slicing leaves %8s       %8d visibilities\n",'',nvis_A);
-    self.dprintf(1,"flag selection leaves    %8s       %8d visibilities\n",'',nvis_B);
-    self.dprintf(1,"data clipping leaves     %8s       %8d visibilities\n",'',nvis_C);
+    stats = zip(flagsets,flagmasks,stat_nrow,stat_nvis);
+    self.dprint(1,"flagset stats:");
+    for fset,fm,nr,nv in stats:
+      self.dprintf(1,"%-20s %8d rows, %10d visibilities\n",fset,nr,nv);
+    return totrows,sel_nrow,sel_nvis,nvis_A,stats;
+
+  def _flagset_stats_from_summary (self,flagsets,flagmasks,ddid=None,antennas=None,baselines=None,
+                                   progress_callback=None):
+    """Helper method for flagset_stats(). Gets the stats from the flag summary.""";
+    ms = self._reopen();
+    fs = self.flag_summary(progress_callback=progress_callback);
+    cellmask = numpy.ones(fs.ncells(),bool);
+    if ddid is not None:
+      cellmask &= numpy.in1d(fs.ddid,self._parse_ddids(ms,ddid));
+    if antennas is not None:
+      cellmask &= numpy.in1d(fs.ant1,antennas)|numpy.in1d(fs.ant2,antennas);
+    if baselines:
+      cellmask &= _baseline_rowmask(_baseline_lookup([ (int(p),int(q)) for p,q in baselines ]),fs.ant1,fs.ant2);
+    sel_nrow,sel_nvis,rowbits,visbits = fs.totals(cellmask);
+    stats = [ (fset,fm,rowbits[self._summary_bit(fm)],visbits[self._summary_bit(fm)])
+              for fset,fm in zip(flagsets,flagmasks) ];
+    self.dprint(1,"flagset stats (from flag summary):");
+    for fset,fm,nr,nv in stats:
+      self.dprintf(1,"%-20s %8d rows, %10d visibilities\n",fset,nr,nv);
+    return ms.nrows(),sel_nrow,sel_nvis,sel_nvis,stats;
+
+  def _summary_bit (self,flagmask):
+    """Helper method. Returns the flag summary bit corresponding to a flagmask, or None if the flagmask
+    is not a single bit.""";
+    if flagmask == self.LEGACY:
+      return FlagSummary.LEGACY_BIT;
+    if flagmask and not flagmask&~self.BITMASK_ALL and not flagmask&(flagmask-1):
+      return int(flagmask).bit_length()-1;
+    return None;
+
+  def _summary_counts (self,bits,visflags,rowflags):
+    """Helper method. Given a chunk of visibility and row flags converted to bitmasks, returns
+    (viscounts,rowcounts) tuple of (nrows,len(bits)) arrays, with the per-row numbers of
+    flagged visibilities and row flags for each of the given flag summary bits.""";
+    nrows = len(rowflags);
+    viscounts = numpy.zeros((nrows,len(bits)),numpy.int64);
+    rowcounts = numpy.zeros((nrows,len(bits)),numpy.int64);
+    for i,bit in enumerate(bits):
+      mask = self.LEGACY if bit == FlagSummary.LEGACY_BIT else 1<<bit;
+      viscounts[:,i] = ((visflags&mask)!=0).reshape((nrows,-1)).sum(1);
+      rowcounts[:,i] = (rowflags&mask)!=0;
+    return viscounts,rowcounts;
+
+  def _ms_mtime (self):
+    """Helper method. Returns the latest modification time of the table.* files of the MS (not
+    counting the lock file).""";
+    paths = [ os.path.join(self.msname,name) for name in os.listdir(self.msname)
+              if name.startswith('table.') and name != 'table.lock' ];
+    return max([ os.path.getmtime(path) for path in paths if os.path.isfile(path) ]);
+
+  def _load_flag_summary (self):
+    """Helper method. Returns the flag summary stored for the MS in the index cache directory, or None
+    if there is none, or if it is out of date.""";
+    filename = MSIndex.cache_filename(self.msname,FlagSummary.FILENAME);
+    if filename is None or not os.path.exists(filename):
+      return None;
+    try:
+      summary = FlagSummary.FlagSummary.load(filename);
+    except Exception,exc:
+      self.dprintf(1,"error reading flag summary %s: %s\n",filename,exc);
+      return None;
+    if summary is None or summary.mtime != self._ms_mtime():
+      self.dprint(2,"flag summary is out of date");
+      return None;
+    return summary;
+
+  def _save_flag_summary (self,summary):
+    """Helper method. Saves the flag summary to the index cache directory, if storing indices is
+    enabled and the directory is writable. Nothing is ever written into the MS itself.""";
+    filename = MSIndex.cache_filename(self.msname,FlagSummary.FILENAME);
+    if filename is None:
+      return;
+    try:
+      if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename));
+      # write to a temporary file first, so that readers never see a partial summary
+      tmpname = "%s.%d.tmp"%(filename,os.getpid());
+      fobj = file(tmpname,"wb");
+      summary.save(fobj);
+      fobj.close();
+      os.rename(tmpname,filename);
+      self.dprint(2,"saved flag summary to",filename);
+    except (IOError,OSError),exc:
+      self.dprintf(1,"unable to save flag summary %s: %s\n",filename,exc);
+
+  def flag_summary (self,rebuild=False,timebin=FlagSummary.DEFAULT_TIMEBIN,progress_callback=None):
+    """Returns a FlagSummary object with per-bit flag counts for every DDID, baseline and time chunk
+    of timebin seconds (see Owlcat.FlagSummary). The summary stored for the MS (in the index cache
+    directory, see Owlcat.MSIndex) is used if it is up to date (and rebuild is False), otherwise the
+    summary is rebuilt in a single pass through the MS, and stored again. xflag() keeps a stored summary up to date, other writes to the MS make it
+    out of date.
+    """;
+    # the summary describes the flags in the MS, so changes pending in the shadow store are written out first
+    self.sync();
+    ms = self._reopen();
+    if not rebuild:
+      summary = self._load_flag_summary();
+      if summary is not None:
+        return summary;
+    self.dprint(1,"building flag summary");
+    summary = FlagSummary.FlagSummary(timebin);
+    readcols = [ 'ANTENNA1','ANTENNA2','TIME','FLAG','FLAG_ROW' ];
+    if self.has_bitflags:
+      readcols += [ 'BITFLAG','BITFLAG_ROW' ];
+    sub_mss = self._get_submss(ms);
+    nrow_tot = ms.nrows();
+    pipeline = self._pipeline(self._get_chunks(sub_mss,columns=readcols),readcols);
+    try:
+      for (ddid,irow_prev,subms,row0,nrows),cols in pipeline:
+        if progress_callback:
+          progress_callback(irow_prev+row0,nrow_tot);
+        self.dprintf(2,"summarizing ddid %d, rows %d:%d\n",ddid,row0,row0+nrows-1);
+        visflags = cols['FLAG']*self.LEGACY;
+        rowflags = cols['FLAG_ROW']*self.LEGACY;
+        if self.has_bitflags:
+          visflags |= cols['BITFLAG'];
+          rowflags |= cols['BITFLAG_ROW'];
+        # only count the bits that are actually raised somewhere in this chunk
+        used = int(numpy.bitwise_or.reduce(visflags.ravel())|numpy.bitwise_or.reduce(rowflags));
+        bits = [ bit for bit in range(32) if used&(1<<bit) ] + [ FlagSummary.LEGACY_BIT ];
+        viscounts,rowcounts = self._summary_counts(bits,visflags,rowflags);
+        summary.add(ddid,cols['ANTENNA1'],cols['ANTENNA2'],cols['TIME'],
+                    visflags[0].size if nrows else 0,bits,viscounts,rowcounts);
+    finally:
+      pipeline.close();
+    if progress_callback:
+      progress_callback(99,100);
+    summary.mtime = self._ms_mtime();
+    self._save_flag_summary(summary);
+    return summary;
+
+  # size of occupancy cubes above which occupancy() warns, if no memory budget is set
+  _OCCUPANCY_WARN_BYTES = 1024**3;
+
+  def occupancy (self,flagsets=None,legacy=True,timebin=FlagOccupancy.DEFAULT_TIMEBIN,chanbin=1,
+                 ddid=None,fieldid=None,antennas=None,baselines=None,time=None,reltime=None,taql=None,
+                 progress_callback=None,purr=False):
+    """Makes a flag occupancy cube (see Owlcat.FlagOccupancy) in a single pass through the selected subset
+    of the MS (ddid, fieldid, antennas, baselines, time, reltime, taql, as for xflag()). For every DDID, baseline,
+    block of chanbin channels and block of timebin seconds, this counts the visibilities with any of the flags
+    of each flagset raised. flagsets is a list of flagset names or flagmasks (default is all flagsets); if
+    legacy is True, the legacy FLAG column is included as flagset "+L".
+    The size of the cubes is estimated beforehand: if the Flagger has a memory budget, a RuntimeError is
+    raised when they would exceed it, otherwise a warning is printed if they exceed 1GB.
+    Returns FlagOccupancy object.
+    """;
+    if not self.purrpipe:
+      purr = False;
+    ms = self._reopen();
+    if flagsets is None:
+      flagsets = list(self.flagsets.names() or []);
+    else:
+      flagsets = list(flagsets);
+    if legacy:
+      flagsets.append("+L");
+    flagmasks = [ self.lookup_flagmask(fset) for fset in flagsets ];
+    if not self.has_bitflags and [ fm for fm in flagmasks if fm&self.BITMASK_ALL ]:
+      raise RuntimeError,"no BITFLAG column in this MS, can't get bitflag occupancy";
+    # baseline and time axes of the cube, reduced to the selection where this is easy to do
+    ant1,ant2 = self._row_index().baselines();
+    if antennas is not None:
+      blmask = numpy.in1d(ant1,antennas)|numpy.in1d(ant2,antennas);
+      ant1,ant2 = ant1[blmask],ant2[blmask];
+    if baselines is not None:
+      blmask = _baseline_rowmask(_baseline_lookup([ (int(p),int(q)) for p,q in baselines ]),ant1,ant2);
+      ant1,ant2 = ant1[blmask],ant2[blmask];
+    times = self._timeslot_index().times;
+    t0,t1 = times[0],times[-1];
+    for trange,offset in (time,0),(reltime,self._reltime_origin()):
+      if trange is not None:
+        t0 = t0 if trange[0] is None else max(t0,trange[0]+offset);
+        t1 = t1 if trange[1] is None else min(t1,trange[1]+offset);
+    ntime = max(int((t1-t0)//timebin)+1,1);
+    # largest number of timeslots in one time block, i.e. of rows of one baseline in a cell of the cube
+    times = times[(times>=t0)&(times<=t1)];
+    maxrows = numpy.bincount(numpy.minimum(((times-t0)//timebin).astype(int),ntime-1)).max() if len(times) else 1;
+    occ = FlagOccupancy.FlagOccupancy(flagsets,flagmasks,ant1,ant2,t0,ntime,timebin,chanbin,maxrows);
+    ms,ddids = self._select_subset(ms,ddid=ddid,fieldid=fieldid,antennas=antennas,baselines=baselines,
+                                   time=time,reltime=reltime,taql=taql,purr=purr);
+    sub_mss = self._get_submss(ms,ddids);
+    nbytes = sum([ occ.cube_nbytes(*self._get_datashape(subms)) for dd,irow_prev,subms in sub_mss if subms.nrows() ]);
+    self.dprintf(1,"occupancy: %d baselines x %d time blocks of up to %d timeslots, %d channels per block, %gMB of cubes\n",
+                 len(ant1),ntime,maxrows,occ.chanbin,nbytes/(1024.*1024));
+    if self.memory_budget and nbytes > self.memory_budget*1024*1024:
+      raise RuntimeError,"flag occupancy cubes would take %dMB, more than the %gMB memory budget. " \
+                         "Try a larger timebin or chanbin"%(nbytes//(1024*1024),self.memory_budget);
+    if not self.memory_budget and nbytes > self._OCCUPANCY_WARN_BYTES:
+      self.dprintf(0,"warning: flag occupancy cubes will take %dMB, consider a larger timebin or chanbin\n",
+                   nbytes//(1024*1024));
+    purr and self.purrpipe.comment("; making flag occupancy cube for flagsets %s."%", ".join(map(str,flagsets)));
+    readcols = [ 'ANTENNA1','ANTENNA2','TIME','FLAG' ];
+    if self.has_bitflags:
+      readcols += [ 'BITFLAG' ];
+    nrow_tot = ms.nrows();
+    pipeline = self._pipeline(self._get_chunks(sub_mss,columns=readcols),readcols);
+    try:
+      for (ddid,irow_prev,subms,row0,nrows),cols in pipeline:
+        if progress_callback:
+          progress_callback(irow_prev+row0,nrow_tot);
+        self.dprintf(2,"occupancy: ddid %d, rows %d:%d\n",ddid,row0,row0+nrows-1);
+        with self.profile.stage('flagmasks','FLAG',nrows):
+          visflags = cols['FLAG']*self.LEGACY;
+          if self.has_bitflags:
+            visflags |= cols['BITFLAG'];
+        with self.profile.stage('occupancy',None,nrows):
+          counts = numpy.empty(visflags.shape[:2]+(len(flagmasks),),numpy.int32);
+          for i,fm in enumerate(flagmasks):
+            counts[:,:,i] = ((visflags&fm)!=0).sum(2);
+          occ.add(ddid,cols['ANTENNA1'],cols['ANTENNA2'],cols['TIME'],visflags.shape[2],counts);
+    finally:
+      pipeline.close();
+    if progress_callback:
+      progress_callback(99,100);
+    return occ;
+
+  def _flag_versions (self,ms):
+    """Helper method. Opens the flag versions store of the MS (see Owlcat.FlagVersions), and checks
+    that it matches the MS.""";
+    columns = [ 'FLAG','FLAG_ROW' ] + ([ 'BITFLAG','BITFLAG_ROW' ] if self.has_bitflags else []);
+    fv = FlagVersions.FlagVersions(self.msname);
+    fv.init(ms.nrows(),dict([ (col,ms.getcol(col,0,1).dtype.str) for col in columns ]));
+    return fv;
+
+  def _version_blocks (self,ms,blocksize):
+    """Helper method for the flag versioning methods. Splits the MS into the fixed blocks of rows used by
+    the flag versions store. Returns dict of (ddid,iblock) -> (ddid,irow_prev,subms,row0,nrows) chunks.""";
+    chunks = {};
+    for ddid,irow_prev,subms in self._get_submss(ms):
+      for row0 in range(0,subms.nrows(),blocksize):
+        chunks[ddid,row0//blocksize] = ddid,irow_prev,subms,row0,min(blocksize,subms.nrows()-row0);
+    return chunks;
+
+  def _read_flag_changes (self,fv,chunks,update_base=False,progress_callback=None):
+    """Helper method for the flag versioning methods. Reads the flags of the MS block by block, and
+    compares them to the base flags of the versions store. Returns the delta of the MS against the base.
+    If update_base is True, the base is brought up to date with the MS.""";
+    columns = sorted(fv.columns.keys());
+    delta = {};
+    nrow_tot = self.ms.nrows();
+    pipeline = self._pipeline([ chunks[block] for block in sorted(chunks.keys()) ],columns);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows),cols in pipeline:
+        if progress_callback:
+          progress_callback(irow_prev+row0,nrow_tot);
+        block = ddid,row0//fv.blocksize;
+        base = fv.get_base(block);
+        packed = dict([ (col,FlagVersions.pack(cols[col])) for col in columns ]);
+        changed = FlagVersions.xor_deltas({ block:packed },{ block:base } if base else {});
+        if changed:
+          self.dprintf(3,"ddid %d rows %d:%d differ from the stored flags\n",ddid,row0,row0+nrows-1);
+          delta.update(changed);
+          if update_base:
+            fv.put_base(block,packed);
+    finally:
+      pipeline.close();
+    if progress_callback:
+      progress_callback(99,100);
+    return delta;
 
-    return totrows,sel_nrow,sel_nvis,nvis_A,nvis_B,nvis_C;
+  def _ms_flag_delta (self,fv,ms,update_base=False,progress_callback=None):
+    """Helper method for the flag versioning methods. Returns the delta of the MS against the base
+    flags of the versions store, reading the flags only if the MS has been modified since the base
+    was last brought up to date.""";
+    if fv.base_is_current(self._ms_mtime()):
+      self.dprint(2,"MS not modified since last snapshot or restore, not reading flags");
+      return {};
+    return self._read_flag_changes(fv,self._version_blocks(ms,fv.blocksize),update_base=update_base,
+                                   progress_callback=progress_callback);
 
+  def snapshot_flags (self,name,comment="",progress_callback=None,purr=True):
+    """Saves the current flags of the MS as a named flag version. Only the blocks of rows whose flags differ
+    from the previous version are stored, as compressed XOR deltas (see Owlcat.FlagVersions). The flags are
+    only read if the MS has been modified since the last snapshot or restore.
+    Returns the number of blocks stored.
+    """;
+    if not self.purrpipe:
+      purr = False;
+    self.sync();
+    ms = self._reopen(self.readwrite);
+    fv = self._flag_versions(ms);
+    if name in fv.names():
+      raise ValueError,"flag version '%s' already exists"%name;
+    mtime_taken = time.time();
+    mtime = self._ms_mtime();
+    msdelta = self._ms_flag_delta(fv,ms,update_base=True,progress_callback=progress_callback);
+    # delta against the latest version is the delta against the base, plus the base against the latest version
+    delta = FlagVersions.xor_deltas(msdelta,fv.delta_between(fv.base_version,fv.latest()));
+    fv.add_version(name,comment,delta,mtime,mtime_taken);
+    self.dprintf(1,"saved flag version '%s', %d blocks of rows changed\n",name,len(delta));
+    purr and self.purrpipe.title("Flagging").comment("Saved flag version '%s'."%name);
+    return len(delta);
+
+  def restore_flags (self,name,progress_callback=None,purr=True):
+    """Restores the flags of the MS to a named flag version. Only the blocks of rows whose flags differ
+    from that version are written. Changes to the flags since the last snapshot or restore are discarded
+    (finding them needs a pass through the MS).
+    Returns the number of blocks written.
+    """;
+    if not self.purrpipe:
+      purr = False;
+    self.sync();
+    ms = self._reopen(True);
+    fv = self._flag_versions(ms);
+    iversion = fv.find(name);
+    chunks = self._version_blocks(ms,fv.blocksize);
+    # blocks where the MS differs from the base, and blocks where the version differs from the base
+    msdelta = self._ms_flag_delta(fv,ms,progress_callback=progress_callback);
+    if msdelta:
+      self.dprintf(1,"%d blocks of rows modified since the last snapshot or restore, discarding these changes\n",len(msdelta));
+    delta = fv.delta_between(fv.base_version,iversion);
+    blocks = sorted(set(msdelta.keys())|set(delta.keys()));
+    datashapes = {};
+    for i,block in enumerate(blocks):
+      if progress_callback:
+        progress_callback(i,len(blocks));
+      ddid,irow_prev,subms,row0,nrows = chunks[block];
+      if ddid not in datashapes:
+        datashapes[ddid] = self._get_datashape(subms);
+      # flags of the version, as packed arrays. Columns missing from the dict are all zero
+      target = FlagVersions.xor_deltas({ block:fv.get_base(block) or {} },{ block:delta.get(block,{}) }).get(block,{});
+      putcols = [];
+      for col in set(msdelta.get(block,{}).keys())|set(delta.get(block,{}).keys()):
+        shape = (nrows,)+datashapes[ddid] if col in ('FLAG','BITFLAG') else (nrows,);
+        if col in target:
+          value = FlagVersions.unpack(target[col],shape,fv.columns[col]);
+        else:
+          value = numpy.zeros(shape,fv.columns[col]);
+        putcols.append((col,value));
+      self.dprintf(3,"restoring ddid %d rows %d:%d\n",ddid,row0,row0+nrows-1);
+      self._putcols(subms,row0,nrows,putcols);
+      fv.put_base(block,target);
+    # bitflags may have gone to the shadow store
+    self.sync();
+    self.ms.flush();
+    fv.set_base_state(iversion,self._ms_mtime());
+    if progress_callback:
+      progress_callback(99,100);
+    self.dprintf(1,"restored flag version '%s', %d blocks of rows written\n",name,len(blocks));
+    purr and self.purrpipe.title("Flagging").comment("Restored flag version '%s'."%name);
+    return len(blocks);
+
+  def diff_flags (self,name1,name2=None,progress_callback=None):
+    """Compares two named flag versions, or (if name2 is None) a flag version and the current flags of
+    the MS. Only the deltas in between are read, plus the flags of the MS if name2 is None and the MS has
+    been modified since the last snapshot or restore.
+    Returns dict of column -> number of values (visibilities or rows) that differ.
+    """;
+    ms = self._reopen(self.readwrite);
+    fv = self._flag_versions(ms);
+    iv1 = fv.find(name1);
+    if name2 is None:
+      delta = FlagVersions.xor_deltas(fv.delta_between(iv1,fv.base_version),
+                                      self._ms_flag_delta(fv,ms,progress_callback=progress_callback));
+    else:
+      delta = fv.delta_between(iv1,fv.find(name2));
+    counts = dict([ (col,0) for col in fv.columns ]);
+    for cols in delta.itervalues():
+      for col,data in cols.iteritems():
+        counts[col] += FlagVersions.count_changes(data,fv.columns[col]);
+    return counts;
+
+  def flag_versions (self):
+    """Returns list of (name,comment,time,nblocks) tuples describing the stored flag versions, where time is
+    the time of the snapshot, and nblocks is the number of blocks of rows changed since the previous version.""";
+    fv = FlagVersions.FlagVersions(self.msname);
+    return [ (v['name'],v['comment'],v['time'],v['nblocks']) for v in fv.versions ];
 
   def set_legacy_flags (self,flags,progress_callback=None,purr=True):
     """Fills the legacy FLAG/FLAG_ROW column by applying the specified flagmask
@@ -932,7 +2392,7 @@ class Flagger (Timba.dmi.verbosity):
     """;
     if not self.purrpipe:
       purr = False;
-    ms = self._reopen();
+    ms = self._reopen(True);
     if not self.has_bitflags:
       raise TypeError,"MS does not contain a BITFLAG column, cannot use bitflags""";
     if isinstance(flags,str):
@@ -956,57 +2416,526 @@ class Flagger (Timba.dmi.verbosity):
     # get list of per-DDID subsets
     sub_mss = self._get_submss(ms);
     nrow_tot = ms.nrows();
-    # go through rows of the MS in chunks
-    for ddid,irow_prev,ms in sub_mss:
-      self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
-      if progress_callback:
-        progress_callback(irow_prev,nrow_tot);
-      for row0 in range(0,ms.nrows(),self.chunksize):
+    # go through rows of the MS in chunks. Only the bitflag columns are read, and the outputs take their shapes
+    chunks = self._get_chunks(sub_mss,columns=['FLAG','FLAG_ROW','BITFLAG','BITFLAG_ROW']);
+    pipeline = self._pipeline(chunks,['BITFLAG','BITFLAG_ROW']);
+    # output buffers are reused, once the writes queued up behind them are done
+    buffers = _BufferRing(self.readahead+2);
+    # flagmask converted to the types of the bitflag columns, so that the AND can be done in place
+    masks = {};
+    try:
+      for (ddid,irow_prev,ms,row0,nrows),cols in pipeline:
+        if row0 == 0:
+          self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
         if progress_callback:
           progress_callback(irow_prev+row0,nrow_tot);
-        nrows = min(self.chunksize,ms.nrows()-row0);
         self.dprintf(2,"filling rows %d:%d\n",row0,row0+nrows-1);
-        bf = self._get_bitflag_col(ms,row0,nrows,ms.getcol('FLAG').shape);
-        bfr = ms.getcol('BITFLAG_ROW',row0,nrows);
-        ms.putcol('FLAG',(bf&flagmask).astype(Timba.array.dtype('bool')),row0,nrows);
-        ms.putcol('FLAG_ROW',(bfr&flagmask).astype(Timba.array.dtype('bool')),row0,nrows);
+        buffers.next();
+        with self.profile.stage('legacy',None,nrows):
+          putcols = [];
+          for col,bf in ('FLAG',cols['BITFLAG']),('FLAG_ROW',cols['BITFLAG_ROW']):
+            if bf.dtype not in masks:
+              masks[bf.dtype] = numpy.array(flagmask&self.BITMASK_ALL).astype(bf.dtype);
+            numpy.bitwise_and(bf,masks[bf.dtype],out=bf);
+            putcols.append((col,numpy.not_equal(bf,0,out=buffers.get(col,bf.shape,bool))));
+        pipeline.put(ms,row0,nrows,putcols);
+      pipeline.flush();
+    finally:
+      pipeline.close();
     if progress_callback:
       progress_callback(99,100);
 
   def clear_legacy_flags (self,progress_callback=None,purr=True):
-    """Clears the legacy FLAG/FLAG_ROW columns.
+    """Clears the legacy FLAG/FLAG_ROW columns. Nothing is read, see _fill_columns().
     """;
     if not self.purrpipe:
       purr = False;
-    ms = self._reopen();
+    ms = self._reopen(True);
     self.dprintf(1,"clearing legacy FLAG/FLAG_ROW column\n");
     purr and self.purrpipe.title("Flagging").comment("Clearing FLAG/FLAG_ROW columns");
-    # now go through MS and fill the column
-    # go through rows of the MS in chunks
-    shape = list(ms.getcol('FLAG',0,1).shape);
-    shape[0] = self.chunksize
-    fzero  = Timba.array.zeros(shape,dtype='bool');
-    frzero = Timba.array.zeros((self.chunksize,),dtype='bool');
-    # now go through MS and fill the column
-    # get list of per-DDID subsets
-    sub_mss = self._get_submss(ms);
+    self._fill_columns(ms,dict(FLAG=False,FLAG_ROW=False),progress_callback=progress_callback);
+
+  def _fill_columns (self,ms,values,progress_callback=None,taql=True):
+    """Helper method. Fills columns of the MS with constant values, given as a dict of column -> value,
+    in one write pass and without reading anything. If taql is True and TaQL commands are available,
+    this is done by a single UPDATE command inside casacore. Otherwise (or if the command fails, or if
+    the columns are in the shadow store), preallocated constant buffers are written chunk by chunk,
+    one set of buffers per DDID shape.""";
     nrow_tot = ms.nrows();
-    # go through each sub-MS, and through rows of the sub-MS in chunks
-    for ddid,irow_prev,ms in sub_mss:
-      self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
+    columns = sorted(values.keys());
+    if progress_callback:
+      progress_callback(0,nrow_tot);
+    if taql and TAQL and not (self._shadow is not None and set(columns)&set(FlagShadow.COLUMNS)):
+      def literal (value):
+        if isinstance(value,(bool,numpy.bool_)):
+          return "T" if value else "F";
+        return repr(value);
+      command = "UPDATE $1 SET " + ", ".join([ "%s=%s"%(col,literal(values[col])) for col in columns ]);
+      self.dprintf(2,"filling columns with TaQL command: %s\n",command);
+      try:
+        with self.profile.stage('fill',None,nrow_tot):
+          TAQL(command,tables=[ms]);
+      except Exception,exc:
+        self.dprintf(1,"TaQL command failed (%s), filling columns chunk by chunk\n",exc);
+      else:
+        if progress_callback:
+          progress_callback(99,100);
+        return;
+    sub_mss = self._get_submss(ms);
+    # per-DDID buffers of constant values. These are never modified, so writes can share them
+    buffers = {};
+    for ddid,irow_prev,subms,row0,nrows in self._get_chunks(sub_mss,columns=columns):
+      if row0 == 0:
+        self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
       if progress_callback:
-        progress_callback(irow_prev,nrow_tot);
-      for row0 in range(0,ms.nrows(),self.chunksize):
+        progress_callback(irow_prev+row0,nrow_tot);
+      self.dprintf(2,"filling rows %d:%d\n",row0,row0+nrows-1);
+      bufs = buffers.get(ddid);
+      if bufs is None or bufs[0][1].shape[0] < nrows:
+        # shapes and types are taken from the first row
+        bufs = buffers[ddid] = [];
+        for col in columns:
+          first = subms.getcol(col,0,1);
+          buf = numpy.empty((nrows,)+first.shape[1:],first.dtype);
+          buf.fill(values[col]);
+          bufs.append((col,buf));
+      self._putcols(subms,row0,nrows,[ (col,buf[:nrows]) for col,buf in bufs ]);
+    if progress_callback:
+      progress_callback(99,100);
+
+  def _get_corrtypes (self,ddid):
+    """Helper method. Returns the list of CORR_TYPE values of the given DATA_DESC_ID.""";
+    polids = TABLE(self.ms.getkeyword('DATA_DESCRIPTION'),ack=False).getcol('POLARIZATION_ID');
+    return list(TABLE(self.ms.getkeyword('POLARIZATION'),ack=False).getcol('CORR_TYPE')[polids[ddid]]);
+
+  def _get_baseline_chunks (self,sub_mss,columns,halo=None):
+    """Helper method for the native autoflaggers. Sorts each per-DDID subset returned by _get_submss()
+    by baseline and time, and splits it into chunks made up of whole baselines. A baseline with more
+    rows than the chunk size makes up a chunk by itself. Returns list of
+    (ddid,irow_prev,sorted_subms,row0,nrows,baselines) tuples, where baselines is a list of (i0,i1)
+    row ranges within the chunk, one per baseline.
+    If halo is not None, a baseline with more rows than the chunk size is instead split into
+    consecutive windows of time, each one read in with up to 'halo' extra rows on either side, so
+    that the chunks stay bounded in size. The tuples then carry two more items: a (c0,c1) range of
+    "core" rows within the chunk, which are the rows the chunk is responsible for, and a flag which
+    is True if the chunk continues the baseline of the previous chunk.
+    """;
+    chunks = [];
+    for ddid,irow_prev,subms in sub_mss:
+      if not subms.nrows():
+        continue;
+      subms = subms.sort('ANTENNA1,ANTENNA2,TIME');
+      a1 = subms.getcol('ANTENNA1');
+      a2 = subms.getcol('ANTENNA2');
+      bounds = [ 0 ] + list(numpy.flatnonzero((a1[1:]!=a1[:-1])|(a2[1:]!=a2[:-1]))+1) + [ len(a1) ];
+      chunksize = self._get_chunksize(subms,ddid,columns);
+      row0 = 0;
+      baselines = [];
+      for b0,b1 in zip(bounds[:-1],bounds[1:]):
+        if baselines and b1-row0 > chunksize:
+          chunks.append(self._whole_baseline_chunk(ddid,irow_prev,subms,row0,b0-row0,baselines,halo));
+          row0 = b0;
+          baselines = [];
+        if halo is not None and b1-b0 > chunksize:
+          # split baseline into windows, with halos
+          window = max(chunksize-2*halo,1);
+          for c0 in range(b0,b1,window):
+            c1 = min(c0+window,b1);
+            r0,r1 = max(c0-halo,b0),min(c1+halo,b1);
+            chunks.append((ddid,irow_prev,subms,r0,r1-r0,[(0,r1-r0)],(c0-r0,c1-r0),c0>b0));
+          row0 = b1;
+          continue;
+        baselines.append((b0-row0,b1-row0));
+      if baselines:
+        chunks.append(self._whole_baseline_chunk(ddid,irow_prev,subms,row0,len(a1)-row0,baselines,halo));
+    return chunks;
+
+  @staticmethod
+  def _whole_baseline_chunk (ddid,irow_prev,subms,row0,nrows,baselines,halo):
+    """Helper method for _get_baseline_chunks(). Makes the tuple for a chunk of whole baselines.""";
+    chunk = (ddid,irow_prev,subms,row0,nrows,baselines);
+    return chunk if halo is None else chunk+((0,nrows),False);
+
+  def _put_autoflags (self,pipeline,ms,row0,nrows,cols,mask,flag,fill_legacy=None):
+    """Helper method for the native autoflaggers. Given a chunk of rows (with cols holding the
+    FLAG, FLAG_ROW, BITFLAG and BITFLAG_ROW columns as read in), raises the flag bitmask for the
+    visibilities in the boolean mask, recomputes the row flags, refills the legacy flags if fill_legacy
+    is not None, and writes back whatever has changed. Returns number of newly flagged visibilities.
+    """;
+    lf,lfr,bf,bfr = cols['FLAG'],cols['FLAG_ROW'],cols['BITFLAG'],cols['BITFLAG_ROW'];
+    nflagged = (mask&((bf&flag)==0)).sum();
+    # raise the flagset bit, and recompute it in the row flags
+    bf1 = numpy.where(mask,bf|flag,bf).astype(bf.dtype);
+    bfr1 = ((bfr&~flag)|(_reduce_rowflags(bf1)&flag)).astype(bfr.dtype);
+    putcols = [ ('BITFLAG',bf1,bf),('BITFLAG_ROW',bfr1,bfr) ];
+    if fill_legacy is not None:
+      lf1 = (bf1&fill_legacy)!=0;
+      lfr1 = (bfr1&fill_legacy)!=0;
+      if fill_legacy&self.LEGACY:
+        lf1 |= lf;
+        lfr1 |= lfr;
+      putcols += [ ('FLAG',lf1,lf),('FLAG_ROW',lfr1,lfr) ];
+    self._put_changed(pipeline,ms,row0,nrows,putcols);
+    return nflagged;
+
+  def _autoflag (self,label,flagset,kernel,column='DATA',fignore=False,create=True,fill_legacy=None,
+                 ddid=None,fieldid=None,antennas=None,baselines=None,time=None,reltime=None,taql=None,
+                 channels=None,halo=0,progress_callback=None,purr=False):
+    """Helper method driving the native autoflaggers. Goes through the selected subset of the MS in
+    chunks of whole baselines, sorted in time (see _get_baseline_chunks()). For each chunk, calls
+    kernel(ddid,data,flags,baselines), where data is the (nrows,nchan,ncorr) data column, flags is a
+    boolean array of existing flags (any bitflag or legacy flag raised, or None if fignore is set),
+    and baselines is a list of per-baseline (i0,i1) row ranges. The kernel returns a boolean array
+    of visibilities to be flagged, which are then flagged with the given flagset (created as needed).
+    Baselines too long for one chunk are split into windows of time, read in with 'halo' rows either
+    side, so the chunk size (or memory budget) holds. The kernel sees the whole window, but only the
+    flags of its core rows are written. The leading halo is given the existing flags as read in by
+    the previous window, so the results do not depend on whether its flags have been written yet.
+    If channels is given (as for xflag()), the kernel only sees the selected channels.
+    Returns (nvis,nflagged) tuple: number of visibilities processed, and number newly flagged.
+    """;
+    if not self.purrpipe:
+      purr = False;
+    ms = self._reopen(True);
+    if not self.has_bitflags:
+      raise TypeError,"MS does not contain a BITFLAG column, cannot use flagsets";
+    flag = self.lookup_flagmask(flagset,create=create);
+    fill_legacy = self.lookup_flagmask(fill_legacy);
+    self.dprintf(2,"%s: flagset %s corresponds to bitmask %s\n",label,flagset,self.flagmaskstr(flag));
+    purr and self.purrpipe.title("Flagging").comment("Running %s into flagset %s"%(label,flagset),endline=False);
+    ms,ddids = self._select_subset(ms,ddid=ddid,fieldid=fieldid,antennas=antennas,baselines=baselines,
+                                   time=time,reltime=reltime,taql=taql,purr=purr);
+    if channels is not None:
+      channels = _make_slice_list(channels,'channels');
+      purr and self.purrpipe.comment("; channels are %s"%channels,endline=False);
+    purr and self.purrpipe.comment(".");
+    readcols = [ 'FLAG','FLAG_ROW','BITFLAG','BITFLAG_ROW',column ];
+    chunks = self._get_baseline_chunks(self._get_submss(ms,ddids),readcols,halo=halo);
+    nrow_tot = ms.nrows();
+    nvis = nflagged = 0;
+    # existing flags of the last 'halo' rows of the baseline as originally read in (see grow_flags())
+    carry = None;
+    pipeline = self._pipeline(chunks,readcols);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows,baselines,(c0,c1),cont),cols in pipeline:
         if progress_callback:
-          progress_callback(row0+irow_prev,ms.nrows());
-        nrows = min(self.chunksize,ms.nrows()-row0);
-        self.dprintf(2,"filling rows %d:%d\n",row0,row0+nrows-1);
-        fl = ms.getcol('FLAG',row0,nrows);
-        fl[:,:,:] = False;
-        ms.putcol('FLAG',fl,row0,nrows);
-        ms.putcol('FLAG_ROW',Timba.array.zeros((nrows,),dtype='bool'),row0,nrows);
+          progress_callback(irow_prev+row0,nrow_tot);
+        self.dprintf(2,"%s: ddid %d, rows %d:%d (%d baselines)\n",label,ddid,row0+c0,row0+c1-1,len(baselines));
+        data = cols[column];
+        flags = None;
+        if not fignore:
+          flags = cols['FLAG']|(cols['BITFLAG']!=0);
+          if cont and c0:
+            flags[:c0] = carry[-c0:];
+          if halo:
+            carry = numpy.concatenate((carry,flags[c0:c1]))[-halo:] if cont else flags[c0:c1][-halo:];
+        chans = None;
+        if channels is not None:
+          chans = numpy.unique(numpy.concatenate([ numpy.arange(data.shape[1])[sl] for sl in channels ]));
+          data = data[:,chans];
+          flags = flags if flags is None else flags[:,chans];
+        mask = kernel(ddid,data,flags,baselines)[c0:c1];
+        nvis += mask.size;
+        if chans is not None:
+          mask1 = numpy.zeros((c1-c0,)+cols[column].shape[1:],bool);
+          mask1[:,chans] = mask;
+          mask = mask1;
+        core = dict([ (col,value[c0:c1]) for col,value in cols.iteritems() ]);
+        nflagged += self._put_autoflags(pipeline,ms,row0+c0,c1-c0,core,mask,flag,fill_legacy);
+      pipeline.flush();
+    finally:
+      pipeline.close();
+    if progress_callback:
+      progress_callback(99,100);
+    self.dprintf(1,"%s: %d of %d visibilities newly flagged\n",label,nflagged,nvis);
+    return nvis,nflagged;
+
+  def median_flag (self,flagset="medflag",axis="time",thr=5,hw=10,rowthr=10,rowhw=6,norow=False,
+                   column='DATA',expr='ABS I',fignore=False,**kw):
+    """Native sliding-median autoflagger, replacing the settimemed (axis="time") and setfreqmed
+    (axis="freq") methods of the glish autoflagger, and taking the same parameters. Works per
+    baseline, on the time/frequency plane of real values given by expr (see Owlcat.Autoflag).
+    Flags are raised in the given flagset, which is created as needed. Other keywords select a
+    subset of the MS (ddid, fieldid, antennas, baselines, time, reltime, taql, channels), or are passed
+    on to _autoflag() (fill_legacy, create, progress_callback, purr).
+    Baselines too long for one chunk are split into windows of time, with enough halo rows (hw+rowhw
+    for the time median, rowhw for the frequency median) that the flags come out the same.
+    Returns (nvis,nflagged) tuple: number of visibilities processed, and number newly flagged.
+    """;
+    if axis not in ("time","freq"):
+      raise ValueError,"invalid median axis '%s', must be 'time' or 'freq'"%axis;
+    iaxis = 0 if axis == "time" else 1;
+    # parsed expressions, per DDID
+    exprs = {};
+    def kernel (ddid,data,flags,baselines):
+      if ddid not in exprs:
+        exprs[ddid] = Autoflag.parse_expr(expr,self._get_corrtypes(ddid));
+      func,terms = exprs[ddid];
+      icorrs = [ icorr for sign,icorr in terms ];
+      values = Autoflag.eval_expr(data,func,terms);
+      if flags is not None:
+        values[flags[:,:,icorrs].any(2)] = numpy.nan;
+      planeflags = numpy.zeros(values.shape,bool);
+      for i0,i1 in baselines:
+        fl,rowfl = Autoflag.median_flag(values[i0:i1],iaxis,thr=thr,hw=hw,rowthr=rowthr,rowhw=rowhw,norow=norow);
+        fl[rowfl,:] = True;
+        planeflags[i0:i1] = fl;
+      # flags go to all correlations that make up the expression
+      mask = numpy.zeros(data.shape,bool);
+      mask[:,:,icorrs] = planeflags[:,:,numpy.newaxis];
+      return mask;
+    # rows whose flags depend on a given row: the median window along time, and the window of row noise levels
+    halo = (hw if axis == "time" else 0) + (0 if norow else rowhw);
+    return self._autoflag("%s-median flagger"%axis,flagset,kernel,column=column,fignore=fignore,halo=halo,**kw);
+
+  def sumthreshold_flag (self,flagset="sumthreshold",thr=6,rho=1.5,max_window=64,niter=2,
+                         corrs=None,allcorr=False,column='DATA',fignore=False,**kw):
+    """SumThreshold RFI flagger (see Owlcat.Autoflag.sumthreshold()). Works per baseline and
+    correlation, on the time/frequency plane of amplitudes. thr is the base threshold in units
+    of the noise, rho the threshold reduction for each doubling of the window size, max_window the
+    largest window size, niter the number of background/noise estimation iterations.
+    corrs is a list of correlation indices to flag (default is all). If allcorr is set, flags
+    raised in any correlation are applied to all correlations.
+    Flags are raised in the given flagset, which is created as needed. Other keywords select a
+    subset of the MS (ddid, fieldid, antennas, baselines, time, reltime, taql, channels), or are passed
+    on to _autoflag() (fill_legacy, create, progress_callback, purr).
+    Baselines too long for one chunk are split into windows of time, with max_window halo rows either
+    side. The background and noise are then estimated per window rather than per baseline.
+    Returns (nvis,nflagged) tuple: number of visibilities processed, and number newly flagged.
+    """;
+    def kernel (ddid,data,flags,baselines):
+      mask = numpy.zeros(data.shape,bool);
+      for icorr in (range(data.shape[2]) if corrs is None else corrs):
+        for i0,i1 in baselines:
+          mask[i0:i1,:,icorr] = Autoflag.sumthreshold_flag(abs(data[i0:i1,:,icorr]),
+              flags[i0:i1,:,icorr] if flags is not None else None,
+              thr=thr,rho=rho,max_window=max_window,niter=niter);
+      if allcorr:
+        mask |= mask.any(2)[:,:,numpy.newaxis];
+      return mask;
+    return self._autoflag("SumThreshold flagger",flagset,kernel,column=column,fignore=fignore,halo=max_window,**kw);
+
+  def grow_flags (self,flagmask,grow_time=0,grow_freq=0,threshold_frac=None,flag=None,create=False,fill_legacy=None,
+                  ddid=None,fieldid=None,antennas=None,baselines=None,time=None,reltime=None,taql=None,
+                  progress_callback=None,purr=False):
+    """Grows flags on the per-baseline time/frequency planes of every correlation (see Owlcat.Autoflag.grow_flags()).
+    Visibilities with any of the flags in flagmask (a flagmask or flagset name, optionally "+L") raised
+    are extended by grow_time timeslots (i.e. rows of the baseline) and grow_freq channels either way.
+    Then, if threshold_frac is given, every row with more than that fraction of its visibilities (over
+    all channels and correlations) flagged is flagged entirely, in all correlations. The grown flags
+    are raised using the flag bitmask (default is the bitflags of flagmask). If this includes the
+    legacy bit, the legacy flags are raised as well.
+    Other keywords select a subset of the MS (ddid, fieldid, antennas, baselines, time, reltime, taql), or
+    are as for _autoflag() (create, fill_legacy, progress_callback, purr).
+    The MS is processed in chunks of whole baselines, sorted in time. Baselines too long for one chunk
+    are split into windows of time, with grow_time rows of halo either side.
+    Returns (nvis,nflagged) tuple: number of visibilities processed, and number newly flagged.
+    """;
+    if not self.purrpipe:
+      purr = False;
+    ms = self._reopen(True);
+    if not self.has_bitflags:
+      raise TypeError,"MS does not contain a BITFLAG column, cannot use flagsets";
+    flagmask = self.lookup_flagmask(flagmask);
+    flag = flagmask&self.BITMASK_ALL if flag is None else self.lookup_flagmask(flag,create=create);
+    fill_legacy = self.lookup_flagmask(fill_legacy);
+    if not flag&self.BITMASK_ALL:
+      raise ValueError,"no flagset specified to raise grown flags in";
+    if flag&self.LEGACY:
+      fill_legacy = (fill_legacy or 0)|flag;
+    flag &= self.BITMASK_ALL;
+    bitmask = flagmask&self.BITMASK_ALL;
+    label = "flag growing";
+    self.dprintf(2,"%s: growing %s by %d timeslots, %d channels, threshold %s, into %s\n",label,
+                 self.flagmaskstr(flagmask),grow_time,grow_freq,threshold_frac,self.flagmaskstr(flag));
+    purr and self.purrpipe.title("Flagging").comment("Growing flags %s by %d timeslots and %d channels%s"%(
+        self.flagmaskstr(flagmask),grow_time,grow_freq,
+        ", with threshold %g"%threshold_frac if threshold_frac is not None else ""),endline=False);
+    ms,ddids = self._select_subset(ms,ddid=ddid,fieldid=fieldid,antennas=antennas,baselines=baselines,
+                                   time=time,reltime=reltime,taql=taql,purr=purr);
+    purr and self.purrpipe.comment(".");
+    readcols = [ 'FLAG','FLAG_ROW','BITFLAG','BITFLAG_ROW' ];
+    chunks = self._get_baseline_chunks(self._get_submss(ms,ddids),readcols,halo=grow_time);
+    nrow_tot = ms.nrows();
+    nvis = nflagged = 0;
+    # flags of the last grow_time rows of the baseline as originally read in. Chunks that continue
+    # a baseline must use these for their leading halo, since by the time they are read in, the
+    # write of the previous chunk may or may not have gone through
+    carry = None;
+    pipeline = self._pipeline(chunks,readcols);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows,baselines,(c0,c1),cont),cols in pipeline:
+        if progress_callback:
+          progress_callback(irow_prev+row0,nrow_tot);
+        self.dprintf(2,"%s: ddid %d, rows %d:%d (%d baselines)\n",label,ddid,row0+c0,row0+c1-1,len(baselines));
+        with self.profile.stage('grow',None,c1-c0):
+          flags = (cols['BITFLAG']&bitmask)!=0;
+          flags |= ((cols['BITFLAG_ROW']&bitmask)!=0)[:,numpy.newaxis,numpy.newaxis];
+          if flagmask&self.LEGACY:
+            flags |= cols['FLAG'];
+            flags |= cols['FLAG_ROW'][:,numpy.newaxis,numpy.newaxis];
+          if cont and c0:
+            flags[:c0] = carry[-c0:];
+          if grow_time:
+            carry = numpy.concatenate((carry,flags[c0:c1]))[-grow_time:] if cont else flags[c0:c1][-grow_time:];
+          # per-row bounds of the baseline that each row belongs to
+          lower = numpy.zeros(nrows,int);
+          upper = numpy.zeros(nrows,int);
+          for i0,i1 in baselines:
+            lower[i0:i1] = i0;
+            upper[i0:i1] = i1;
+          mask = Autoflag.grow_flags(flags,grow_time,grow_freq,threshold_frac,lower,upper)[c0:c1];
+          nvis += mask.size;
+        core = dict([ (col,value[c0:c1]) for col,value in cols.iteritems() ]);
+        nflagged += self._put_autoflags(pipeline,ms,row0+c0,c1-c0,core,mask,flag,fill_legacy);
+      pipeline.flush();
+    finally:
+      pipeline.close();
     if progress_callback:
       progress_callback(99,100);
+    self.dprintf(1,"%s: %d of %d visibilities newly flagged\n",label,nflagged,nvis);
+    return nvis,nflagged;
+
+  def uvbin_flag (self,flagset="uvbin",thr=0.001,minpop=0,nbins=50,column='DATA',expr='ABS I',fignore=False,
+                  ddid=None,plotchan=None,econoplot=None,create=True,progress_callback=None,purr=False,**kw):
+    """Native UV-binning autoflagger, replacing the setuvbin method of the glish autoflagger, and
+    taking the same parameters (plotchan and econoplot are accepted for compatibility, but no plots
+    are made). Visibilities are binned per channel by UV distance and by the real value given by
+    expr (see Owlcat.Autoflag), using nbins bins along each axis (or an [nuv,nval] pair). Bins holding
+    fewer than minpop points, and the least populated bins which between them hold no more than
+    a fraction thr of all points, are flagged (see Owlcat.Autoflag.uvbin_lowpop()).
+    Works in three passes over the data: the first finds the ranges of UV distance and value, so that
+    the histograms get exactly nbins bins along each axis, the second accumulates the histograms, and
+    the third raises flags in the given flagset, which is created as needed. If the Flagger was created with workers>1,
+    DDIDs are processed in parallel worker processes. Other keywords select a subset of the MS
+    (fieldid, antennas, time, reltime, taql), or set fill_legacy.
+    Returns (nvis,nflagged) tuple: number of visibilities processed, and number newly flagged.
+    """;
+    if not self.purrpipe:
+      purr = False;
+    ms = self._reopen(True);
+    ddids = self._parse_ddids(ms,ddid);
+    kw.update(flagset=flagset,thr=thr,minpop=minpop,nbins=nbins,column=column,expr=expr,fignore=fignore);
+    if self.workers < 2 or len(ddids) < 2 or self._shadow is not None:
+      return self._uvbin_flag(ddid=ddids,create=create,progress_callback=progress_callback,purr=purr,**kw);
+    # look up the flagset here, so that worker processes don't race to create it
+    self.lookup_flagmask(flagset,create=create);
+    self.dprintf(1,"running UV-bin flagger on %d DDIDs in %d worker processes\n",len(ddids),self.workers);
+    purr and self.purrpipe.title("Flagging").comment("Running UV-bin flagger into flagset %s, using %d parallel jobs."%(flagset,len(ddids)));
+    # detach from the MS while workers are running, they will open their own table handles
+    self.close();
+    import multiprocessing
+    pool = multiprocessing.Pool(min(self.workers,len(ddids)));
+    try:
+      results = [];
+      args = [ (self.msname,self.get_verbose(),self.chunksize,self.memory_budget,self.readahead,dd,kw)
+               for dd in ddids ];
+      for res in pool.imap_unordered(_uvbin_job,args):
+        results.append(res);
+        if progress_callback:
+          progress_callback(len(results),len(ddids));
+    finally:
+      pool.close();
+      pool.join();
+    return tuple([ sum(x) for x in zip(*results) ]) if results else (0,0);
+
+  def _uvbin_flag (self,flagset,thr,minpop,nbins,column,expr,fignore,create=True,fill_legacy=None,
+                   ddid=None,fieldid=None,antennas=None,time=None,reltime=None,taql=None,
+                   progress_callback=None,purr=False):
+    """Internal _uvbin_flag method does the actual work of uvbin_flag().""";
+    ms = self._reopen(True);
+    if not self.has_bitflags:
+      raise TypeError,"MS does not contain a BITFLAG column, cannot use flagsets";
+    flag = self.lookup_flagmask(flagset,create=create);
+    fill_legacy = self.lookup_flagmask(fill_legacy);
+    self.dprintf(2,"UV-bin flagger: flagset %s corresponds to bitmask %s\n",flagset,self.flagmaskstr(flag));
+    purr and self.purrpipe.title("Flagging").comment("Running UV-bin flagger into flagset %s"%flagset,endline=False);
+    ms,ddids = self._select_subset(ms,ddid=ddid,fieldid=fieldid,antennas=antennas,
+                                   time=time,reltime=reltime,taql=taql,purr=purr);
+    purr and self.purrpipe.comment(".");
+    sub_mss = self._get_submss(ms,ddids);
+    nrow_tot = ms.nrows();
+    # parsed expressions, per DDID
+    exprs = {};
+    def evaluate (ddid,cols):
+      """Returns the UV distances, values, valid points and correlation indices of a chunk""";
+      if ddid not in exprs:
+        exprs[ddid] = Autoflag.parse_expr(expr,self._get_corrtypes(ddid));
+      func,terms = exprs[ddid];
+      icorrs = [ icorr for sign,icorr in terms ];
+      values = Autoflag.eval_expr(cols[column],func,terms);
+      valid = numpy.isfinite(values);
+      if not fignore:
+        valid &= ~(cols['FLAG']|(cols['BITFLAG']!=0))[:,:,icorrs].any(2);
+      uvw = cols['UVW'];
+      return numpy.sqrt(uvw[:,0]**2+uvw[:,1]**2),values,valid,icorrs;
+    # first pass: find the ranges of UV distance and value of the valid points, per DDID, so that the
+    # histograms can be set up with exactly nbins bins along each axis
+    ranges = {};
+    readcols = [ 'UVW',column ] + ([] if fignore else [ 'FLAG','BITFLAG' ]);
+    pipeline = self._pipeline(self._get_chunks(sub_mss,columns=readcols),readcols);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows),cols in pipeline:
+        if progress_callback:
+          progress_callback((irow_prev+row0)//3,nrow_tot);
+        self.dprintf(2,"UV-bin flagger: finding ranges for ddid %d, rows %d:%d\n",ddid,row0,row0+nrows-1);
+        uvdist,values,valid,icorrs = evaluate(ddid,cols);
+        rows,chans = numpy.nonzero(valid);
+        if len(rows):
+          x = uvdist[rows];
+          y = values[rows,chans];
+          rng = [ x.min(),x.max(),y.min(),y.max() ];
+          if ddid in ranges:
+            rng = [ min(a,b) if i%2 == 0 else max(a,b) for i,(a,b) in enumerate(zip(ranges[ddid],rng)) ];
+          ranges[ddid] = rng;
+    finally:
+      pipeline.close();
+    # second pass: accumulate the histograms, per DDID. DDIDs with no valid points get none
+    histograms = {};
+    pipeline = self._pipeline(self._get_chunks(sub_mss,columns=readcols),readcols);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows),cols in pipeline:
+        if progress_callback:
+          progress_callback((nrow_tot+irow_prev+row0)//3,nrow_tot);
+        if ddid not in ranges:
+          continue;
+        self.dprintf(2,"UV-bin flagger: binning ddid %d, rows %d:%d\n",ddid,row0,row0+nrows-1);
+        uvdist,values,valid,icorrs = evaluate(ddid,cols);
+        if ddid not in histograms:
+          rng = ranges[ddid];
+          histograms[ddid] = Autoflag.UVBinHistogram(values.shape[1],nbins,rng[:2],rng[2:]);
+          self.dprintf(2,"UV-bin flagger: ddid %d bin widths are %g (UV distance), %g (value)\n",ddid,
+                       *histograms[ddid].bin_widths());
+        histograms[ddid].add(uvdist,values,valid);
+    finally:
+      pipeline.close();
+    lowpop = dict([ (dd,Autoflag.uvbin_lowpop(hist.counts,thr,minpop).ravel()) for dd,hist in histograms.iteritems() ]);
+    # third pass: flag points falling into the selected bins
+    readcols = [ 'FLAG','FLAG_ROW','BITFLAG','BITFLAG_ROW','UVW',column ];
+    nvis = nflagged = 0;
+    pipeline = self._pipeline(self._get_chunks(sub_mss,columns=readcols),readcols);
+    try:
+      for (ddid,irow_prev,ms,row0,nrows),cols in pipeline:
+        if progress_callback:
+          progress_callback((2*nrow_tot+irow_prev+row0)//3,nrow_tot);
+        self.dprintf(2,"UV-bin flagger: flagging ddid %d, rows %d:%d\n",ddid,row0,row0+nrows-1);
+        uvdist,values,valid,icorrs = evaluate(ddid,cols);
+        planeflags = numpy.zeros(values.shape,bool);
+        if ddid in lowpop and lowpop[ddid].any():
+          rows,chans = numpy.nonzero(valid);
+          planeflags[rows,chans] = lowpop[ddid][histograms[ddid].bin_index(chans,uvdist[rows],values[rows,chans])];
+        # flags go to all correlations that make up the expression
+        mask = numpy.zeros(cols[column].shape,bool);
+        mask[:,:,icorrs] = planeflags[:,:,numpy.newaxis];
+        nvis += mask.size;
+        nflagged += self._put_autoflags(pipeline,ms,row0,nrows,cols,mask,flag,fill_legacy);
+      pipeline.flush();
+    finally:
+      pipeline.close();
+    if progress_callback:
+      progress_callback(99,100);
+    self.dprintf(1,"UV-bin flagger: %d of %d visibilities newly flagged\n",nflagged,nvis);
+    return nvis,nflagged;
 
   def autoflagger (self,*args,**kw):
     return Flagger.AutoFlagger(self,*args,**kw);
@@ -1015,6 +2944,8 @@ class Flagger (Timba.dmi.verbosity):
     def __init__ (self,flagger,load=False):
       self.flagger = flagger;
       self._cmds = [];
+      # list of (methodname,kwargs) pairs, for use by the native autoflagger. None if commands were loaded from file
+      self._methods = [];
       if load:
         if isinstance(load,bool):
           load = 'default.af';
@@ -1025,6 +2956,7 @@ class Flagger (Timba.dmi.verbosity):
 
     def reset (self):
       self._cmds = [];
+      self._methods = [];
 
     def setdata (self,chanstart=None,chanend=None,chanstep=None,spwid=None,fieldid=None,msselect=None):
       args = [];
@@ -1081,18 +3013,23 @@ class Flagger (Timba.dmi.verbosity):
             args.append("%s=%s"%(kw,format%value));
       return "af.%s(%s);"%(methodname,','.join(args));
 
+    def _method (self,methodname,kw):
+      self._cmd(self._setmethod(methodname,kw));
+      if self._methods is not None:
+        self._methods.append((methodname,kw));
+
     def settimemed (self,**kw):
-      self._cmd(self._setmethod('settimemed',kw));
+      self._method('settimemed',kw);
     def setfreqmed (self,**kw):
-      self._cmd(self._setmethod('setfreqmed',kw));
+      self._method('setfreqmed',kw);
     def setnewtimemed (self,**kw):
-      self._cmd(self._setmethod('setnewtimemed',kw));
+      self._method('setnewtimemed',kw);
     def setsprej (self,**kw):
-      self._cmd(self._setmethod('setsprej',kw));
+      self._method('setsprej',kw);
     def setuvbin (self,**kw):
-      self._cmd(self._setmethod('setuvbin',kw));
+      self._method('setuvbin',kw);
     def setselect (self,**kw):
-      self._cmd(self._setmethod('setselect',kw));
+      self._method('setselect',kw);
     def setdata (self,**kw):
       if kw.get("nchan",None) is not None:
         kw["mode"] = "channel";
@@ -1100,10 +3037,145 @@ class Flagger (Timba.dmi.verbosity):
       # causes the flagger to select on everything except channels
       elif [ x for x in kw.itervalues() if x is not None ]:
         kw["mode"] = "spwids";
-      self._cmd(self._setmethod('setdata',kw));
+      self._method('setdata',kw);
+
+    # methods supported by the native autoflagger: name -> (Flagger method, extra arguments)
+    _native_methods = dict(settimemed=('median_flag',dict(axis='time')),
+                           setfreqmed=('median_flag',dict(axis='freq')),
+                           setnewtimemed=('median_flag',dict(axis='time')),
+                           setuvbin=('uvbin_flag',{}));
+
+    # setdata() and setselect() arguments with a native equivalent: name -> Flagger selection argument.
+    # spwid is converted into a list of DDIDs, and chan into a list of channel slices
+    _native_setdata = dict(spwid='ddid',field='fieldid',msselect='taql',mode=None);
+    _native_setselect = dict(spwid='ddid',field='fieldid',ant='antennas',baseline='baselines',
+                             timerng='time',chan='channels',corr='corrs',unflag=None);
+
+    # run() arguments that only apply to glish: plotting ones are ignored by the native autoflagger,
+    # reset is handled by clearing the flagset, and trial has no native equivalent
+    _native_run_ignored = ('plotscr','plotdev','devfile');
+
+    def _native_selection (self,methodname,args,unsupported):
+      """Helper method: converts the arguments of a setdata() or setselect() call into a dict of
+      Flagger selection arguments. Arguments with no native equivalent are added to the unsupported list.""";
+      argmap = getattr(self,'_native_%s'%methodname);
+      selection = {};
+      for key,value in args.iteritems():
+        if key not in argmap:
+          unsupported.append("%s(%s)"%(methodname,key));
+          continue;
+        name = argmap[key];
+        if name is None:
+          continue;
+        if key in ('spwid','field','ant','corr') and not isinstance(value,(list,tuple)):
+          value = [ value ];
+        if key == 'spwid':
+          ms = self.flagger.ms or self.flagger._reopen();
+          spws = TABLE(ms.getkeyword('DATA_DESCRIPTION'),ack=False).getcol('SPECTRAL_WINDOW_ID');
+          value = [ ddid for ddid,spw in enumerate(spws) if spw in value ];
+        elif key == 'timerng':
+          if len(value) != 2 or [ t for t in value if isinstance(t,str) ]:
+            unsupported.append("%s(timerng=%s)"%(methodname,value));
+            continue;
+        elif key == 'corr':
+          if [ c for c in value if isinstance(c,str) ]:
+            unsupported.append("%s(corr=%s)"%(methodname,value));
+            continue;
+        elif key == 'chan':
+          # (first,last) channel pairs: lists are passed to glish as is, so are 1-based, while
+          # integer arrays are 0-based (see _format_2N())
+          if isinstance(value,(list,tuple)):
+            value = numpy.array(value,int).reshape((-1,2)) - 1;
+          else:
+            value = numpy.asarray(value,int).reshape((-1,2));
+          value = [ slice(c0,c1+1) for c0,c1 in value ];
+        selection[name] = value;
+      return selection;
 
-    def run (self,wait=True,cmdfile=None,purr=True,**kw):
-      if not self.purrpipe:
+    def _native_plan (self,flagset):
+      """Helper method: converts the methods set up so far into a list of (Flagger method,arguments)
+      calls. Returns (calls,unsupported) tuple, where unsupported is a list of the methods and arguments
+      with no native equivalent. setdata() restricts all subsequent methods to its selection, and
+      setselect() becomes an xflag() of its selection.""";
+      calls = [];
+      unsupported = [];
+      selection = {};
+      for name,args in self._methods:
+        args = dict([ (key,value) for key,value in args.iteritems() if value is not None ]);
+        if name == 'setdata':
+          selection = self._native_selection(name,args,unsupported);
+        elif name == 'setselect':
+          args1 = selection.copy();
+          args1.update(self._native_selection(name,args,unsupported));
+          if args.get('unflag'):
+            args1['unflag'] = flagset;
+          else:
+            args1.update(flag=flagset,create=True);
+          calls.append(('xflag',args1));
+        elif name in self._native_methods:
+          funcname,extra_args = self._native_methods[name];
+          args.update(extra_args);
+          args.update(selection);
+          calls.append((funcname,args));
+        else:
+          unsupported.append("%s()"%name);
+      return calls,unsupported;
+
+    def run_native (self,flagset='autoflag',purr=True,reset=False,**kw):
+      """Runs the autoflag methods set up so far with the native autoflagger (see e.g. Flagger.median_flag())
+      instead of glish. Flags are raised in the given flagset, which is created as needed. If reset is True,
+      the flagset is cleared first. The selection of setdata() applies to all subsequent methods, and
+      setselect() flags its selection via Flagger.xflag(). Other keywords are passed to each Flagger
+      method, and may be used to select a subset of the MS.
+      Returns the number of visibilities newly flagged by the autoflag methods (flags raised by
+      setselect() are not counted).""";
+      if self._methods is None:
+        raise RuntimeError,"Autoflagger: commands loaded from file can only be run by glish";
+      calls,unsupported = self._native_plan(flagset);
+      if unsupported:
+        raise RuntimeError,"Autoflagger: %s not supported by native autoflagger"%", ".join(unsupported);
+      self.flagger.ms or self.flagger._reopen();
+      if reset and flagset in self.flagger.flagsets.names():
+        self.flagger.xflag(unflag=flagset,purr=purr,**kw);
+      nflagged = 0;
+      for funcname,args in calls:
+        args.update(kw);
+        if funcname == 'xflag':
+          # nothing to unflag if the flagset doesn't exist yet
+          if args.get('unflag') and flagset not in self.flagger.flagsets.names():
+            continue;
+          self.flagger.xflag(purr=purr,**args);
+        else:
+          nvis,nfl = getattr(self.flagger,funcname)(flagset=flagset,purr=purr,**args);
+          nflagged += nfl;
+      return nflagged;
+
+    def run (self,wait=True,cmdfile=None,purr=True,native=None,flagset='autoflag',**kw):
+      """Runs the autoflagger. If native is True, or if native is None and glish is not available,
+      runs the native autoflagger via run_native(), raising flags in the given flagset. If the methods
+      or run() arguments have no native equivalent, falls back to glish when it is available. Otherwise
+      spawns glish.""";
+      if native is None:
+        native = _GLISH is None;
+      if native:
+        # check what the native autoflagger can't do
+        if self._methods is None:
+          unsupported = [ "commands loaded from file" ];
+        else:
+          unsupported = self._native_plan(flagset)[1];
+        if kw.get('trial'):
+          unsupported.append("run(trial)");
+        if not unsupported:
+          native_kw = dict([ (key,value) for key,value in kw.iteritems()
+                             if key not in self._native_run_ignored and key != 'trial' ]);
+          ignored = [ key for key in self._native_run_ignored if kw.get(key) is not None ];
+          if ignored:
+            self.flagger.dprintf(1,"native autoflagger ignores run() argument(s) %s\n",",".join(ignored));
+          return self.run_native(flagset=flagset,purr=purr,**native_kw);
+        if _GLISH is None:
+          raise RuntimeError,"Autoflagger: %s not supported by native autoflagger, and glish not found"%", ".join(unsupported);
+        self.flagger.dprintf(0,"%s not supported by native autoflagger, falling back to glish\n",", ".join(unsupported));
+      if not self.flagger.purrpipe:
         purr = False;
       runcmd = self._setmethod('run',kw);
       # init list of command strings
@@ -1145,6 +3217,7 @@ class Flagger (Timba.dmi.verbosity):
 
     def load (self,filename='default.af'):
       self._cmds = file(filename).readlines();
+      self._methods = None;
       self.flagger.dprintf(2,"loaded autoflag command sequence from file %s\n",filename);
       self.flagger.dprint(2,"sequence is:");
       for cmd in self._cmds:
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+
+"""Cached indices of MS rows. Indices are built in one vectorized pass over the relevant columns,
+and stored in a cache directory outside the MS, so that subsequent tools can reuse them, and so that
+read-only tools (plot-ms, split-ms-spw, flag-ms -s) never write into the MS. The flag summary (see
+Owlcat.FlagSummary) is kept in the same cache directory, for the same reason. The cache directory is
+given by the OWLCAT_INDEX_CACHE environment variable (default is ~/.cache/owlcat/msindex), with
+index files named by a hash of the full path of the MS; setting OWLCAT_INDEX_CACHE to an empty
+string disables storing indices altogether. A stored index is keyed on the number of rows of the
+MS, and on the names, sizes and modification times of the storage manager files (table.f<N>*)
+holding the indexed columns, and is rebuilt if any of these have changed. Keying on the data files
+of the indexed columns, rather than on the MS as a whole, means that flagging does not invalidate an
+index unless the flag columns share a storage manager with the indexed columns (as they do in an MS
+whose scalar columns are all in one StandardStMan).
+""";
+
+import os
+import os.path
+import glob
+import hashlib
+
+import numpy
+
+# default cache directory for stored indices, see above
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"),".cache","owlcat","msindex");
+
+def cache_filename (msname,basename):
+  """Returns name of the file in the cache directory in which the given index (or other derived data,
+  such as the flag summary) of the MS is stored, or None if storing indices is disabled.""";
+  cachedir = os.environ.get("OWLCAT_INDEX_CACHE",DEFAULT_CACHE_DIR);
+  if not cachedir:
+    return None;
+  return os.path.join(cachedir,"%s_%s"%(hashlib.md5(os.path.realpath(msname)).hexdigest(),basename));
+
+def _column_files (ms,msname,columns):
+  """Helper function. Returns a string describing the storage manager files that hold the given
+  columns of the MS (names, sizes and modification times), or None if these cannot be determined.""";
+  try:
+    seqnrs = sorted(set([ ms.getdminfo(col)['SEQNR'] for col in columns ]));
+  except Exception:
+    return None;
+  files = [];
+  for seqnr in seqnrs:
+    base = os.path.join(msname,"table.f%d"%seqnr);
+    names = glob.glob(base) + glob.glob(base+"_*");
+    if not names:
+      return None;
+    for name in sorted(names):
+      st = os.stat(name);
+      files.append("%s:%d:%r"%(os.path.basename(name),st.st_size,st.st_mtime));
+  return ",".join(files);
+
+def _load (filename,ms,files):
+  """Helper function. Loads a stored index, given the description of the column files returned by
+  _column_files(). Returns dict of arrays, or None if the index file does not exist, or does not
+  match the MS.""";
+  if files is None or filename is None or not os.path.exists(filename):
+    return None;
+  try:
+    data = numpy.load(filename);
+    arrays = dict([ (key,data[key]) for key in data.files ]);
+  except Exception:
+    return None;
+  if int(arrays.get('nrows',-1)) != ms.nrows() or str(arrays.get('column_files')) != files:
+    return None;
+  return arrays;
+
+def _save (filename,ms,files,**arrays):
+  """Helper function. Stores an index, if storing is enabled, the cache directory is writable, and the
+  storage manager files of the indexed columns could be determined. files must be taken before the columns
+  are read, so that a change made while the index is being built makes the stored index out of date.""";
+  if files is None or filename is None:
+    return;
+  try:
+    if not os.path.isdir(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename));
+    # write to a temporary file first, so that readers never see a partial index
+    tmpname = "%s.%d.tmp"%(filename,os.getpid());
+    fobj = file(tmpname,"wb");
+    numpy.savez(fobj,nrows=ms.nrows(),column_files=files,**arrays);
+    fobj.close();
+    os.rename(tmpname,filename);
+  except (IOError,OSError):
+    pass;
+
+TIMESLOT_FILENAME = "TIMESLOT_INDEX.npz";
+
+class TimeslotIndex (object):
+  """Index of the timeslots of an MS. times is the sorted array of unique TIME values. row0 and row1
+  give, for each timeslot, the first row and the last row (plus one) with that time. If ordered is
+  True, rows are sorted in time, so each timeslot occupies exactly the rows row0:row1.
+  """;
+  def __init__ (self,times,row0,row1,ordered):
+    self.times,self.row0,self.row1,self.ordered = times,row0,row1,bool(ordered);
+
+  @staticmethod
+  def build (time):
+    """Builds index from a TIME column.""";
+    times,row0 = numpy.unique(time,return_index=True);
+    # first occurrences in the reversed column are the last occurrences
+    row1 = len(time) - numpy.unique(time[::-1],return_index=True)[1];
+    return TimeslotIndex(times,row0,row1,(numpy.diff(time)>=0).all());
+
+  def slots (self,t0=None,t1=None):
+    """Returns (islot0,islot1) range of timeslots with t0<=time<=t1. None means no limit.""";
+    islot0 = 0 if t0 is None else numpy.searchsorted(self.times,t0,'left');
+    islot1 = len(self.times) if t1 is None else numpy.searchsorted(self.times,t1,'right');
+    return islot0,max(islot0,islot1);
+
+  def row_range (self,islot0,islot1):
+    """Returns (row0,row1) range of rows making up the timeslots islot0:islot1. Only valid
+    if the MS is ordered in time.""";
+    if islot1 <= islot0:
+      return 0,0;
+    return int(self.row0[islot0]),int(self.row1[islot1-1]);
+
+def timeslot_index (ms,msname):
+  """Returns TimeslotIndex for the given MS table (which must be the full MS, not a subset of it),
+  using the stored index if it is up to date, and building and storing it otherwise.""";
+  filename = cache_filename(msname,TIMESLOT_FILENAME);
+  files = _column_files(ms,msname,['TIME']);
+  arrays = _load(filename,ms,files);
+  if arrays is not None:
+    return TimeslotIndex(arrays['times'],arrays['row0'],arrays['row1'],arrays['ordered']);
+  index = TimeslotIndex.build(ms.getcol('TIME'));
+  _save(filename,ms,files,times=index.times,row0=index.row0,row1=index.row1,ordered=index.ordered);
+  return index;
+
+class _Partition (object):
+  """Helper class: partition of row numbers by the value of a key. values is the sorted array of
+  unique keys, order is the array of row numbers sorted by key (and by row number within each key),
+  and the rows with key values[i] are order[bounds[i]:bounds[i+1]].
+  """;
+  def __init__ (self,values,bounds,order):
+    self.values,self.bounds,self.order = values,bounds,order;
+
+  @staticmethod
+  def build (key):
+    # a stable sort keeps the row numbers of each key in order
+    order = numpy.argsort(key,kind='mergesort');
+    values,starts = numpy.unique(key[order],return_index=True);
+    return _Partition(values,numpy.append(starts,len(key)),order);
+
+  def rows (self,values):
+    """Returns sorted array of the row numbers with any of the given key values.""";
+    parts = [ self.order[self.bounds[i]:self.bounds[i+1]] for i in numpy.flatnonzero(numpy.in1d(self.values,values)) ];
+    if len(parts) == 1:
+      return parts[0];
+    return numpy.sort(numpy.concatenate(parts)) if parts else numpy.zeros(0,int);
+
+ROW_FILENAME = "ROW_INDEX.npz";
+_ROW_COLUMNS = [ 'DATA_DESC_ID','FIELD_ID','ANTENNA1','ANTENNA2' ];
+
+class RowIndex (object):
+  """Index of the rows of an MS by DATA_DESC_ID, FIELD_ID and baseline, giving the sorted row numbers
+  of any subset of these, so that subsets of the MS can be made with selectrows() instead of TaQL queries.
+  """;
+  _KEYS = 'ddid','field','baseline';
+
+  def __init__ (self,**partitions):
+    self._partitions = partitions;
+
+  @staticmethod
+  def build (ddid,field,ant1,ant2):
+    baseline = (numpy.asarray(ant1,numpy.int64)<<16)|ant2;
+    return RowIndex(ddid=_Partition.build(ddid),field=_Partition.build(field),baseline=_Partition.build(baseline));
+
+  def arrays (self):
+    """Returns dict of arrays for storing the index.""";
+    arrays = {};
+    for key,part in self._partitions.iteritems():
+      arrays.update({ key+"_values":part.values,key+"_bounds":part.bounds,key+"_order":part.order });
+    return arrays;
+
+  @staticmethod
+  def from_arrays (arrays):
+    return RowIndex(**dict([ (key,_Partition(arrays[key+"_values"],arrays[key+"_bounds"],arrays[key+"_order"]))
+                             for key in RowIndex._KEYS ]));
+
+  def ddid_rows (self,ddids):
+    """Returns sorted row numbers of the given DATA_DESC_IDs.""";
+    return self._partitions['ddid'].rows(ddids);
+
+  def field_rows (self,fields):
+    """Returns sorted row numbers of the given FIELD_IDs.""";
+    return self._partitions['field'].rows(fields);
+
+  def baseline_rows (self,baselines):
+    """Returns sorted row numbers of the given list of (ANTENNA1,ANTENNA2) baselines.""";
+    return self._partitions['baseline'].rows([ (p<<16)|q for p,q in baselines ]);
+
+  def baselines (self):
+    """Returns (ant1,ant2) tuple of arrays of all the baselines present in the MS, sorted.""";
+    values = self._partitions['baseline'].values;
+    return values>>16,values&0xFFFF;
+
+  def antenna_rows (self,antennas):
+    """Returns sorted row numbers of all baselines involving any of the given antennas.""";
+    values = self._partitions['baseline'].values;
+    return self._partitions['baseline'].rows(values[numpy.in1d(values>>16,antennas)|numpy.in1d(values&0xFFFF,antennas)]);
+
+def row_index (ms,msname):
+  """Returns RowIndex for the given MS table (which must be the full MS, not a subset of it), using
+  the stored index if it is up to date, and building and storing it otherwise.""";
+  filename = cache_filename(msname,ROW_FILENAME);
+  files = _column_files(ms,msname,_ROW_COLUMNS);
+  arrays = _load(filename,ms,files);
+  if arrays is not None:
+    return RowIndex.from_arrays(arrays);
+  index = RowIndex.build(*[ ms.getcol(col) for col in _ROW_COLUMNS ]);
+  _save(filename,ms,files,**index.arrays());
+  return index;
+
+def split_by_ddid (ms,ddids,index=None):
+  """Splits MS table into subsets by DATA_DESC_ID, without TaQL queries. If a RowIndex is given, ms
+  must be the full MS that it indexes. Otherwise, the DATA_DESC_ID column of ms is read and partitioned.
+  Returns list of (ddid,subms) pairs.""";
+  if index is None:
+    index = RowIndex(ddid=_Partition.build(ms.getcol('DATA_DESC_ID')));
+  return [ (ddid,ms.selectrows(index.ddid_rows([ddid]))) for ddid in ddids ];
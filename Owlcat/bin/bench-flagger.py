@@ -0,0 +1,317 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+#% $Id$
+#
+#
+# Copyright (C) 2002-2011
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+import sys
+import os
+import os.path
+import time
+import json
+import shutil
+import platform
+import tempfile
+import subprocess
+
+import numpy
+
+from Owlcat import table,tableexists,tabledelete
+import Owlcat.Console;
+
+progress = Owlcat.Console.Reporter(timestamp=True);
+
+# number of rows written at once when making the MS, and when resetting its flags
+ROWCHUNK = 50000;
+
+# storage managers for the array columns of the synthetic MS
+STORAGE_MANAGERS = dict(standard="StandardStMan",tiled="TiledShapeStMan");
+
+# name of the flagset raised by the benchmarks
+FLAGSET = "bench";
+
+# amplitude threshold used by the clipping benchmarks, in units of the noise
+CLIP_THRESHOLD = 7.;
+
+def make_ms (msname,nant,nchan,ncorr,nddid,ntime,stman="tiled",seed=0):
+  """Makes a synthetic MS with the given dimensions, with all baselines (no autocorrelations) at every
+  timeslot and DDID, rows ordered by time. DATA and CORRECTED_DATA hold Gaussian noise with a few
+  outliers. All flags are clear. Array columns use the given storage manager (see STORAGE_MANAGERS).""";
+  from pyrap.tables import makescacoldesc,makearrcoldesc,maketabdesc
+  rng = numpy.random.RandomState(seed);
+  # main table
+  coldescs = [ makescacoldesc('TIME',0.),makescacoldesc('ANTENNA1',0),makescacoldesc('ANTENNA2',0),
+               makescacoldesc('DATA_DESC_ID',0),makescacoldesc('FIELD_ID',0),makearrcoldesc('UVW',0.,ndim=1),
+               makescacoldesc('FLAG_ROW',False),makescacoldesc('BITFLAG_ROW',0),
+               makearrcoldesc('DATA',0j,ndim=2,valuetype='complex'),
+               makearrcoldesc('CORRECTED_DATA',0j,ndim=2,valuetype='complex'),
+               makearrcoldesc('FLAG',False,ndim=2),makearrcoldesc('BITFLAG',0,ndim=2) ];
+  arraycols = [ 'DATA','CORRECTED_DATA','FLAG','BITFLAG' ];
+  # tiles of (all correlations) x (up to 64 channels) x (enough rows for 16k values)
+  spec = dict(DEFAULTTILESHAPE=[ncorr,min(nchan,64),max(1024*16//(ncorr*min(nchan,64)),1)]) if stman == "tiled" else {};
+  dminfo = { '*1':dict(TYPE=STORAGE_MANAGERS[stman],NAME="BenchArrays",SPEC=spec,COLUMNS=arraycols) };
+  p,q = numpy.triu_indices(nant,1);
+  nbl = len(p);
+  nrows = ntime*nddid*nbl;
+  ms = table(msname,maketabdesc(coldescs),nrow=nrows,dminfo=dminfo,readonly=False,ack=False);
+  # subtables
+  def subtable (name,nrows,coldescs,**columns):
+    tab = table(os.path.join(msname,name),maketabdesc(coldescs),nrow=nrows,readonly=False,ack=False);
+    for col,value in columns.iteritems():
+      tab.putcol(col,value);
+    tab.close();
+    ms.putkeyword(name,"Table: "+os.path.join(msname,name));
+  subtable("ANTENNA",nant,
+      [ makescacoldesc('NAME',''),makearrcoldesc('POSITION',0.,ndim=1),makescacoldesc('DISH_DIAMETER',0.) ],
+      NAME=[ "ANT%02d"%i for i in range(nant) ],
+      POSITION=numpy.array([ [ 5109000.+100*i,2006000.,-3239000. ] for i in range(nant) ]),
+      DISH_DIAMETER=numpy.ones(nant)*13.5);
+  subtable("SPECTRAL_WINDOW",nddid,
+      [ makearrcoldesc('CHAN_FREQ',0.,ndim=1),makescacoldesc('NUM_CHAN',0),makescacoldesc('REF_FREQUENCY',0.) ],
+      CHAN_FREQ=numpy.array([ 1.4e+9+1e+8*i+1e+5*numpy.arange(nchan) for i in range(nddid) ]),
+      NUM_CHAN=numpy.ones(nddid,int)*nchan,REF_FREQUENCY=1.4e+9+1e+8*numpy.arange(nddid));
+  subtable("POLARIZATION",1,
+      [ makearrcoldesc('CORR_TYPE',0,ndim=1),makescacoldesc('NUM_CORR',0) ],
+      CORR_TYPE=numpy.array([ [9,10,11,12][:ncorr] ]),NUM_CORR=numpy.array([ncorr]));
+  subtable("DATA_DESCRIPTION",nddid,
+      [ makescacoldesc('SPECTRAL_WINDOW_ID',0),makescacoldesc('POLARIZATION_ID',0),makescacoldesc('FLAG_ROW',False) ],
+      SPECTRAL_WINDOW_ID=numpy.arange(nddid),POLARIZATION_ID=numpy.zeros(nddid,int));
+  subtable("FIELD",1,[ makescacoldesc('NAME','') ],NAME=["BENCH"]);
+  # rows are ordered by time, then DDID, then baseline
+  rows_per_time = nddid*nbl;
+  tchunk = max(ROWCHUNK//rows_per_time,1);
+  for t0 in range(0,ntime,tchunk):
+    nt = min(tchunk,ntime-t0);
+    row0,nr = t0*rows_per_time,nt*rows_per_time;
+    progress.overprint("Writing rows %d~%d of %d"%(row0,row0+nr-1,nrows));
+    ms.putcol('TIME',numpy.repeat(4.e+9+10.*numpy.arange(t0,t0+nt),rows_per_time),row0,nr);
+    ms.putcol('ANTENNA1',numpy.tile(p,nt*nddid),row0,nr);
+    ms.putcol('ANTENNA2',numpy.tile(q,nt*nddid),row0,nr);
+    ms.putcol('DATA_DESC_ID',numpy.tile(numpy.repeat(numpy.arange(nddid),nbl),nt),row0,nr);
+    ms.putcol('FIELD_ID',numpy.zeros(nr,int),row0,nr);
+    ms.putcol('UVW',rng.randn(nr,3)*1000,row0,nr);
+    data = (rng.standard_normal((nr,nchan,ncorr))+1j*rng.standard_normal((nr,nchan,ncorr))).astype(numpy.complex64);
+    ms.putcol('CORRECTED_DATA',data,row0,nr);
+    # a few outliers for the clippers to find
+    data[rng.rand(nr,nchan,ncorr)<0.001] *= 50;
+    ms.putcol('DATA',data,row0,nr);
+  ms.close();
+  reset_flags(msname);
+  progress("Made %s: %d rows, %d antennas, %d channels, %d correlations, %d DDIDs, %s storage manager"%(
+            msname,nrows,nant,nchan,ncorr,nddid,stman));
+  return nrows;
+
+def reset_flags (msname):
+  """Clears all flag columns of the MS, and removes any flag summary and flag versions left by the benchmarks.""";
+  ms = table(msname,readonly=False,ack=False);
+  nrows = ms.nrows();
+  for row0 in range(0,nrows,ROWCHUNK):
+    nr = min(ROWCHUNK,nrows-row0);
+    shape = (nr,)+ms.getcol('FLAG',row0,1).shape[1:];
+    ms.putcol('FLAG',numpy.zeros(shape,bool),row0,nr);
+    ms.putcol('BITFLAG',numpy.zeros(shape,numpy.int32),row0,nr);
+    ms.putcol('FLAG_ROW',numpy.zeros(nr,bool),row0,nr);
+    ms.putcol('BITFLAG_ROW',numpy.zeros(nr,numpy.int32),row0,nr);
+  ms.close();
+  from Owlcat import FlagSummary,FlagVersions
+  for name in FlagSummary.FILENAME,FlagVersions.DIRNAME:
+    path = os.path.join(msname,name);
+    if os.path.isdir(path):
+      shutil.rmtree(path);
+    elif os.path.exists(path):
+      os.remove(path);
+
+# The benchmarks. Each is a (name,setup,run) tuple. setup(flagger) prepares the MS (untimed, may be None),
+# and run(flagger,msname) is timed
+
+def _create_flagset (flagger):
+  flagger.xflag(flag=FLAGSET,create=True,antennas=[0]);
+
+def _run_flagms (flagger,msname):
+  flagger.close();
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)),"flag-ms.py");
+  args = [ sys.executable,script,"-f",FLAGSET,"-c","-C","DATA","--above",str(CLIP_THRESHOLD),msname ];
+  if subprocess.call(args,stdout=open(os.devnull,"w")):
+    raise RuntimeError,"flag-ms failed: %s"%" ".join(args);
+
+BENCHMARKS = [
+  ("xflag-rows",None,
+    lambda flagger,msname:flagger.xflag(flag=FLAGSET,create=True,antennas=[0,1])),
+  ("xflag-channels",None,
+    lambda flagger,msname:flagger.xflag(flag=FLAGSET,create=True,channels=slice(0,None,4),corrs=[0])),
+  ("xflag-clip",None,
+    lambda flagger,msname:flagger.xflag(flag=FLAGSET,create=True,data_column='DATA',data_above=CLIP_THRESHOLD)),
+  ("stats",_create_flagset,
+    lambda flagger,msname:flagger.flagset_stats(summary=False)),
+  ("set-legacy",_create_flagset,
+    lambda flagger,msname:flagger.set_legacy_flags(FLAGSET,purr=False)),
+  ("clear-legacy",_create_flagset,
+    lambda flagger,msname:flagger.clear_legacy_flags(purr=False)),
+  ("flag-ms",None,_run_flagms),
+];
+
+def run_benchmarks (msname,names,repeat=3,**flagger_kw):
+  """Runs the named benchmarks on the MS, repeat times each, resetting the flags in between.
+  Returns dict of name -> dict of results.""";
+  from Owlcat.Flagger import Flagger
+  nrows = table(msname,ack=False).nrows();
+  results = {};
+  for name,setup,run in BENCHMARKS:
+    if name not in names:
+      continue;
+    times = [];
+    for i in range(repeat):
+      reset_flags(msname);
+      flagger = Flagger(msname,**flagger_kw);
+      if setup:
+        setup(flagger);
+      t0 = time.time();
+      run(flagger,msname);
+      flagger.close();
+      times.append(time.time()-t0);
+    best = min(times);
+    results[name] = dict(best=best,mean=sum(times)/len(times),times=times,rows_per_sec=nrows/best if best else None);
+    progress("%-16s best %8.3fs  mean %8.3fs  %10.0f rows/s"%(name,best,results[name]['mean'],nrows/best if best else 0));
+  return results;
+
+def load_history (filename):
+  if not os.path.exists(filename):
+    return [];
+  return json.load(open(filename));
+
+def compare (results,previous,tolerance):
+  """Compares results to a previous history entry. Returns list of names of benchmarks that are
+  slower by more than the given tolerance (a fraction).""";
+  regressions = [];
+  for name in sorted(results.keys()):
+    prev = previous['results'].get(name);
+    if not prev:
+      continue;
+    ratio = results[name]['best']/prev['best'] if prev['best'] else 1;
+    slower = ratio > 1+tolerance;
+    if slower:
+      regressions.append(name);
+    progress("%-16s %8.3fs vs %8.3fs (%s): x%.2f%s"%(name,results[name]['best'],prev['best'],
+              previous.get('label') or time.strftime("%Y/%m/%d %H:%M",time.localtime(previous['time'])),
+              ratio,"  REGRESSION" if slower else ""));
+  return regressions;
+
+if __name__ == "__main__":
+
+  # setup some standard command-line option parsing
+  #
+  from optparse import OptionParser
+  parser = OptionParser(usage="""%prog: [options]""",
+    description="Benchmarks the flagging engine (Owlcat.Flagger and flag-ms) on a synthetic MS, which is made "
+    "locally with the given dimensions. Each benchmark is run several times, with all flags cleared in between, "
+    "and the best time is reported. Results are appended to a JSON history file, and compared to the last "
+    "entry in the history with the same MS configuration.");
+  parser.add_option("-a","--antennas",metavar="N",type="int",default=14,
+                    help="number of antennas. Default is %default.");
+  parser.add_option("-c","--channels",metavar="N",type="int",default=64,
+                    help="number of channels. Default is %default.");
+  parser.add_option("-p","--corrs",metavar="N",type="int",default=4,
+                    help="number of correlations. Default is %default.");
+  parser.add_option("-d","--ddids",metavar="N",type="int",default=2,
+                    help="number of DATA_DESC_IDs (spectral windows). Default is %default.");
+  parser.add_option("-n","--rows",metavar="N",type="int",default=200000,
+                    help="approximate number of rows (rounded to a whole number of timeslots). Default is %default.");
+  parser.add_option("-s","--storage-manager",type="choice",choices=sorted(STORAGE_MANAGERS.keys()),default="tiled",
+                    help="storage manager for the array columns: %s. Default is %%default."%", ".join(sorted(STORAGE_MANAGERS.keys())));
+  parser.add_option("-b","--benchmarks",metavar="NAMES",type="string",
+                    help="comma-separated list of benchmarks to run (default is all): %s."%", ".join([ b[0] for b in BENCHMARKS ]));
+  parser.add_option("-r","--repeat",metavar="N",type="int",default=3,
+                    help="number of times to run each benchmark. Default is %default.");
+  parser.add_option("-o","--history",metavar="FILENAME",type="string",default="bench-flagger.json",
+                    help="JSON history file to append results to. Default is %default.");
+  parser.add_option("-l","--label",type="string",
+                    help="label for this run in the history (e.g. a git revision).");
+  parser.add_option("-t","--tolerance",metavar="PERCENT",type="float",default=20,
+                    help="report benchmarks that are slower than the previous run by more than this much, and exit "
+                    "with an error status if there are any. Default is %default.");
+  parser.add_option("--ms",metavar="MSNAME",type="string",
+                    help="name of synthetic MS. It is made if it does not exist (or if -f is given), and kept "
+                    "afterwards. Default is to make a temporary MS, and delete it afterwards.");
+  parser.add_option("-f","--force",action="store_true",
+                    help="remake the MS given by --ms even if it exists.");
+  parser.add_option("-z","--chunk-size",metavar="NROWS",type="int",default=200000,
+                    help="Flagger chunk size, in rows. Default is %default.");
+  parser.add_option("-j","--jobs",metavar="N",type="int",default=1,
+                    help="Flagger worker processes. Default is %default.");
+
+  (options,args) = parser.parse_args();
+  if args:
+    parser.error("Incorrect number of arguments. Use '-h' for help.");
+
+  names = [ b[0] for b in BENCHMARKS ];
+  if options.benchmarks:
+    unknown = set(options.benchmarks.split(",")) - set(names);
+    if unknown:
+      parser.error("Unknown benchmark(s) %s"%",".join(sorted(unknown)));
+    names = options.benchmarks.split(",");
+
+  nbl = options.antennas*(options.antennas-1)//2;
+  ntime = max(options.rows//(nbl*options.ddids),1);
+  config = dict(antennas=options.antennas,channels=options.channels,corrs=options.corrs,ddids=options.ddids,
+                timeslots=ntime,rows=ntime*nbl*options.ddids,storage_manager=options.storage_manager,
+                chunk_size=options.chunk_size,jobs=options.jobs);
+
+  # make the MS
+  tmpdir = None;
+  if options.ms:
+    msname = options.ms;
+    if tableexists(msname) and options.force:
+      tabledelete(msname);
+  else:
+    tmpdir = tempfile.mkdtemp(prefix="bench-flagger-");
+    msname = os.path.join(tmpdir,"bench.MS");
+  try:
+    if not tableexists(msname):
+      progress("Making synthetic MS %s"%msname);
+      make_ms(msname,options.antennas,options.channels,options.corrs,options.ddids,ntime,options.storage_manager);
+    else:
+      progress("Using existing MS %s"%msname);
+
+    progress("Running %d benchmark(s), %d time(s) each"%(len(names),options.repeat));
+    results = run_benchmarks(msname,names,repeat=options.repeat,chunksize=options.chunk_size,workers=options.jobs);
+  finally:
+    if tmpdir:
+      shutil.rmtree(tmpdir,ignore_errors=True);
+
+  # compare to the last run with the same configuration, then add this run to the history
+  history = load_history(options.history);
+  previous = [ entry for entry in history if entry.get('config') == config ];
+  regressions = [];
+  if previous:
+    progress("Comparing to previous run:");
+    regressions = compare(results,previous[-1],options.tolerance/100.);
+  history.append(dict(time=time.time(),label=options.label,host=platform.node(),
+                      python=platform.python_version(),config=config,results=results));
+  json.dump(history,open(options.history,"w"),indent=1);
+  progress("Results appended to %s"%options.history);
+
+  if regressions:
+    progress("%d benchmark(s) slower by more than %g%%: %s"%(len(regressions),options.tolerance,", ".join(regressions)));
+    sys.exit(1);
@@ -28,6 +28,7 @@
 
 import os.path
 import math
+import time
 import sys
 import re
 import gzip
@@ -48,6 +49,28 @@ def get_ms (readonly=True):
     ms = Owlcat.table(msname,readonly=readonly);
   return ms;
 
+def report_profile (flagger):
+  """Prints the profile of the flagger, and writes it to the --profile-json file, if enabled.""";
+  if not flagger.profile:
+    return;
+  print "===> Profile:";
+  for line in flagger.profile.summary():
+    print "===>   "+line;
+  if options.profile_json:
+    flagger.profile.dump(options.profile_json,msname=msname,command=" ".join(sys.argv));
+    print "===> Profile written to %s"%options.profile_json;
+
+def write_occupancy (flagger,subset):
+  """Makes the flag occupancy cube of the selection, and writes it to the --occupancy file.""";
+  occ_subset = dict([ (key,value) for key,value in subset.iteritems() if key in
+    ('ddid','fieldid','antennas','baselines','time','reltime','taql') ]);
+  print "===> making flag occupancy cube (time blocks of %g s, channel blocks of %d)"%(options.occupancy_timebin,
+      options.occupancy_chanbin);
+  occ = flagger.occupancy(timebin=options.occupancy_timebin,chanbin=options.occupancy_chanbin,**occ_subset);
+  occ.save(options.occupancy);
+  print "===>   %d flagsets x %d baselines x %d time blocks, for DDID(s) %s, written to %s"%(len(occ.flagsets),
+      len(occ.ant1),occ.ntime,",".join(map(str,occ.ddids())),options.occupancy);
+
 def shape_str (label,arr):
   return "%s: %s"%(label,"x".join(map(str,arr.shape)) if arr is not None else "None");
 
@@ -220,13 +243,69 @@ if __name__ == "__main__":
   group.add_option("-c","--create",action="store_true",
                   help="for -f/--flag option only: if a named flagset doesn't exist, creates "
                   "it. Without this option, an error is reported.");
+  group.add_option("--grow-time",metavar="N",type="int",default=0,
+                  help="for -f/--flag option only: once the selection is flagged, grows the flags by N timeslots "
+                  "either way, per baseline and correlation, within the rows selected by -D/-F/-S/-I/-T/-Q. The "
+                  "-L/--channels, -X/--corrs and data value selections do not restrict the growing.");
+  group.add_option("--grow-freq",metavar="N",type="int",default=0,
+                  help="for -f/--flag option only: likewise grows the flags by N channels either way.");
+  group.add_option("--threshold-frac",metavar="X",type="float",
+                  help="for -f/--flag option only: after growing, flags whole timeslots (of a baseline) in which "
+                  "more than a fraction X of the visibilities (over all channels and correlations) are flagged.");
+  group.add_option("-P","--program",metavar="FILENAME",type="string",
+                  help="runs a flag program: a list of flagging operations, each one given by its own selection and "
+                  "action arguments (see Flagger.xflag()), which are all done in a single pass through the MS. "
+                  "FILENAME is a Python file defining a list of dicts called 'program', or a YAML file (.yaml or .yml) "
+                  "containing a list of mappings. The selection options above do not apply to the program. Legacy "
+                  "flags are filled as for -f/--flag once the program is done (see -g/--fill-legacy).");
+  parser.add_option_group(group);
+
+  group = OptionGroup(parser,"Automatic flagging");
+  group.add_option("--sumthreshold",metavar="FLAGSET",type="string",
+                  help="runs the SumThreshold RFI flagger on the selection (per baseline and correlation, using "
+                  "the -C/--data-column amplitudes), and raises flags in the named FLAGSET, which is created as "
+                  "needed. The -L/--channels and -X/--corrs selections restrict the channels and correlations that are "
+                  "flagged, the data value and flag selections do not apply. Combine with -x/--extend-all-corr to flag "
+                  "all correlations when any one is flagged.");
+  group.add_option("--st-threshold",metavar="X",type="float",default=6,
+                  help="SumThreshold base threshold, in units of the noise. Default is %default.");
+  group.add_option("--st-max-window",metavar="N",type="int",default=64,
+                  help="largest SumThreshold window size, in samples. Default is %default.");
+  parser.add_option_group(group);
+
+  group = OptionGroup(parser,"Flag versions");
+  group.add_option("--snapshot",metavar="NAME",type="string",
+                  help="saves the current flags as a named flag version, before any flagging actions are done. "
+                  "Only the changes since the previous version are stored, in the MS directory.");
+  group.add_option("--restore",metavar="NAME",type="string",
+                  help="restores the flags to a named flag version, before any flagging actions are done "
+                  "(and before --snapshot). Unsaved changes to the flags are lost.");
+  group.add_option("--versions",action="store_true",
+                  help="lists the stored flag versions, and exits.");
+  group.add_option("--diff",metavar="NAME[,NAME2]",type="string",
+                  help="prints the number of flags that differ between two flag versions, or between a flag "
+                  "version and the current flags, and exits.");
   parser.add_option_group(group);
 
   group = OptionGroup(parser,"Other options");
   group.add_option("-l","--list",action="store_true",
                   help="lists various info about the MS, including its flagsets.");
   group.add_option("-s","--stats",action="store_true",
-                  help="prints per-flagset flagging stats.");
+                  help="prints per-flagset flagging stats. Unless the selection involves channels, correlations, "
+                  "fields, times or TaQL, these are taken from a flag summary kept in the MS index "
+                  "cache directory (see OWLCAT_INDEX_CACHE), which is built on first use, and kept up to date by "
+                  "subsequent flagging.");
+  group.add_option("--no-summary",action="store_true",
+                  help="for -s/--stats option only: do not use the flag summary, always read the flags.");
+  group.add_option("--occupancy",metavar="FILENAME",type="string",
+                  help="writes a flag occupancy cube of the selection to FILENAME (a .npz file, see Owlcat.FlagOccupancy): "
+                  "the number of flagged visibilities per flagset, baseline, channel and time block, for every "
+                  "DATA_DESC_ID, collected in a single pass through the MS. If any flagging actions are specified, "
+                  "these will be done first.");
+  group.add_option("--occupancy-timebin",metavar="SECONDS",type="float",default=600,
+                  help="for --occupancy option only: size of time blocks. Default is %default.");
+  group.add_option("--occupancy-chanbin",metavar="N",type="int",default=1,
+                  help="for --occupancy option only: number of channels per block. Default is %default.");
   group.add_option("-r","--remove",metavar="FLAGSET(s)",type="string",
                   help="unflags and removes named flagset(s). You can use a comma-separated list.");
   group.add_option("--export",type="string",metavar="FILENAME",
@@ -237,8 +316,23 @@ if __name__ == "__main__":
                     help="verbosity level for messages. Higher is more verbose, default is 0.");
   group.add_option("--timestamps",action="store_true",
                   help="adds timestamps to verbosity messages.");
+  group.add_option("--profile",action="store_true",
+                  help="prints a table of the time spent in each stage of processing (selection, column reads "
+                  "and writes, flag computations, etc.), with rows/s and bytes read and written per stage and column.");
+  group.add_option("--profile-json",metavar="FILENAME",type="string",
+                  help="writes the profiling results to a JSON file. Implies --profile.");
   group.add_option("-z","--chunk-size",metavar="NROWS",type="int",default=200000,
                     help="Number of rows to process at once. Default is %default. Set to higher values if you have RAM to spare.");
+  group.add_option("-m","--memory-budget",metavar="MB",type="float",
+                    help="Memory budget for processing, in MB. If given, the number of rows to process at once is "
+                    "computed separately for each DATA_DESC_ID from the row size of the columns involved, "
+                    "and -z/--chunk-size is ignored.");
+  group.add_option("-j","--jobs",metavar="N",type="int",default=1,
+                    help="Number of worker processes to use for flagging. Work is split up by DATA_DESC_ID "
+                    "(and by row ranges, if there are fewer DATA_DESC_IDs than workers). Default is %default.");
+  group.add_option("--read-ahead",metavar="N",type="int",default=1,
+                    help="Number of chunks to read ahead (and write behind) in background I/O threads, so that "
+                    "disk access overlaps with computation. Use 0 to disable the I/O threads. Default is %default.");
   parser.add_option_group(group);
 
   parser.set_defaults(data_column="CORRECTED_DATA",data_flagmask="ALL",
@@ -251,6 +345,10 @@ if __name__ == "__main__":
   if len(args) != 1:
     parser.error("Incorrect number of arguments. Use '-h' for help.");
   msname  = args[0];
+  if options.profile_json:
+    options.profile = True;
+  if (options.grow_time or options.grow_freq or options.threshold_frac is not None) and not options.flag:
+    parser.error("--grow-time, --grow-freq and --threshold-frac require -f/--flag.");
 
   import Owlcat
 
@@ -271,7 +369,7 @@ if __name__ == "__main__":
     print "Flags imported OK.";
 
   # if no other actions supplied, enable stats (unless flags were imported, in which case just exit)
-  if not (options.flag or options.unflag or options.fill_legacy):
+  if not (options.flag or options.unflag or options.fill_legacy or options.sumthreshold or options.program):
     if options._import:
       sys.exit(0);
     statonly = True;
@@ -283,10 +381,52 @@ if __name__ == "__main__":
   import Owlcat.Flagger
   from Owlcat.Flagger import Flagger
 
+  # flag versions are listed, compared, restored and saved before any other actions
+  if options.versions or options.diff or options.restore or options.snapshot:
+    flagger = Flagger(msname,verbose=options.verbose,timestamps=options.timestamps,chunksize=options.chunk_size,
+                      readahead=options.read_ahead,profile=options.profile);
+    if options.versions or options.diff:
+      if options.versions:
+        versions = flagger.flag_versions();
+        print "===> MS has %d flag version(s)"%len(versions);
+        for name,comment,vtime,nblocks in versions:
+          print "===>   %-20s %s  %6d blocks changed  %s"%(name,time.strftime("%Y/%m/%d %H:%M:%S",time.localtime(vtime)),
+              nblocks,comment);
+      if options.diff:
+        names = options.diff.split(",",1);
+        try:
+          counts = flagger.diff_flags(*names);
+        except KeyError,exc:
+          error(exc.args[0]);
+        print "===> Differences between %s and %s:"%(names[0],names[1] if len(names) > 1 else "current flags");
+        for col in sorted(counts.keys()):
+          print "===>   %-12s %10d"%(col,counts[col]);
+      flagger.close();
+      report_profile(flagger);
+      sys.exit(0);
+    try:
+      if options.restore:
+        print "===> restoring flag version %s"%options.restore;
+        nblocks = flagger.restore_flags(options.restore);
+        print "===>   %d blocks of rows written"%nblocks;
+      if options.snapshot:
+        print "===> saving flag version %s"%options.snapshot;
+        nblocks = flagger.snapshot_flags(options.snapshot);
+        print "===>   %d blocks of rows changed since the previous version"%nblocks;
+    except (KeyError,ValueError),exc:
+      error(exc.args[0]);
+    flagger.close();
+    report_profile(flagger);
+    # with no flagging actions, exit (unless flags are to be exported)
+    if statonly and not options.export:
+      sys.exit(0);
+
   # now, skip most of the actions below if we're in statonly mode and exporting
-  if not (statonly and options.export):
+  if not (statonly and options.export and not options.occupancy):
     # create flagger object
-    flagger = Flagger(msname,verbose=options.verbose,timestamps=options.timestamps,chunksize=options.chunk_size);
+    flagger = Flagger(msname,verbose=options.verbose,timestamps=options.timestamps,chunksize=options.chunk_size,
+                      memory_budget=options.memory_budget,workers=options.jobs,readahead=options.read_ahead,
+                      profile=options.profile);
 
     #
     # -l/--list: list MS info
@@ -321,19 +461,19 @@ if __name__ == "__main__":
         else:
           print "  No flagsets.";
       print "";
-      if options.flag or options.unflag or options.fill_legacy or options.remove:
+      if options.flag or options.unflag or options.fill_legacy or options.remove or options.sumthreshold or options.program:
         print "-l/--list was in effect, so all other options were ignored.";
       sys.exit(0);
 
-    # --flag/--unflag/--remove implies '-g all' by default, '-g -' skips the fill-legacy step
-    if options.flag or options.unflag or options.remove:
+    # --flag/--unflag/--remove/--sumthreshold/--program implies '-g all' by default, '-g -' skips the fill-legacy step
+    if options.flag or options.unflag or options.remove or options.sumthreshold or options.program:
       if options.fill_legacy is None:
         options.fill_legacy = 'all';
       elif options.fill_legacy == '-':
         options.fill_legacy = None;
 
     # if no other actions supplied, enable stats (unless flags were imported, in which case just exit)
-    if not (options.flag or options.unflag or options.fill_legacy):
+    if not (options.flag or options.unflag or options.fill_legacy or options.sumthreshold or options.program):
       if options._import:
         sys.exit(0);
       statonly = not options.export;
@@ -385,6 +525,7 @@ if __name__ == "__main__":
         print "===> and filling FLAG/FLAG_ROW using flagmask %s"%Flagger.flagmaskstr(options.fill_legacy);
       flagger.xflag(unflag=~flagmask,fill_legacy=options.fill_legacy);
       flagger.flagsets.remove_flagset(*list(all_flagsets-retain));
+      report_profile(flagger);
       sys.exit(0);
 
     # parse subset options
@@ -396,8 +537,9 @@ if __name__ == "__main__":
     # convert timeslots to reltime option, if specified
     if options.timeslots:
       from Owlcat import Parsing
+      from Owlcat import MSIndex
       tslice = Parsing.parse_slice(options.timeslots,options.timeslot_multiplier);
-      times = sorted(set(get_ms().getcol('TIME')));
+      times = MSIndex.timeslot_index(get_ms(),msname).times;
       time0 = times[0] if tslice.start is None else times[tslice.start];
       time1 = times[-1] if tslice.stop is None else times[tslice.stop-1];
       time0 -= times[0];
@@ -418,61 +560,104 @@ if __name__ == "__main__":
       print "===> filling legacy flags with flagmask %s"%legacystr;
 
 
+    # --occupancy with no flagging actions: write the cube now, and exit unless stats are wanted
+    if options.occupancy and statonly:
+      write_occupancy(flagger,subset);
+      if not options.stats:
+        flagger.close();
+        report_profile(flagger);
+        sys.exit(0);
+
     # if --stats in effect, loop over all flagsets and print stats
     if options.stats:
       print "===> --stats in effect, showing per-flagset statistics"
-      printed_header = False;
-      for flagset in list(flagger.flagsets.names())+["+L"]:
-        # get stats for this flagset
-        subset['flagmask'] = flagger.lookup_flagmask(flagset);
-        totrows,sel_nrow,sel_nvis,nvis_A,nvis_B,nvis_C = flagger.xflag(**subset);
-        percent = 100.0/sel_nvis if sel_nvis else 0;
-        # print them
-        if flagset is "+L":
+      # get stats for all flagsets in one pass
+      stats_subset = dict([ (key,value) for key,value in subset.iteritems() if key in
+        ('ddid','fieldid','antennas','baselines','time','reltime','taql','channels','corrs',
+         'flagmask_all','flagmask_none') ]);
+      totrows,sel_nrow,sel_nvis,nvis_A,stats = flagger.flagset_stats(summary=not options.no_summary,**stats_subset);
+      percent = 100.0/sel_nvis if sel_nvis else 0;
+      rpc = 100.0/totrows if totrows else 0;
+      print "===>   MS size:               %8d rows"%totrows;
+      print "===>   Data/time selection:   %8d rows, %10d visibilities (%.3g%% of MS rows)"%(sel_nrow,sel_nvis,sel_nrow*rpc);
+      if options.channels or options.corrs:
+        print "===>   Chan/corr slicing reduces this to    %12d visibilities (%.3g%% of selection)"%(nvis_A,nvis_A*percent);
+      for flagset,flagmask,nrow_B,nvis_B in stats:
+        if flagset == "+L":
           label = "legacy FLAG/FLAG_ROW";
         else:
-          label =  "Flagset %s (0x%02X)"%(flagset,flagger.flagsets.flagmask(flagset));
-        if not printed_header:
-          printed_header = True;
-          rpc = 100.0/totrows if totrows else 0;
-          print "===>   MS size:               %8d rows"%totrows;
-          print "===>   Data/time selection:   %8d rows, %10d visibilities (%.3g%% of MS rows)"%(sel_nrow,sel_nvis,sel_nrow*rpc);
-          if options.channels or options.corrs:
-            print "===>   Chan/corr slicing reduces this to    %12d visibilities (%.3g%% of selection)"%(nvis_A,nvis_A*percent);
+          label =  "Flagset %s (0x%02X)"%(flagset,flagmask);
         print "===>   %-29s includes %10d visibilities (%.3g%% of selection)"%(label,nvis_B,nvis_B*percent);
+      report_profile(flagger);
       sys.exit(0);
 
-    # else not stats mode, do the actual flagging job
-    totrows,sel_nrow,sel_nvis,nvis_A,nvis_B,nvis_C = \
-      flagger.xflag(flag=options.flag,unflag=options.unflag,fill_legacy=options.fill_legacy,
-        flag_allcorr=options.extend_all_corr,
-        **subset);
+    # --sumthreshold: run the SumThreshold flagger on the selection
+    if options.sumthreshold:
+      st_subset = dict([ (key,value) for key,value in subset.iteritems() if key in
+        ('ddid','fieldid','antennas','baselines','time','reltime','taql','channels','corrs') ]);
+      print "===> running SumThreshold flagger on %s, raising flagset %s"%(options.data_column,options.sumthreshold);
+      nvis,nflagged = flagger.sumthreshold_flag(options.sumthreshold,thr=options.st_threshold,
+          max_window=options.st_max_window,allcorr=options.extend_all_corr,column=options.data_column,
+          fill_legacy=options.fill_legacy,**st_subset);
+      print "===>   %d of %d visibilities newly flagged (%.3g%%)"%(nflagged,nvis,nflagged*100.0/nvis if nvis else 0);
+
+    # --program: run all operations of the flag program in one pass
+    if options.program:
+      try:
+        program = Owlcat.Flagger.load_flag_program(options.program);
+      except Exception,exc:
+        error("Error loading flag program %s: %s"%(options.program,exc));
+      # legacy flags are filled once the program is done
+      if options.fill_legacy is not None:
+        program.append(dict(fill_legacy=options.fill_legacy));
+      print "===> running flag program %s (%d operations)"%(options.program,len(program));
+      stats = flagger.xflag_program(program);
+      for i,(op,(totrows,sel_nrow,sel_nvis,nvis_A,nvis_B,nvis_C)) in enumerate(zip(program,stats)):
+        percent = 100.0/sel_nvis if sel_nvis else 0;
+        print "===>   %d: %s"%(i+1,", ".join([ "%s=%s"%item for item in sorted(op.items()) ]));
+        print "===>      selected %8d rows, %10d visibilities, of which %10d (%.3g%%) were operated on"%(
+            sel_nrow,sel_nvis,nvis_C,nvis_C*percent);
+
+    # else not stats mode, do the actual flagging job (unless --sumthreshold or --program were the only actions)
+    if options.flag or options.unflag or not (options.sumthreshold or options.program):
+      totrows,sel_nrow,sel_nvis,nvis_A,nvis_B,nvis_C = \
+        flagger.xflag(flag=options.flag,unflag=options.unflag,fill_legacy=options.fill_legacy,
+          flag_allcorr=options.extend_all_corr,grow_time=options.grow_time,grow_freq=options.grow_freq,
+          threshold_frac=options.threshold_frac,
+          **subset);
       
-    # print stats
-    if statonly:
-      print "===> No actions were performed. Showing the result of your selection:"
-    else:
-      print "===> Flagging stats:";
-    rpc = 100.0/totrows if totrows else 0;
-    print "===>   MS size:               %8d rows"%totrows;
-    print "===>   Data/time selection:   %8d rows, %10d visibilities (%.3g%% of MS rows)"%(sel_nrow,sel_nvis,sel_nrow*rpc);
-    if legacystr:
-      print "===>     (over which legacy flags were filled using flagmask %s)"%legacystr;
-
-    percent = 100.0/sel_nvis if sel_nvis else 0;
-    if options.channels or options.corrs:
-      print "===>   Chan/corr slicing reduces this to     %10d visibilities (%.3g%% of selection)"%(nvis_A,nvis_A*percent);
-    if not (options.flagmask is None and options.flagmask_all is None and options.flagmask_none is None):
-      print "===>   Flag selection reduces this to        %10d visibilities (%.3g%% of selection)"%(nvis_B,nvis_B*percent);
-    if options.nan or options.above is not None or options.below is not None or \
-        options.fm_above is not None or options.fm_below is not None:
-      print "===>   Data selection reduces this to         %10d visibilities (%.3g%% of selection)"%(nvis_C,nvis_C*percent);
-    if unflagstr:
-      print "===>     (which were unflagged using flagmask %s)"%unflagstr;
-    if flagstr:
-      print "===>     (which were flagged using flagmask %s)"%flagstr;
+      # print stats
+      if statonly:
+        print "===> No actions were performed. Showing the result of your selection:"
+      else:
+        print "===> Flagging stats:";
+      rpc = 100.0/totrows if totrows else 0;
+      print "===>   MS size:               %8d rows"%totrows;
+      print "===>   Data/time selection:   %8d rows, %10d visibilities (%.3g%% of MS rows)"%(sel_nrow,sel_nvis,sel_nrow*rpc);
+      if legacystr:
+        print "===>     (over which legacy flags were filled using flagmask %s)"%legacystr;
+
+      percent = 100.0/sel_nvis if sel_nvis else 0;
+      if options.channels or options.corrs:
+        print "===>   Chan/corr slicing reduces this to     %10d visibilities (%.3g%% of selection)"%(nvis_A,nvis_A*percent);
+      if not (options.flagmask is None and options.flagmask_all is None and options.flagmask_none is None):
+        print "===>   Flag selection reduces this to        %10d visibilities (%.3g%% of selection)"%(nvis_B,nvis_B*percent);
+      if options.nan or options.above is not None or options.below is not None or \
+          options.fm_above is not None or options.fm_below is not None:
+        print "===>   Data selection reduces this to         %10d visibilities (%.3g%% of selection)"%(nvis_C,nvis_C*percent);
+      if unflagstr:
+        print "===>     (which were unflagged using flagmask %s)"%unflagstr;
+      if flagstr:
+        print "===>     (which were flagged using flagmask %s)"%flagstr;
+      if options.grow_time or options.grow_freq or options.threshold_frac is not None:
+        print "===>     (and then grown by %d timeslots and %d channels%s)"%(options.grow_time,options.grow_freq,
+            ", with threshold %g"%options.threshold_frac if options.threshold_frac is not None else "");
+
+    if options.occupancy and not statonly:
+      write_occupancy(flagger,subset);
 
     flagger.close();
+    report_profile(flagger);
 
   # export flags from file, if so specified
   if options.export:
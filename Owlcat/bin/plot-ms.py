@@ -37,6 +37,7 @@ import numpy.ma
 import Owlcat
 
 from Owlcat import Parsing
+from Owlcat import MSIndex
 
 COMPLEX_CIRCLE = "cc";  # identifier for the complex circle plot type
 COMPLEX_CIRCLE_MEAN = "ccm"; # identifier for the complex circle plot type
@@ -256,7 +257,7 @@ BITFLAG/FLAG columns are shared among all data columns.
     parser.error("MS not specified. Use '-h' for help.");
   msname = args[0]
   print "===> Attaching to MS %s"%msname;
-  ms = Owlcat.table(msname);
+  ms = full_ms = Owlcat.table(msname);
 
   # get flagmask, use a Flagger for this
   import Owlcat.Flagger
@@ -354,6 +355,17 @@ BITFLAG/FLAG columns are shared among all data columns.
   else:
     print "===> Selected all %d interferometers "%tot_ifrs;
 
+  # if the MS is ordered in time, a timeslot range is a contiguous range of rows, so only read those
+  if (timeslice.start is not None or timeslice.stop is not None) and (timeslice.step or 1) > 0:
+    tsindex = MSIndex.timeslot_index(ms,msname);
+    if tsindex.ordered:
+      islot0,islot1 = timeslice.indices(len(tsindex.times))[:2];
+      row0,row1 = tsindex.row_range(islot0,islot1);
+      ms = ms.selectrows(numpy.arange(row0,row1));
+      print "===> Timeslots %d:%d are rows %d:%d of the MS"%(islot0,islot1,row0,row1);
+      # per-baseline rows are now counted from the first selected timeslot
+      timeslice = slice(None,None,timeslice.step);
+
   # select DDIDs
   ddid_tab = Owlcat.table(ms.getkeyword('DATA_DESCRIPTION'));
   # default ('first') is to use first DDID in MS
@@ -474,11 +486,13 @@ and/or TaQL query (-Q/--taql) options. Or was your MS empty to begin with?""";
   active_ifrs  = set();
   labelattrs = {};  # dict of plot label attrs, updated in each loop
 
+  # split selection by DDID. The stored row index only applies if no other selection has been made
+  sub_mss = MSIndex.split_by_ddid(ms,ddids,MSIndex.row_index(ms,msname) if ms is full_ms else None);
+
   # now loop over DDIDs
-  for ddid in ddids:
+  for ddid,subms in sub_mss:
     labelattrs['ddid'] = ddid;
 
-    subms = ms.query("DATA_DESC_ID==%d"%ddid);
     datashape = [ subms.nrows(),nchan[spwids[ddid]],len(corrs[polids[ddid]]) ];
 
     print "===> Processing DATA_DESC_ID %d (%d MHz): %dx%d by %d rows"%(
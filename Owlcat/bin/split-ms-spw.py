@@ -32,6 +32,7 @@ import re
 import time
 
 from Owlcat import table,tablecopy,tableexists,tabledelete
+from Owlcat import MSIndex
 
 if __name__ == "__main__":
 
@@ -70,11 +71,13 @@ if __name__ == "__main__":
     parser.error("DATA_DESC_ID %d is out of range"%options.ddid);
   else:
     ddids = [ options.ddid ];
+  # get row subsets of each DDID from the row index, rather than querying for each DDID
+  sub_mss = MSIndex.split_by_ddid(ms,ddids,MSIndex.row_index(ms,msname));
 
   # setup outputs
   msname,msext = os.path.splitext(os.path.basename(os.path.normpath(msname)));
 
-  for ddid in ddids:
+  for ddid,ms1 in sub_mss:
     msout = options.output%dict(ms=msname,msext=msext,ddid=ddid);
     print "Extracting DATA_DESC_ID %d into MS %s"%(ddid,msout);
     # delete if exists
@@ -84,7 +87,6 @@ if __name__ == "__main__":
       print "Deleting existing copy of %s"%msout;
       tabledelete(msout);
     # extract
-    ms1 = ms.query("DATA_DESC_ID==%d"%ddid);
     ms1.copy(msout,deep=True);
     ms1.close();
 
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+#% $Id$
+#
+#
+# Copyright (C) 2002-2011
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+
+import numpy
+
+from checkutils import load_module,run_checks
+
+FlagRegions = load_module("FlagRegions");
+
+def check_regions (rng):
+  """Checks RegionIndex.overlapping() and hits() against a brute-force match of every row and region.""";
+  regions = [];
+  for i in range(40):
+    t0 = rng.uniform(0,100);
+    reg = dict(time=(t0,t0+rng.exponential(10)));
+    if rng.rand() < 0.3:
+      reg = dict(reltime=(reg['time'][0]-50,None if rng.rand() < 0.2 else reg['time'][1]-50));
+    if rng.rand() < 0.5:
+      reg['ddid'] = [ int(rng.randint(2)) ];
+    if rng.rand() < 0.3:
+      reg['baselines'] = [ (0,1),(2,3) ];
+    elif rng.rand() < 0.3:
+      reg['antennas'] = [ int(rng.randint(4)) ];
+    regions.append(reg);
+  regions.append(dict());
+  index = FlagRegions.RegionIndex(regions,time0=50);
+  def trange (reg):
+    if reg.get('reltime') is not None:
+      t0,t1 = reg['reltime'];
+      return t0+50,numpy.inf if t1 is None else t1+50;
+    return reg.get('time') or (-numpy.inf,numpy.inf);
+  for tmin,tmax in (0,5),(20,21),(99,200),(-10,-5):
+    ref = [ reg for reg in regions if trange(reg)[1] >= tmin and trange(reg)[0] <= tmax ];
+    found = [ index.regions[i] for i in index.overlapping(tmin,tmax) ];
+    assert sorted(map(id,found)) == sorted(map(id,ref)),"overlapping(%g,%g) differs"%(tmin,tmax);
+  time = rng.uniform(-5,120,200);
+  ant1 = rng.randint(0,3,200);
+  ant2 = ant1 + rng.randint(1,3,200);
+  for ddid in 0,1:
+    rows,regs = index.hits(ddid,time,ant1,ant2);
+    found = set(zip(rows.tolist(),[ id(index.regions[i]) for i in regs ]));
+    ref = set();
+    for row in range(len(time)):
+      for reg in regions:
+        t0,t1 = trange(reg);
+        if t0 <= time[row] <= t1 and (reg.get('ddid') is None or ddid in reg['ddid']) and \
+            (reg.get('baselines') is None or (ant1[row],ant2[row]) in reg['baselines']) and \
+            (reg.get('antennas') is None or ant1[row] in reg['antennas'] or ant2[row] in reg['antennas']):
+          ref.add((row,id(reg)));
+    assert found == ref,"hits() for ddid %d differs"%ddid;
+
+if __name__ == "__main__":
+  run_checks([ ("regions",check_regions) ],
+    "Checks the flag region index (Owlcat.FlagRegions.RegionIndex) against a brute-force match of every "
+    "row and region, on random data. Needs numpy only.");
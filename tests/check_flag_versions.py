@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+#% $Id$
+#
+#
+# Copyright (C) 2002-2011
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+
+import numpy
+
+from checkutils import load_module,run_checks
+
+FlagVersions = load_module("FlagVersions");
+
+def check_versions (rng):
+  """Checks FlagVersions.pack()/unpack() round trips, and that XORed deltas combine and count changes.""";
+  shape = (13,7,4);
+  for dtype in bool,numpy.int32:
+    states = [ (rng.rand(*shape)<0.2) if dtype is bool else rng.randint(0,4,shape).astype(dtype) for i in range(3) ];
+    for state in states:
+      assert (FlagVersions.unpack(FlagVersions.pack(state),shape,dtype) == state).all(),"pack/unpack round trip failed";
+    packed = [ FlagVersions.pack(state) for state in states ];
+    # delta 0->1 XOR delta 1->2 is delta 0->2, and applying a delta to a state gives the other state
+    d01,d12 = [ {0:dict(COL=packed[i]^packed[i+1])} for i in 0,1 ];
+    d02 = FlagVersions.xor_deltas(d01,d12);
+    assert (d02[0]['COL'] == packed[0]^packed[2]).all(),"xor_deltas() does not combine deltas";
+    state2 = FlagVersions.unpack(packed[0]^d02[0]['COL'],shape,dtype);
+    assert (state2 == states[2]).all(),"applying a delta does not restore the state";
+    assert FlagVersions.count_changes(d02[0]['COL'],dtype) == (states[0]!=states[2]).sum(),"count_changes() is wrong";
+    # a delta XORed with itself cancels out entirely
+    assert FlagVersions.xor_deltas(d01,d01) == {},"xor_deltas() of a delta with itself is not empty";
+
+if __name__ == "__main__":
+  run_checks([ ("versions",check_versions) ],
+    "Checks the flag version deltas (Owlcat.FlagVersions pack/unpack, XOR deltas and change counts) "
+    "on random data. Needs numpy only.");
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+#% $Id$
+#
+#
+# Copyright (C) 2002-2011
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+
+import numpy
+
+from checkutils import load_module,run_checks
+
+Autoflag = load_module("Autoflag");
+
+def check_grow (rng):
+  """Checks Autoflag.dilate() and grow_flags() against a brute-force dilation, over a plane holding several
+  baselines, then checks that growing in windows of time with a halo carry (as Flagger.grow_flags() does for
+  long baselines) gives the same flags as growing the whole plane.""";
+  bounds = [ 0,5,23,24,40 ];
+  flags = rng.rand(bounds[-1],12,2) < 0.04;
+  lower = numpy.zeros(bounds[-1],int);
+  upper = numpy.zeros(bounds[-1],int);
+  for b0,b1 in zip(bounds[:-1],bounds[1:]):
+    lower[b0:b1],upper[b0:b1] = b0,b1;
+  for gt,gf,thr in (0,0,None),(2,1,None),(3,0,0.3),(1,4,0.5):
+    ref = numpy.zeros_like(flags);
+    for i in range(len(flags)):
+      for j in range(flags.shape[1]):
+        ref[i,j] = flags[max(i-gt,lower[i]):min(i+gt+1,upper[i]),max(j-gf,0):j+gf+1].any(0).any(0);
+    if thr is not None:
+      ref[ref.reshape((len(ref),-1)).mean(1)>thr] = True;
+    grown = Autoflag.grow_flags(flags,gt,gf,thr,lower,upper);
+    assert (grown == ref).all(),"grow_flags(%d,%d,%s) differs from brute force"%(gt,gf,thr);
+    # now grow a single baseline in windows of 'window' core rows, each read in with gt rows of halo
+    # either side. The leading halo is taken from a carry of the flags as originally read in, since
+    # in the MS it would already have been overwritten by the previous window
+    plane = flags[bounds[1]:bounds[2]];
+    whole = Autoflag.grow_flags(plane,gt,gf,thr);
+    for window in 1,4,7:
+      current = plane.copy();
+      carry = None;
+      for c0 in range(0,len(plane),window):
+        c1 = min(c0+window,len(plane));
+        r0,r1 = max(c0-gt,0),min(c1+gt,len(plane));
+        chunk = current[r0:r1].copy();
+        h = c0-r0;
+        if h:
+          chunk[:h] = carry[-h:];
+        if gt:
+          carry = numpy.concatenate((carry,chunk[h:h+c1-c0]))[-gt:] if c0 else chunk[h:h+c1-c0][-gt:];
+        current[c0:c1] = Autoflag.grow_flags(chunk,gt,gf,thr)[h:h+c1-c0];
+      assert (current == whole).all(),"windowed grow_flags(%d,%d,%s) with window %d differs"%(gt,gf,thr,window);
+
+if __name__ == "__main__":
+  run_checks([ ("grow",check_grow) ],
+    "Checks flag growing (Owlcat.Autoflag.grow_flags(), including growing in windows with a halo carry) "
+    "against a brute-force dilation, on random data. Needs numpy only.");
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+#% $Id$
+#
+#
+# Copyright (C) 2002-2011
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+
+import numpy
+
+from checkutils import load_module,run_checks
+
+Autoflag = load_module("Autoflag");
+
+def check_sumthreshold (rng):
+  """Checks the cumulative-sum window sums of the SumThreshold passes against explicit window sums.""";
+  values = abs(rng.randn(37,9))*2;
+  flags = rng.rand(37,9) < 0.1;
+  for m in 1,2,3,8,37:
+    for chi in 1.,2.5:
+      for axis in 0,1:
+        v,f = (values,flags) if axis == 0 else (values.T,flags.T);
+        if len(v) < m:
+          continue;
+        w = numpy.where(f,chi,v);
+        # sums taken from cumulative sums are only exact to rounding, so windows summing to within rounding
+        # of the threshold (e.g. all-flagged ones) may go either way: the result must lie between the
+        # samples flagged with a slightly higher and a slightly lower threshold
+        ref_hi = numpy.zeros(v.shape,bool);
+        ref_lo = numpy.zeros(v.shape,bool);
+        for j in range(len(v)-m+1):
+          wsum = w[j:j+m].sum(0);
+          ref_hi[j:j+m] |= (wsum > m*chi*(1+1e-9))[numpy.newaxis,:];
+          ref_lo[j:j+m] |= (wsum > m*chi*(1-1e-9))[numpy.newaxis,:];
+        result = Autoflag._sumthreshold_pass(values,flags,chi,m,axis);
+        if axis:
+          result = result.T;
+        assert not (ref_hi&~result).any() and not (result&~ref_lo).any(),"SumThreshold pass m=%d axis=%d differs"%(m,axis);
+
+if __name__ == "__main__":
+  run_checks([ ("sumthreshold",check_sumthreshold) ],
+    "Checks the cumulative-sum window sums of the SumThreshold passes (Owlcat.Autoflag) against explicit "
+    "window sums, on random data. Needs numpy only.");
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+#
+#% $Id$
+#
+#
+# Copyright (C) 2002-2011
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+
+"""Helpers for the self-checks of the pure numpy kernels of the flagging engine. Each check_*.py script
+in this directory checks the kernels of one part of the engine against brute-force versions on random
+data, needs numpy only, and exits with an error status if a check fails. The checks are not installed.
+""";
+
+import sys
+import os.path
+import imp
+import traceback
+
+import numpy
+
+def load_module (name):
+  """Loads the given module of the Owlcat package directly from its file in the source tree, so that
+  the package itself (which needs pyrap and Kittens) is not imported.""";
+  pkgdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,"Owlcat");
+  return imp.load_source("Owlcat_check_%s"%name,os.path.join(pkgdir,name+".py"));
+
+def run_checks (checks,description):
+  """Parses the command line, and runs the given list of (name,function) checks. Each function is called
+  with a numpy RandomState, once per trial. Exits with an error status if any check fails.""";
+  from optparse import OptionParser
+  parser = OptionParser(usage="""%prog: [options]""",description=description);
+  parser.add_option("-s","--seed",metavar="N",type="int",default=0,
+                    help="random seed. Default is %default.");
+  parser.add_option("-n","--trials",metavar="N",type="int",default=5,
+                    help="number of times to run each check, with different random data. Default is %default.");
+
+  (options,args) = parser.parse_args();
+  if args:
+    parser.error("Incorrect number of arguments. Use '-h' for help.");
+
+  failed = [];
+  for name,check in checks:
+    rng = numpy.random.RandomState(options.seed);
+    try:
+      for i in range(options.trials):
+        check(rng);
+    except AssertionError:
+      print "%-16s FAILED: %s"%(name,sys.exc_info()[1]);
+      failed.append(name);
+    except:
+      traceback.print_exc();
+      print "%-16s ERROR"%name;
+      failed.append(name);
+    else:
+      print "%-16s ok"%name;
+
+  if failed:
+    print "%d check(s) failed: %s"%(len(failed),", ".join(failed));
+    sys.exit(1);